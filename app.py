@@ -1,15 +1,18 @@
 #!/usr/bin/env python
 
 # for system operations, file handling
-import base64
-import os
+import atexit
+import hmac
 import mimetypes
+import os
+import secrets
 import random
 import string
 import time
 from functools import wraps
-from hashlib import md5
+from hashlib import sha256
 from pathlib import Path
+from urllib.parse import quote
 
 # for image handling
 from io import BytesIO
@@ -20,13 +23,14 @@ import json
 from flask import (
     Flask,
     flash,
+    g,
     request,
     redirect,
     url_for,
     jsonify,
     render_template,
     make_response,
-    send_from_directory,
+    send_file,
 )
 from werkzeug.exceptions import RequestEntityTooLarge
 from flask_talisman import Talisman
@@ -48,12 +52,28 @@ from jwt.exceptions import PyJWTError, ExpiredSignatureError
 
 # for local database
 from threading import Lock
-from tinydb import TinyDB, Query
-import tinydb.operations
+from database import ViewBuffer, open_database
+
+# for resized copies of the uploaded images
+# made by a pool of worker processes
+import derivatives
+from jobs import JobQueue, JobQueueFull
+
+# for uploads stored once per content
+import storage
+
+# for cached authentication tokens
+from cache import LRUCache
+
+# for the uploads shared with the other worker processes
+from locks import FileLock
 
 # for authentication, CAPTCHA image
 import bcrypt
 from captcha.image import ImageCaptcha
+from captchas import (
+    CaptchaPool, ExpiringStore, FileNonceStore, FileStore, NonceStore
+)
 
 # SECRETs
 from secret import SECRET_KEY, CAPTCHA_KEY
@@ -68,15 +88,45 @@ app = Flask(__name__)
 app.config["UPLOAD_DIR"] = UPLOAD_DIR
 app.config["SECRET_KEY"] = SECRET_KEY
 app.config["CAPTCHA_KEY"] = CAPTCHA_KEY
+app.config["JWT_CACHE_SIZE"] = 4096  # verified tokens kept in memory
+app.config["JWT_CACHE_TTL"] = 5 * 60  # seconds before verifying again
+app.config["AVATAR_CACHE_SIZE"] = 4096  # resolved avatars kept in memory
+app.config["AVATAR_CACHE_TTL"] = 60  # seconds before resolving again
 app.config["CAPTCHA_EXPIRE_SECONDS"] = 5 * 60  # 5 minutes
-app.config["MAX_CONTENT_LENGTH"] = 1 * 1000 * 1000  # 1MB limit
+# "hmac" (single-use tokens) or "bcrypt" (slower, tokens can be reused)
+app.config["CAPTCHA_MODE"] = "hmac"
+app.config["CAPTCHA_SIZE"] = (140, 50)  # width, height of the image
+app.config["CAPTCHA_FORMAT"] = "webp"  # or "png", larger
+app.config["CAPTCHA_IMAGES"] = 10000  # images waiting to be fetched
+app.config["CAPTCHA_POOL_SIZE"] = 32  # CAPTCHAs made ahead of time
+app.config["CAPTCHA_POOL_LOW_WATERMARK"] = 8  # refill the pool below this
+app.config["CAPTCHA_POOL_MAX_AGE"] = 60  # seconds a CAPTCHA waits to be served
+# uploads are streamed to the disk, only a chunk is held in memory
+app.config["MAX_CONTENT_LENGTH"] = 16 * 1000 * 1000  # 16MB limit
+# or "sqlite:///photostore.sqlite3", or "shards:///photostore-shards"
 app.config["DATABASE"] = "photostore.db"
+app.config["IMAGE_CACHE_SIZE"] = 4096  # image records kept in memory
+app.config["SHARED_DATABASE"] = False  # set by `share_state`
+# token of '/api/stats' (Authorization: Bearer <token>), None to disable it
+app.config["STATS_TOKEN"] = None
 app.config["USE_CAPTCHA"] = True
+app.config["IMAGE_INFO_BATCH_LIMIT"] = 100  # images per '/api/image/info'
+app.config["IMAGE_LIST_PAGE_SIZE"] = 24  # default page of '/api/image/list'
+app.config["IMAGE_LIST_MAX_PAGE_SIZE"] = 100
+app.config["POPULAR_IMAGES"] = 4  # images on the index page
+app.config["WEBP_DERIVATIVES"] = True  # also generate WebP derivatives
+app.config["IMAGE_WORKERS"] = 2  # processes resizing the images
+app.config["IMAGE_QUEUE_SIZE"] = 64  # images waiting to be resized
+app.config["VIEW_FLUSH_INTERVAL"] = 5  # seconds between writes of the views
+app.config["VIEW_BUFFER_SIZE"] = 256  # views written early once reached
+# None (sent by the app), "x-accel-redirect" (nginx) or "x-sendfile"
+app.config["SENDFILE"] = None
+app.config["SENDFILE_PREFIX"] = "/protected/uploads/"  # nginx, 'internal'
 
 # apply Talisman
 csp = {
     "default-src": "'self'",
-    "img-src": "'self' data:"
+    "img-src": "'self'"
 }
 
 talisman = Talisman(app, force_https=False, content_security_policy=csp)
@@ -84,12 +134,141 @@ talisman = Talisman(app, force_https=False, content_security_policy=csp)
 # enable CSRF validation
 csrf = CSRFProtect(app)
 
+# for verified JWT tokens, token -> claims
+jwt_cache = LRUCache(
+    max_size=app.config["JWT_CACHE_SIZE"],
+    ttl=app.config["JWT_CACHE_TTL"],
+)
+
+# for resolved avatars, username -> (file path or None, version)
+avatar_cache = LRUCache(
+    max_size=app.config["AVATAR_CACHE_SIZE"],
+    ttl=app.config["AVATAR_CACHE_TTL"],
+)
+
 # for CAPTCHA
-captcha = ImageCaptcha()
+# the default font sizes of ImageCaptcha fit a height of 60px
+captcha = ImageCaptcha(
+    *app.config["CAPTCHA_SIZE"],
+    font_sizes=tuple(
+        font_size * app.config["CAPTCHA_SIZE"][1] // 60
+        for font_size in (42, 50, 56)
+    ),
+)
+captcha_nonces = NonceStore()
+
+# for CAPTCHA images, served by '/api/captcha/<id>.<ext>' until they expire
+captcha_images = ExpiringStore(max_size=app.config["CAPTCHA_IMAGES"])
+
+# Pillow options of each CAPTCHA format, favoring the encoding speed
+CAPTCHA_FORMATS = {
+    "png": {"format": "PNG", "compress_level": 1},
+    "webp": {"format": "WEBP", "quality": 60, "method": 0},
+}
+
+# for image processing, off the request threads
+jobs = JobQueue(
+    workers=app.config["IMAGE_WORKERS"],
+    max_pending=app.config["IMAGE_QUEUE_SIZE"],
+)
+atexit.register(jobs.shutdown)
+
+# for local database, opened once and shared by every request
+database = None
+database_lock = Lock()
+
+
+def get_db():
+    """
+    Return the process-wide database handle
+    it is opened on first use and kept alive afterwards
+    """
+
+    global database
+
+    if database is None or database.uri != app.config["DATABASE"]:
+        with database_lock:
+            if database is None or database.uri != app.config["DATABASE"]:
+                database = open_database(
+                    app.config["DATABASE"],
+                    image_cache_size=app.config["IMAGE_CACHE_SIZE"],
+                    shared=app.config["SHARED_DATABASE"],
+                )
+
+    return database
+
+
+# for the files shared by several images, held while an image is
+# added to (or removed from) a file, so that a file is never removed
+# while it gains a new reference, by any of the worker processes
+upload_lock = None
+upload_lock_guard = Lock()
+
+
+def get_upload_lock():
+    """
+    Return the process-wide lock of the uploads directory
+    (`app.config["UPLOAD_DIR"]`), see 'upload_lock'
+    """
+
+    global upload_lock
+
+    path = os.path.join(app.config["UPLOAD_DIR"], ".lock")
+
+    if upload_lock is None or upload_lock.path != path:
+        with upload_lock_guard:
+            if upload_lock is None or upload_lock.path != path:
+                upload_lock = FileLock(path)
+
+    return upload_lock
+
+
+# for image views, written in batches off the request threads
+views = ViewBuffer(
+    lambda pending: get_db().add_image_views(pending),
+    max_pending=app.config["VIEW_BUFFER_SIZE"],
+    interval=app.config["VIEW_FLUSH_INTERVAL"],
+)
+atexit.register(views.flush)
+
+
+def share_state(directory):
+    """
+    Share the state of the web application with the other
+    worker processes of './server.py', in the files of 'directory'
+    must be called before the first request
+
+        - the CAPTCHA images and nonces, kept in files
+        - the cached data, invalidated by the changes made
+          by the other processes, see `open_database`
+    """
+
+    global captcha_nonces, captcha_images
+
+    captcha_nonces = FileNonceStore(os.path.join(directory, "nonces"))
+    captcha_images = FileStore(os.path.join(directory, "captchas"))
+    app.config["SHARED_DATABASE"] = True
+
+
+def run_image_job(key, func, *args, callback=None):
+    """
+    Run 'func(*args)' in the background under 'key'
+    then 'callback' with its result
+
+    when the queue is full, it runs in the current thread
+    instead, which slows down the uploads during a burst
+    """
 
-# for local database (but this table is not used)
-TinyDB.default_table_name = "photostore"
-db_lock = Lock()
+    try:
+        jobs.submit(key, func, *args, callback=callback)
+    except JobQueueFull:
+        try:
+            result = func(*args)
+        except (OSError, UnidentifiedImageError):
+            app.logger.exception(f"job {key} failed")
+        else:
+            if callback:
+                callback(result)
 
 
 def is_allowed_file(filename):
@@ -140,8 +319,20 @@ def decode_from_jwt(token):
     """
     Wrapper method to decode 'token' into
     JWT data using app's SECRET_KEY
+
+    verified tokens are cached, only the
+    invalid ones are verified every time
     """
 
+    if not token:
+        return {}
+
+    jwt_data = jwt_cache.get(token)
+
+    if jwt_data is not None:
+        # a copy, the cached claims are shared by the requests
+        return dict(jwt_data)
+
     jwt_data = {}
 
     try:
@@ -153,19 +344,42 @@ def decode_from_jwt(token):
     except PyJWTError:
         pass
 
+    if jwt_data:
+        jwt_cache.put(token, dict(jwt_data), expiry=jwt_data.get("exp"))
+
     return jwt_data
 
 
+def current_username():
+    """
+    Return the username of the client, None if it is not logged in
+    """
+
+    return decode_from_jwt(request.cookies.get("jwt")).get("username")
+
+
+def captcha_hmac(nonce, captcha_code):
+    """
+    Return the keyed hash of 'captcha_code' for the token 'nonce'
+    """
+
+    return hmac.new(
+        app.config["CAPTCHA_KEY"],
+        b"captcha:" + nonce.encode("latin1") + b":" + captcha_code,
+        sha256,
+    ).hexdigest()
+
+
 def generate_captcha():
     """
     Generate a captcha using random text and other
     related attributes:
         - captcha value, answer
-        - captcha image encoded in base64
-        - **salted** captcha hash of the captcha value
-            to later verify the captcha response
+        - captcha image, encoded in 'CAPTCHA_FORMAT'
+        - **salted** (bcrypt) or **keyed** (HMAC) captcha hash
+            of the captcha value to later verify the captcha response
         - JWT token of the generated captcha hash
-            with an **expiry**
+            with an **expiry** (and a **nonce** in HMAC mode)
     """
 
     # select a random length between 6 and 10
@@ -176,28 +390,48 @@ def generate_captcha():
 
     captcha_image = captcha.generate_image(captcha_value)
     captcha_buffer = BytesIO()
-    captcha_image.save(captcha_buffer, format="PNG")
-    captcha_base64 = base64.b64encode(
-        captcha_buffer.getvalue()
-    ).decode("latin1")
+    captcha_image.save(
+        captcha_buffer,
+        **CAPTCHA_FORMATS[app.config["CAPTCHA_FORMAT"]]
+    )
+    captcha_bytes = captcha_buffer.getvalue()
 
     captcha_timestamp = int(time.time())
     captcha_expiry = captcha_timestamp + app.config["CAPTCHA_EXPIRE_SECONDS"]
 
-    captcha_salt = bcrypt.gensalt(rounds=12)
     captcha_code = (str(captcha_expiry) + captcha_value).encode("latin")
-    captcha_hash = bcrypt.hashpw(captcha_code, captcha_salt).decode("latin1")
+    captcha_claims = {"exp": captcha_expiry}
+
+    if app.config["CAPTCHA_MODE"] == "hmac":
+        # the hash can't be brute-forced without the key, and
+        # the nonce lets every token be verified only once
+        captcha_claims["nonce"] = secrets.token_urlsafe(16)
+        captcha_hash = captcha_hmac(captcha_claims["nonce"], captcha_code)
+    else:
+        captcha_salt = bcrypt.gensalt(rounds=12)
+        captcha_hash = bcrypt.hashpw(
+            captcha_code, captcha_salt
+        ).decode("latin1")
+
+    captcha_claims["hash"] = captcha_hash
 
     captcha_jwt = jwt.encode(
-        {
-            "hash": captcha_hash,
-            "exp": captcha_expiry
-        },
+        captcha_claims,
         key=app.config["CAPTCHA_KEY"],
         algorithm="HS256",
     )
 
-    return captcha_value, captcha_base64, captcha_hash, captcha_jwt
+    return captcha_value, captcha_bytes, captcha_hash, captcha_jwt
+
+
+# for CAPTCHAs generated in the background, ready to be served
+captcha_pool = CaptchaPool(
+    generate_captcha,
+    size=app.config["CAPTCHA_POOL_SIZE"],
+    low_watermark=app.config["CAPTCHA_POOL_LOW_WATERMARK"],
+    max_age=app.config["CAPTCHA_POOL_MAX_AGE"],
+)
+atexit.register(captcha_pool.close)
 
 
 def verify_captcha(captcha_answer, token):
@@ -225,14 +459,89 @@ def verify_captcha(captcha_answer, token):
         pass
 
     if jwt_data:
-        captcha_hash = jwt_data["hash"].encode("latin1")
+        captcha_hash = jwt_data["hash"]
         captcha_expiry = jwt_data["exp"]
         captcha_code = (str(captcha_expiry) + captcha_answer).encode("latin1")
-        captcha_result["valid"] = bcrypt.checkpw(captcha_code, captcha_hash)
+
+        # the mode the token was made with, not the current one
+        if "nonce" in jwt_data:
+            # a replayed token is never valid, even with the right answer
+            if captcha_nonces.use(jwt_data["nonce"], captcha_expiry):
+                captcha_result["valid"] = hmac.compare_digest(
+                    captcha_hmac(jwt_data["nonce"], captcha_code),
+                    captcha_hash,
+                )
+        else:
+            captcha_result["valid"] = bcrypt.checkpw(
+                captcha_code, captcha_hash.encode("latin1")
+            )
 
     return captcha_result
 
 
+def can_view_image(image, username):
+    """
+    Check if 'username' has access to the given 'image'
+    this check prevents IDOR
+    """
+
+    return bool(image.get("public") or image.get("owner") == username)
+
+
+def image_info(image, username):
+    """
+    Return the information of 'image' as shown to 'username'
+    """
+
+    return {
+        "id": image["id"],
+        "timestamp": image.get("timestamp"),
+        "owner": image.get("owner"),
+        "description": image.get("description"),
+        "public": image.get("public"),
+        "likes": list(image.get("likes")),
+        "views": len(image.get("views")),
+        "comments": image.get("comments"),
+        "firstSeen": username and username not in image.get("views"),
+    }
+
+
+def select_image_file(image, size):
+    """
+    Return the file to serve for the 'size' of 'image'
+    and whether it is the requested size or the original
+    as a fallback, while the derivatives are not ready
+
+    the WebP derivative is preferred when the client accepts it
+    """
+
+    filename = image.get("filename")
+    generated = image.get("derivatives")
+
+    if size == "original":
+        return filename, True
+
+    if generated is None:
+        return filename, False
+
+    candidates = [derivatives.derivative_filename(filename, size)]
+
+    if (
+        app.config["WEBP_DERIVATIVES"] and
+        request.accept_mimetypes["image/webp"]
+    ):
+        candidates.insert(
+            0, derivatives.derivative_filename(filename, size, "webp")
+        )
+
+    for candidate in candidates:
+        if candidate in generated:
+            return candidate, True
+
+    # small images have no derivatives, the original is the thumbnail
+    return filename, True
+
+
 def no_cache(func):
     """
     Decorator to apply cache headers to the generated
@@ -251,6 +560,103 @@ def no_cache(func):
     return inner
 
 
+def conditional(get_keys, variant=current_username, cache_control=None):
+    """
+    Decorator to answer a conditional request (If-None-Match)
+    with '304 Not Modified' before running the route, when the
+    data of the response did not change since
+
+    'get_keys(**kwargs)' returns the version keys of that data
+    (see `database.image_keys`), the ETag also depends on the
+    query string and on 'variant()', by default the client
+
+    the responses can be stored, but are revalidated every time
+    unless the route sets its own Cache-Control, or 'cache_control'
+    is given: 'cache_control(**kwargs)' is then the Cache-Control
+    of every response, the '304 Not Modified' ones included
+
+    the ETag is kept in 'g.etag' for the route, see `send_upload`
+    """
+
+    def decorator(func):
+        @wraps(func)
+        def inner(*args, **kwargs):
+            etag = get_db().versions.etag(
+                get_keys(**kwargs),
+                variant(),
+                request.query_string,
+            )
+            g.etag = etag
+
+            if request.if_none_match.contains(etag):
+                resp = make_response("", 304)
+            else:
+                resp = make_response(func(*args, **kwargs))
+
+            if resp.status_code in (200, 206, 304):
+                resp.set_etag(etag)
+
+            if cache_control is not None:
+                resp.headers["Cache-Control"] = cache_control(**kwargs)
+            elif "Cache-Control" not in resp.headers:
+                resp.headers["Cache-Control"] = "private, no-cache"
+
+            return resp
+
+        return inner
+
+    return decorator
+
+
+def send_upload(filepath):
+    """
+    Return the response serving the stored file 'filepath'
+
+    with 'SENDFILE' set, only the access checks are done by the
+    application, the front proxy sends the file (see README.md)
+    and answers the Range requests itself
+
+    otherwise the file is handed to the server as a
+    `wsgi.file_wrapper`, a Range request is answered with
+    '206 Partial Content' if its If-Range (if any) matches
+    the ETag of `conditional`
+    """
+
+    mode = app.config["SENDFILE"]
+
+    if not mode:
+        resp = send_file(filepath, etag=g.get("etag", True))
+        resp.accept_ranges = "bytes"
+        return resp
+
+    resp = app.response_class()
+    resp.mimetype = (
+        mimetypes.guess_type(filepath)[0] or "application/octet-stream"
+    )
+
+    if mode == "x-accel-redirect":
+        path = os.path.relpath(filepath, app.config["UPLOAD_DIR"])
+        resp.headers["X-Accel-Redirect"] = quote(
+            app.config["SENDFILE_PREFIX"] + path.replace(os.sep, "/")
+        )
+    else:
+        resp.headers["X-Sendfile"] = os.path.abspath(filepath)
+
+    return resp
+
+
+def image_version_keys(kind, id):
+    """
+    Return the version keys of 'kind' ("image" or "file") of the
+    image 'id' given in the URL, none if 'id' is not a number
+    """
+
+    try:
+        return [(kind, int(id))]
+    except ValueError:
+        return []
+
+
 # `@app.errorhandler(413)` can also be used
 @app.errorhandler(RequestEntityTooLarge)
 def request_entity_too_large(_):
@@ -342,29 +748,110 @@ def community():
 
 
 @app.route("/api/captcha")
+@no_cache
 def api_captcha():
     """
     API endpoint to generate a captcha
     e.g. used when the user refreshes the captcha
+
+    the image is served from 'url' until the captcha expires,
+    e.g. to a reload of the page
     """
 
     (
         _,  # captcha_value
-        captcha_base64,
+        captcha_bytes,
         _,  # captcha_hash
         captcha_jwt
-    ) = generate_captcha()
+    ) = captcha_pool.pop()
+
+    captcha_id = secrets.token_urlsafe(16)
+    captcha_images.add(
+        captcha_id,
+        captcha_bytes,
+        time.time() + app.config["CAPTCHA_EXPIRE_SECONDS"],
+    )
 
     return jsonify({
-        "b64": captcha_base64,
+        "url": url_for(
+            "api_captcha_image",
+            captcha_id=captcha_id,
+            ext=app.config["CAPTCHA_FORMAT"],
+        ),
         "jwt": captcha_jwt
     })
 
 
-@app.route("/api/image/list")
+@app.route("/api/captcha/<captcha_id>.<ext>")
 @no_cache
+def api_captcha_image(captcha_id, ext):
+    """
+    API endpoint to get the image of a captcha
+    given by '/api/captcha'
+    """
+
+    if ext != app.config["CAPTCHA_FORMAT"]:
+        return ("", 404)
+
+    captcha_bytes = captcha_images.get(captcha_id)
+
+    if captcha_bytes is None:
+        return ("", 404)
+
+    return app.response_class(captcha_bytes, mimetype=f"image/{ext}")
+
+
+@app.route("/api/stats")
+@no_cache
+def api_stats():
+    """
+    API endpoint to monitor the in-memory caches
+    only answered with the `STATS_TOKEN`, behind a front proxy
+    every client would be local
+    """
+
+    token = app.config["STATS_TOKEN"]
+
+    if not token:
+        return (jsonify(None), 404)
+
+    if not hmac.compare_digest(
+        request.headers.get("Authorization", ""), f"Bearer {token}"
+    ):
+        return (jsonify(None), 403)
+
+    return jsonify({
+        "jwt_cache": jwt_cache.stats(),
+        "avatar_cache": avatar_cache.stats(),
+        "image_cache": get_db().image_cache.stats(),
+        "database_lock": get_db().lock_stats(),
+        "upload_lock": get_upload_lock().stats(),
+    })
+
+
+def image_list_keys():
+    """
+    Return the version keys of the list of images requested
+    """
+
+    username = current_username()
+
+    if request.args.get("pagetype") == "profile" and username:
+        return [("user", username)]
+
+    return [("public",)]
+
+
+@app.route("/api/image/list")
+@conditional(image_list_keys)
 def api_image_list():
-    data = []
+    """
+    API endpoint to list the images of a page, newest first
+
+    the list is paginated with 'limit' and 'after', the
+    cursor '<timestamp>-<id>' of the last image of the
+    previous page, e.g. '?pagetype=community&after=1640995200-42'
+    """
 
     token = request.cookies.get("jwt")
     jwt_data = decode_from_jwt(token)
@@ -372,33 +859,51 @@ def api_image_list():
 
     which_page = request.args.get("pagetype", "index")
 
-    with (
-        db_lock,
-        TinyDB(app.config["DATABASE"]) as db
-    ):
-        images = db.table("images")
+    try:
+        limit = int(
+            request.args.get("limit", app.config["IMAGE_LIST_PAGE_SIZE"])
+        )
+        after = request.args.get("after")
 
-        if which_page == "profile" and username:
-            data += images.search(Query().owner == username)
+        if after:
+            timestamp, id = after.split("-")
+            after = (int(timestamp), int(id))
         else:
-            data += images.search(Query().public == True)  # noqa: E712
+            after = None
+    except ValueError:
+        return (json.dumps(None), 404)
 
-        if which_page == "index":
-            # sort such that images with most likes and views comes first
-            data.sort(
-                key=lambda image: len(image["likes"]) + len(image["views"]),
-                reverse=True,
-            )
-            data = [image.doc_id for image in data[:4]]
-        else:
-            # sort such that most recent images comes first
-            data.sort(key=lambda image: image["timestamp"], reverse=True)
-            data = [image.doc_id for image in data]
+    limit = max(1, min(limit, app.config["IMAGE_LIST_MAX_PAGE_SIZE"]))
+
+    db = get_db()
+
+    if which_page == "index":
+        # images with most likes and views comes first
+        data = db.popular_images(app.config["POPULAR_IMAGES"])
+    elif which_page == "profile" and username:
+        data = db.list_images(owner=username, limit=limit, after=after)
+    else:
+        data = db.list_images(limit=limit, after=after)
+
+    # `expand=info` returns the info of every image along with its ID
+    # so that the client does not need one more request per image
+    if request.args.get("expand") == "info":
+        data = [image_info(image, username) for image in data]
+    else:
+        data = [image["id"] for image in data]
 
     return jsonify(data)
 
 
 @app.route("/api/image/get/<id>")
+@conditional(
+    lambda id: image_version_keys("file", id),
+    # the WebP derivatives are only served to the clients accepting them
+    variant=lambda: (
+        current_username(),
+        bool(request.accept_mimetypes["image/webp"]),
+    ),
+)
 def api_image_get(id):
     try:
         id = int(id)
@@ -412,58 +917,62 @@ def api_image_get(id):
     jwt_data = decode_from_jwt(token)
     username = jwt_data.get("username")
 
-    with (
-        db_lock,
-        TinyDB(app.config["DATABASE"]) as db
-    ):
-        images = db.table("images")
-        image = images.get(doc_id=id)
+    db = get_db()
+    image = db.get_image(id)
 
     if not image:
         return ("", 404)
 
-    public = image.get("public")
-    owner = image.get("owner")
-    filename = image.get("filename")
+    # 'thumb', 'medium' or 'original'
+    size = request.args.get("size", "original")
+
+    if size != "original" and size not in derivatives.SIZES:
+        return ("", 404)
 
     # check if the client has access to view this image or not
-    # this check prevents IDOR
-    if not owner == username and not public:
+    if not can_view_image(image, username):
         return ("", 403)
 
     # update the views if this image is accessible by the current user
-    with (
-        db_lock,
-        TinyDB(app.config["DATABASE"]) as db
-    ):
-        images = db.table("images")
-        views = image.get("views")
-
-        if username and username not in views:
-            views.append(username)
-            images.update(
-                tinydb.operations.set("views", views),
-                doc_ids=[id]
-            )
+    # buffered, the database is written in the background
+    if username and username not in image.get("views"):
+        views.add(id, username)
+
+    filename, exact = select_image_file(image, size)
+    filepath = storage.find_upload(app.config["UPLOAD_DIR"], filename)
+
+    if filepath:
+        resp = make_response(send_upload(filepath))
 
-    filepath = os.path.join(app.config["UPLOAD_DIR"], filename)
+        if exact:
+            # images won't change, so they can be cached
+            resp.headers["Cache-Control"] = "max-age=31536000, immutable"
+        else:
+            # the derivative is not ready (yet), don't cache the fallback
+            resp.headers["Cache-Control"] = "no-cache"
 
-    if os.path.isfile(filepath):
-        resp = make_response(send_from_directory(
-            app.config["UPLOAD_DIR"],
-            filename
-        ))
+        if size != "original":
+            resp.vary.add("Accept")
 
-        # images won't change, so they can be cached
-        resp.headers["Cache-Control"] = "max-age=31536000, immutable"
         return resp
 
     return ("", 404)
 
 
-@app.route("/api/image/info/<id>")
+@app.route("/api/image/status/<id>")
 @no_cache
-def api_image_info(id):
+def api_image_status(id):
+    """
+    API endpoint to poll the processing of an image
+    'derivatives' is one of:
+        - "queued", "running", waiting for the resized copies
+        - "done", the resized copies are served
+        - "failed", only the original is served
+        - "missing", never generated (e.g. older uploads)
+    the jobs are only known by the worker process (see './server.py')
+    which queued them, the others answer "missing" meanwhile
+    """
+
     try:
         id = int(id)
     except ValueError:
@@ -472,40 +981,85 @@ def api_image_info(id):
     if not id:
         return (json.dumps(None), 404)
 
-    image = None
-
-    with (
-        db_lock,
-        TinyDB(app.config["DATABASE"]) as db
-    ):
-        images = db.table("images")
-        image = images.get(doc_id=id)
+    image = get_db().get_image(id)
 
     if not image:
         return (json.dumps(None), 404)
 
-    public = image.get("public")
-    owner = image.get("owner")
+    token = request.cookies.get("jwt")
+    jwt_data = decode_from_jwt(token)
+    username = jwt_data.get("username")
+
+    if not can_view_image(image, username):
+        return (jsonify(None), 403)
+
+    if image.get("derivatives") is not None:
+        status = "done"
+    else:
+        status = jobs.status(f"image-{id}") or "missing"
+
+    return jsonify({"derivatives": status})
+
+
+@app.route("/api/image/info/<id>")
+@conditional(lambda id: image_version_keys("image", id))
+def api_image_info(id):
+    try:
+        id = int(id)
+    except ValueError:
+        id = None
+
+    if not id:
+        return (json.dumps(None), 404)
+
+    image = get_db().get_image(id)
+
+    if not image:
+        return (json.dumps(None), 404)
 
     token = request.cookies.get("jwt")
     jwt_data = decode_from_jwt(token)
     username = jwt_data.get("username")
 
-    if not (public or owner == username):
+    if not can_view_image(image, username):
         return (jsonify(None), 403)
 
-    info = {
-        "timestamp": image.get("timestamp"),
-        "owner": owner,
-        "description": image.get("description"),
-        "public": public,
-        "likes": image.get("likes"),
-        "views": len(image.get("views")),
-        "comments": image.get("comments"),
-        "firstSeen": username and username not in image.get("views"),
-    }
+    return jsonify(image_info(image, username))
 
-    return jsonify(info)
+
+@app.route("/api/image/info")
+@conditional(lambda: [
+    key
+    for id in request.args.get("ids", "").split(",")
+    for key in image_version_keys("image", id)
+])
+def api_image_info_batch():
+    """
+    API endpoint to get the info of many images at once
+    e.g. '/api/image/info?ids=1,2,3'
+
+    images which do not exist or are not accessible
+    by the client are left out of the response
+    """
+
+    try:
+        ids = [int(id) for id in request.args.get("ids", "").split(",") if id]
+    except ValueError:
+        return (json.dumps(None), 404)
+
+    ids = ids[:app.config["IMAGE_INFO_BATCH_LIMIT"]]
+
+    token = request.cookies.get("jwt")
+    jwt_data = decode_from_jwt(token)
+    username = jwt_data.get("username")
+
+    data = [
+        image_info(image, username)
+        for image in get_db().get_images(ids)
+        if can_view_image(image, username)
+    ]
+
+    return jsonify(data)
 
 
 @app.route("/api/image/delete", methods=["POST"])
@@ -520,14 +1074,8 @@ def api_image_delete():
     if not id:
         return (json.dumps(None), 404)
 
-    image = None
-
-    with (
-        db_lock,
-        TinyDB(app.config["DATABASE"]) as db
-    ):
-        images = db.table("images")
-        image = images.get(doc_id=id)
+    db = get_db()
+    image = db.get_image(id)
 
     if not image:
         return (json.dumps(None), 404)
@@ -540,30 +1088,15 @@ def api_image_delete():
     username = jwt_data.get("username")
 
     if owner == username:
-        filepath = os.path.join(app.config["UPLOAD_DIR"], filename)
-
-        if os.path.isfile(filepath):
-            os.remove(filepath)
-
-            with (
-                db_lock,
-                TinyDB(app.config["DATABASE"]) as db
-            ):
-                accounts = db.table("accounts")
-                accounts.update(
-                    tinydb.operations.decrement("uploads"),
-                    Query().username == username,
-                )
+        if storage.find_upload(app.config["UPLOAD_DIR"], filename):
+            with get_upload_lock().hold():
+                db.remove_image(id)
 
-                images = db.table("images")
-                image = images.remove(doc_ids=[id])
+                # the file may be shared with other images
+                if not db.file_references(filename):
+                    storage.remove_upload(app.config["UPLOAD_DIR"], filename)
 
-                image_list = images.search(Query().owner == username)
-                total_likes = total_views = 0
-
-                for image in image_list:
-                    total_likes += len(image.get("likes"))
-                    total_views += len(image.get("views"))
+            total_likes, total_views = db.account_totals(username)
 
             info = {"total_likes": total_likes, "total_views": total_views}
             return jsonify(info)
@@ -587,14 +1120,8 @@ def api_image_make_public():
     if not id:
         return (json.dumps(None), 404)
 
-    image = None
-
-    with (
-        db_lock,
-        TinyDB(app.config["DATABASE"]) as db
-    ):
-        images = db.table("images")
-        image = images.get(doc_id=id)
+    db = get_db()
+    image = db.get_image(id)
 
     if not image:
         return (json.dumps(None), 404)
@@ -606,17 +1133,8 @@ def api_image_make_public():
     username = jwt_data.get("username")
 
     if owner == username:
-        with (
-            db_lock,
-            TinyDB(app.config["DATABASE"]) as db
-        ):
-            images = db.table("images")
-            images.update(
-                tinydb.operations.set("public", make_public),
-                doc_ids=[id]
-            )
-
-            return (json.dumps(True), 200)
+        db.set_image_public(id, make_public)
+        return (json.dumps(True), 200)
 
     return (json.dumps(False), 403)
 
@@ -642,45 +1160,17 @@ def api_image_like():
     if not username:
         return (json.dumps(False), 403)
 
-    image = None
+    db = get_db()
+    likes = db.set_image_like(id, username, like)
 
-    with (
-        db_lock,
-        TinyDB(app.config["DATABASE"]) as db
-    ):
-        images = db.table("images")
-        image = images.get(doc_id=id)
-
-    if not image:
+    if likes is None:
         return (json.dumps(None), 404)
 
-    total_likes = 0
-
-    with (
-        db_lock,
-        TinyDB(app.config["DATABASE"]) as db
-    ):
-        images = db.table("images")
-        likes = image.get("likes")
-
-        if like and username not in likes:
-            likes.append(username)
-        elif not like and username in likes:
-            likes.remove(username)
-
-        images.update(
-            tinydb.operations.set("likes", likes),
-            doc_ids=[id]
-        )
-
-        image_list = images.search(Query().owner == username)
-
-        for image in image_list:
-            total_likes += len(image.get("likes"))
+    total_likes, _ = db.account_totals(username)
 
     return (
         json.dumps({
-            "likes": likes,
+            "likes": list(likes),
             "total_likes": total_likes
         }),
         200
@@ -713,37 +1203,16 @@ def api_image_comment():
     if not username:
         return (json.dumps(False), 403)
 
-    image = None
-
-    with (
-        db_lock,
-        TinyDB(app.config["DATABASE"]) as db
-    ):
-        images = db.table("images")
-        image = images.get(doc_id=id)
+    timestamp = int(time.time())
+    comments = get_db().add_image_comment(id, {
+        "username": username,
+        "comment": comment,
+        "timestamp": timestamp
+    })
 
-    if not image:
+    if comments is None:
         return (json.dumps(None), 404)
 
-    with (
-        db_lock,
-        TinyDB(app.config["DATABASE"]) as db
-    ):
-        images = db.table("images")
-        comments = image.get("comments")
-        timestamp = int(time.time())
-
-        comments.append({
-            "username": username,
-            "comment": comment,
-            "timestamp": timestamp
-        })
-
-        images.update(
-            tinydb.operations.set("comments", comments),
-            doc_ids=[id]
-        )
-
     return (json.dumps({"comments": comments}), 200)
 
 
@@ -790,27 +1259,20 @@ def avatar():
             )
             return redirect(return_url)
 
-        # this will clear `file.stream`, so it will become empty
-        buffer = BytesIO(file.stream.read())
-        image = None
-
+        # kept until a worker has made the thumbnail in PNG-format
+        # the current avatar is shown meanwhile
         try:
-            image = Image.open(buffer)
-            image.resize
-        except UnidentifiedImageError:
+            upload_path, _ = storage.receive_upload(
+                file.stream, app.config["UPLOAD_DIR"]
+            )
+        except storage.InvalidUpload:
             flash("Unsupported image!", "error")
         else:
-            # `ext_from_mime` will be of the form `.ext`
-            mimetype = image.get_format_mimetype()
-            ext_from_mime = mimetypes.guess_extension(mimetype)
-
-            if not is_allowed_file(ext_from_mime):
-                flash(f"Invalid mimetype: `{mimetype}`", "error")
-                return redirect(return_url)
+            # only the header is read
+            with Image.open(upload_path) as image:
+                size = image.size
 
             # check if the avatar is square or not
-            size = image.size
-
             if size[0] != size[1]:
                 flash(
                     "Uploaded image is not square!",
@@ -819,54 +1281,119 @@ def avatar():
 
             # create a thumbnail instead of saving the actual image
             # it will be shown as the profile **icon**
-            image.thumbnail((256, 256))
             filename = f"avatar-{username}.png"
-            filepath = os.path.join(
-                app.config["UPLOAD_DIR"],
-                filename
+            filepath = storage.upload_path(app.config["UPLOAD_DIR"], filename)
+
+            run_image_job(
+                f"avatar-{username}",
+                derivatives.make_avatar,
+                upload_path,
+                filepath,
+                callback=lambda _: avatar_changed(username, filename),
             )
 
-            # save the image in PNG-format
-            image.save(filepath, format="PNG")
-
-            with (
-                db_lock,
-                TinyDB(app.config["DATABASE"]) as db
-            ):
-                accounts = db.table("accounts")
-                accounts.update(
-                    tinydb.operations.set("avatar", filename),
-                    Query().username == username,
-                )
-
             flash("Avatar updated successfully!", "success")
 
         return redirect(return_url)
 
     # re-use the already implemented method
-    return avatar_username(username)
+    return avatar_username(username=username)
+
+
+def avatar_changed(username, filename):
+    """
+    Record the new avatar 'filename' of 'username'
+    """
+
+    get_db().update_account(username, {"avatar": filename})
+
+
+def resolve_avatar(username):
+    """
+    Return the path of the avatar file of 'username' (None if
+    there is none) and its version, which changes with the file
+
+    cached, the account is only looked up when its avatar is
+    first requested and after it changed
+    """
+
+    if not is_valid_username(username):
+        return None, "default"
+
+    # changed by any of the worker processes, see `open_database`
+    current = get_db().versions.current([("avatar", username)])
+    avatar = avatar_cache.get(
+        username, valid=lambda entry: entry[0] == current
+    )
+
+    if avatar is not None:
+        return avatar[1]
+
+    filepath = None
+    version = "default"
+    account = get_db().get_account(username)
+
+    if account and account.get("avatar"):
+        filepath = storage.find_upload(
+            app.config["UPLOAD_DIR"], account["avatar"]
+        )
+
+    if filepath:
+        version = f"{os.stat(filepath).st_mtime_ns:x}"
+
+    avatar = (filepath, version)
+    avatar_cache.put(username, (current, avatar))
+    return avatar
+
+
+@app.template_global()
+def avatar_url(username=None):
+    """
+    Return the URL of the avatar of 'username', by default the
+    client, which changes with the avatar so it can be cached
+    """
+
+    username = username or current_username()
+
+    if not username:
+        return url_for("avatar")
+
+    _, version = resolve_avatar(username)
+    return url_for("avatar_username", username=username, v=version)
+
+
+def avatar_cache_control(username):
+    """
+    Return the Cache-Control of the avatar of 'username'
+    the versioned URLs (see `avatar_url`) are cached for good,
+    the other ones are revalidated
+    """
+
+    _, version = resolve_avatar(username)
+
+    if request.args.get("v") == version:
+        return "public, max-age=31536000, immutable"
+
+    return "no-cache"
 
 
 @app.route("/avatar/<username>")
+@conditional(
+    lambda username: [("avatar", username)],
+    # the same for every client
+    variant=lambda: None,
+    cache_control=avatar_cache_control,
+)
 def avatar_username(username):
-    filename = None
-
-    if is_valid_username(username):
-        with (
-            db_lock,
-            TinyDB(app.config["DATABASE"]) as db
-        ):
-            accounts = db.table("accounts")
-            account = accounts.get(Query().username == username)
+    """
+    Serve the avatar of 'username', without looking up
+    the database once it is resolved (see `resolve_avatar`)
+    """
 
-            if account:
-                filename = account.get("avatar")
+    filepath, _ = resolve_avatar(username)
 
-    if (
-        filename and
-        os.path.isfile(os.path.join(app.config["UPLOAD_DIR"], filename))
-    ):
-        return send_from_directory(app.config["UPLOAD_DIR"], filename)
+    if filepath:
+        return send_upload(filepath)
     else:
         return redirect(url_for("static", filename="icons/defaultprofile.png"))
 
@@ -922,15 +1449,8 @@ def signup():
                 flash("CAPTCHA error!", "error")
                 return redirect(request.url)
 
-        user_registered = True
-
-        with (
-            db_lock,
-            TinyDB(app.config["DATABASE"]) as db
-        ):
-            accounts = db.table("accounts")
-            account = accounts.get(Query().username == username)
-            user_registered = account is not None
+        account = get_db().get_account(username)
+        user_registered = account is not None
 
         if user_registered:
             flash("Username already registered!", "error")
@@ -948,14 +1468,14 @@ def signup():
             "avatar": None,
             "timestamp": int(time.time()),
             "uploads": 0,
+            "total_likes": 0,
+            "total_views": 0,
         }
 
-        with (
-            db_lock,
-            TinyDB(app.config["DATABASE"]) as db
-        ):
-            accounts = db.table("accounts")
-            accounts.insert(account)
+        # another signup may have taken the username meanwhile
+        if get_db().add_account(account) is None:
+            flash("Username already registered!", "error")
+            return redirect(request.url)
 
         resp = make_response(redirect(url_for("profile")))
         resp.set_cookie(
@@ -1004,19 +1524,14 @@ def login():
         user_registered = False
         valid_credentials = False
 
-        with (
-            db_lock,
-            TinyDB(app.config["DATABASE"]) as db
-        ):
-            accounts = db.table("accounts")
-            account = accounts.get(Query().username == username)
-
-            if account:
-                user_registered = True
-                passwd_hash = account.get("passwd_hash").encode("latin1")
-                valid_credentials = bcrypt.checkpw(
-                    password.encode("latin1"), passwd_hash
-                )
+        account = get_db().get_account(username)
+
+        if account:
+            user_registered = True
+            passwd_hash = account.get("passwd_hash").encode("latin1")
+            valid_credentials = bcrypt.checkpw(
+                password.encode("latin1"), passwd_hash
+            )
 
         if user_registered:
             if valid_credentials:
@@ -1039,6 +1554,8 @@ def login():
 
 @app.route("/logout")
 def logout():
+    jwt_cache.pop(request.cookies.get("jwt"))
+
     resp = make_response(redirect(url_for("login")))
     resp.delete_cookie("jwt")
     return resp
@@ -1058,22 +1575,13 @@ def profile():
     uploads = 0
     total_likes = total_views = 0
 
-    with (
-        db_lock,
-        TinyDB(app.config["DATABASE"]) as db
-    ):
-        accounts = db.table("accounts")
-        account = accounts.get(Query().username == username)
-
-        if account:
-            uploads = account.get("uploads", 0)
-
-            images = db.table("images")
-            image_list = images.search(Query().owner == username)
+    db = get_db()
+    account = db.get_account(username)
 
-            for image in image_list:
-                total_likes += len(image.get("likes"))
-                total_views += len(image.get("views"))
+    if account:
+        uploads = account.get("uploads", 0)
+        total_likes = account.get("total_likes", 0)
+        total_views = account.get("total_views", 0)
 
     return render_template(
         "profile.html",
@@ -1088,7 +1596,7 @@ def profile():
 
 
 @app.route("/api/user/info/<username>")
-@no_cache
+@conditional(lambda username: [("user", username)])
 def api_user_info(username):
     uploads = 0
     total_likes = 0
@@ -1096,22 +1604,13 @@ def api_user_info(username):
 
     account = None
 
-    with (
-        db_lock,
-        TinyDB(app.config["DATABASE"]) as db
-    ):
-        accounts = db.table("accounts")
-        account = accounts.get(Query().username == username)
-
-        if account:
-            uploads = account.get("uploads", 0)
-
-            images = db.table("images")
-            image_list = images.search(Query().owner == username)
+    db = get_db()
+    account = db.get_account(username)
 
-            for image in image_list:
-                total_likes += len(image.get("likes"))
-                total_views += len(image.get("views"))
+    if account:
+        uploads = account.get("uploads", 0)
+        total_likes = account.get("total_likes", 0)
+        total_views = account.get("total_views", 0)
 
     if not account:
         return (json.dumps(None), 404)
@@ -1161,38 +1660,53 @@ def upload():
         ext = extension(file.filename)
 
         if is_allowed_file(file.filename):
-            timestamp = time.time()
-            timestamp_hash = md5(
-                str(timestamp).encode("utf-8")
-            ).hexdigest()
-
-            filename = f"{username}-{timestamp_hash}.{ext}"
-            filepath = os.path.join(app.config["UPLOAD_DIR"], filename)
-            file.save(filepath)
+            try:
+                temp_path, filename = storage.receive_upload(
+                    file.stream, app.config["UPLOAD_DIR"]
+                )
+            except storage.InvalidUpload:
+                flash("Unsupported image!", "error")
+                return redirect(request.url)
 
             image = {
                 "filename": filename,
                 "owner": username,
-                "timestamp": int(timestamp),
+                "timestamp": int(time.time()),
                 "public": False,
                 "description": description,
                 "likes": [],
                 "views": [],
                 "comments": [],
+                "derivatives": None,
             }
 
-            with (
-                db_lock,
-                TinyDB(app.config["DATABASE"]) as db
-            ):
-                accounts = db.table("accounts")
-                accounts.update(
-                    tinydb.operations.increment("uploads"),
-                    Query().username == username,
-                )
+            db = get_db()
 
-                images = db.table("images")
-                images.insert(image)
+            # an identical file is stored once, whoever uploaded it
+            with get_upload_lock().hold():
+                storage.store_upload(
+                    app.config["UPLOAD_DIR"], temp_path, filename
+                )
+                id = db.add_image(image)
+
+            def derivatives_done(generated):
+                # the image may have been deleted in the meantime
+                if not db.set_image_derivatives(id, generated):
+                    with get_upload_lock().hold():
+                        if not db.file_references(filename):
+                            storage.remove_upload(
+                                app.config["UPLOAD_DIR"], filename
+                            )
+
+            # the original is served until the derivatives are ready
+            run_image_job(
+                f"image-{id}",
+                derivatives.generate_derivatives,
+                storage.upload_directory(app.config["UPLOAD_DIR"], filename),
+                filename,
+                app.config["WEBP_DERIVATIVES"],
+                callback=derivatives_done,
+            )
 
             flash("File uploaded successfully!", "success")
         else:
@@ -1257,19 +1771,14 @@ def reset_pwd():
         account = None
         valid_credentials = False
 
-        with (
-            db_lock,
-            TinyDB(app.config["DATABASE"]) as db
-        ):
-            accounts = db.table("accounts")
-            account = accounts.get(Query().username == username)
-
-            if account:
-                passwd_hash = account.get("passwd_hash").encode("latin1")
-                valid_credentials = bcrypt.checkpw(
-                    current_password.encode("latin1"),
-                    passwd_hash
-                )
+        account = get_db().get_account(username)
+
+        if account:
+            passwd_hash = account.get("passwd_hash").encode("latin1")
+            valid_credentials = bcrypt.checkpw(
+                current_password.encode("latin1"),
+                passwd_hash
+            )
 
         if valid_credentials:
             passwd_salt = bcrypt.gensalt(rounds=12)
@@ -1278,14 +1787,12 @@ def reset_pwd():
                 passwd_salt
             ).decode("latin1")
 
-            account["passwd_hash"] = passwd_hash
+            get_db().update_account(username, {"passwd_hash": passwd_hash})
 
-            with (
-                db_lock,
-                TinyDB(app.config["DATABASE"]) as db
-            ):
-                accounts = db.table("accounts")
-                accounts.update(account)
+            # every token of the user is verified again
+            jwt_cache.remove_matching(
+                lambda claims: claims.get("username") == username
+            )
 
             flash("Password updated successfully", "success")
             return redirect(url_for("profile"))
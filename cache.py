@@ -0,0 +1,176 @@
+# in-memory caches of the web application
+# e.g. the verified JWT tokens, so that every request with the
+# same cookie does not verify (and parse) the token again, the
+# image records, and the version counters identifying (ETag) the
+# cached responses
+
+import secrets
+import time
+from collections import OrderedDict
+from hashlib import sha1
+from threading import Lock
+
+
+class LRUCache:
+    """
+    Bounded, thread-safe mapping which forgets the least
+    recently used entries past 'max_size'
+
+    entries also expire 'ttl' seconds after they are added
+    (or at the expiry given to 'put', if sooner)
+
+    hits, misses and evictions are counted, see 'stats'
+    """
+
+    def __init__(self, max_size=1024, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+
+        self.lock = Lock()
+        # key -> (expiry or None, value), least recently used first
+        self.entries = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None, valid=None):
+        """
+        Return the value cached for 'key', or 'default'
+
+        'valid(value)', if given, tells if the cached value can
+        still be served, it is forgotten (a miss) otherwise
+        """
+
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is not None and (
+                (entry[0] is None or entry[0] > time.time())
+                and (valid is None or valid(entry[1]))
+            ):
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+
+            if entry is not None:
+                del self.entries[key]
+
+            self.misses += 1
+            return default
+
+    def put(self, key, value, expiry=None):
+        """
+        Cache 'value' for 'key', until 'expiry' (UNIX time)
+        at the latest
+        """
+
+        if self.ttl is not None:
+            ttl_expiry = time.time() + self.ttl
+            expiry = ttl_expiry if expiry is None else min(expiry, ttl_expiry)
+
+        with self.lock:
+            self.entries[key] = (expiry, value)
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key):
+        """
+        Forget the value cached for 'key', if any
+        """
+
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def remove_matching(self, predicate):
+        """
+        Forget every value for which 'predicate(value)' is true
+        """
+
+        with self.lock:
+            for key in [
+                key for key, (_, value) in self.entries.items()
+                if predicate(value)
+            ]:
+                del self.entries[key]
+
+    def stats(self):
+        """
+        Return the size and the hit rate of the cache
+        """
+
+        with self.lock:
+            lookups = self.hits + self.misses
+
+            return {
+                "size": len(self.entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else None,
+            }
+
+
+class Versions:
+    """
+    Version counters of the data served by the routes, bumped on
+    every change, so that a response can be identified (ETag) by
+    the versions of the data it is built from, without building it
+
+    'epoch' is random, so that the counters of a restarted process
+    never match the ETags handed out before
+
+    'sync()', if given, is called before the versions are read,
+    e.g. to catch up with the changes made by other processes
+    """
+
+    def __init__(self, sync=None):
+        self.lock = Lock()
+        self.epoch = secrets.token_hex(8)
+        self.counters = {}
+        self.sync = sync
+
+    def bump(self, *keys):
+        """
+        Mark the data of every key in 'keys' as changed
+        """
+
+        with self.lock:
+            for key in keys:
+                self.counters[key] = self.counters.get(key, 0) + 1
+
+    def reset(self, epoch=None):
+        """
+        Mark all the data as changed, the new 'epoch' is
+        random unless given (e.g. shared with other processes)
+        """
+
+        with self.lock:
+            self.epoch = secrets.token_hex(8) if epoch is None else epoch
+            self.counters.clear()
+
+    def current(self, keys):
+        """
+        Return the current version of the data of 'keys'
+        """
+
+        if self.sync is not None:
+            self.sync()
+
+        with self.lock:
+            return self.epoch, [self.counters.get(key, 0) for key in keys]
+
+    def etag(self, keys, *variant):
+        """
+        Return the ETag of a response built from the data of 'keys'
+        'variant' are the other inputs of the response, e.g. the user
+        """
+
+        epoch, versions = self.current(keys)
+        state = repr((epoch, keys, versions, variant))
+
+        return sha1(state.encode("utf-8")).hexdigest()
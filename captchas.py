@@ -0,0 +1,380 @@
+# pool of ready-made CAPTCHAs, their images waiting to be fetched
+# and the nonces of the used ones
+# rendering the image (and hashing the answer in bcrypt mode) takes
+# a large part of a second, so it is done ahead of time in a thread
+#
+# the images and nonces are kept in memory, or in files shared by
+# the worker processes of './server.py' (see 'FileStore'), as the
+# image of a CAPTCHA may be fetched from (and its answer checked
+# by) another process than the one which served it
+
+import heapq
+import logging
+import os
+import re
+import secrets
+import tempfile
+import time
+from collections import deque
+from threading import Condition, Lock, Thread
+
+logger = logging.getLogger(__name__)
+
+
+class CaptchaPool:
+    """
+    Bounded pool of CAPTCHAs made by 'generate'
+
+    a background thread refills the pool up to 'size' whenever
+    it drops below 'low_watermark', so that serving a CAPTCHA
+    is just taking one out of the pool
+
+    a CAPTCHA expires some time after it is made, the ones older
+    than 'max_age' seconds are discarded instead of served, so
+    that the users always get enough time to solve them, the
+    thread discards them as they expire and makes new ones, so
+    that the pool is still full after an idle period
+
+    when 'generate' fails, it is retried after 'retry_delay'
+    seconds, doubled on every failure up to 'max_retry_delay'
+    """
+
+    def __init__(
+        self, generate, size=32, low_watermark=8, max_age=60,
+        retry_delay=1, max_retry_delay=60,
+    ):
+        self.generate = generate
+        self.size = size
+        self.low_watermark = low_watermark
+        self.max_age = max_age
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+
+        self.ready = Condition()
+        self.thread = None
+        self.closed = False
+
+        # (time it was made, CAPTCHA), oldest first
+        self.captchas = deque()
+
+    def _wait_for_refill(self):
+        """
+        Wait until the pool drops below the low watermark, or
+        its oldest CAPTCHA expires, with 'ready' held
+        """
+
+        while not self.closed:
+            if self._discard_expired() or (
+                len(self.captchas) < self.low_watermark
+            ):
+                return
+
+            if self.captchas:
+                expiry = self.captchas[0][0] + self.max_age
+                self.ready.wait(expiry - time.monotonic())
+            else:
+                self.ready.wait()
+
+    def _run(self):
+        retry_delay = self.retry_delay
+
+        while True:
+            with self.ready:
+                self._wait_for_refill()
+
+                if self.closed:
+                    return
+
+            while len(self.captchas) < self.size and not self.closed:
+                try:
+                    captcha = self.generate()
+                except Exception:
+                    logger.exception(
+                        "could not generate a CAPTCHA, retrying in %ss",
+                        retry_delay,
+                    )
+
+                    with self.ready:
+                        self.ready.wait_for(
+                            lambda: self.closed, timeout=retry_delay
+                        )
+
+                    retry_delay = min(retry_delay * 2, self.max_retry_delay)
+                    continue
+
+                retry_delay = self.retry_delay
+
+                with self.ready:
+                    self.captchas.append((time.monotonic(), captcha))
+
+    def _discard_expired(self):
+        """
+        Discard the expired CAPTCHAs and return how many were
+        """
+
+        oldest = time.monotonic() - self.max_age
+        discarded = 0
+
+        while self.captchas and self.captchas[0][0] < oldest:
+            self.captchas.popleft()
+            discarded += 1
+
+        return discarded
+
+    def pop(self):
+        """
+        Return a CAPTCHA out of the pool, or a new one
+        if the pool is empty
+        """
+
+        with self.ready:
+            # started on first use, not in every importing process
+            if self.thread is None:
+                self.thread = Thread(
+                    target=self._run, name="captcha-pool", daemon=True
+                )
+                self.thread.start()
+
+            self._discard_expired()
+            captcha = self.captchas.pop()[1] if self.captchas else None
+
+            if len(self.captchas) < self.low_watermark:
+                self.ready.notify()
+
+        if captcha is None:
+            captcha = self.generate()
+
+        return captcha
+
+    def close(self):
+        """
+        Stop refilling the pool, once the CAPTCHA being
+        made is done
+        """
+
+        with self.ready:
+            self.closed = True
+            self.ready.notify()
+            thread = self.thread
+
+        if thread is not None:
+            thread.join()
+
+
+class ExpiringStore:
+    """
+    Values kept in memory until they expire
+
+    an expired value is forgotten on the next call,
+    the store never grows with the expired ones
+
+    past 'max_size' values, the ones expiring first are
+    forgotten early
+    """
+
+    def __init__(self, max_size=None):
+        self.max_size = max_size
+        self.lock = Lock()
+        self.values = {}
+
+        # heap of (expiry, key), to forget the expired values
+        self.expiries = []
+
+    def _forget_expired(self):
+        now = time.time()
+
+        while self.expiries and self.expiries[0][0] < now:
+            _, key = heapq.heappop(self.expiries)
+            self.values.pop(key, None)
+
+    def add(self, key, value, expiry):
+        """
+        Store 'value' under 'key' until 'expiry' (UNIX time)
+        return False (and keep the current value) if the key is taken
+        """
+
+        with self.lock:
+            self._forget_expired()
+
+            if key in self.values:
+                return False
+
+            while self.max_size and len(self.values) >= self.max_size:
+                _, oldest = heapq.heappop(self.expiries)
+                self.values.pop(oldest, None)
+
+            self.values[key] = value
+            heapq.heappush(self.expiries, (expiry, key))
+
+        return True
+
+    def get(self, key):
+        """
+        Return the value of 'key', None if there is none
+        """
+
+        with self.lock:
+            self._forget_expired()
+            return self.values.get(key)
+
+    def pop(self, key):
+        """
+        Remove and return the value of 'key', None if there is none
+        """
+
+        with self.lock:
+            self._forget_expired()
+            return self.values.pop(key, None)
+
+
+class NonceStore(ExpiringStore):
+    """
+    Nonces of the CAPTCHA tokens already checked, so that
+    every token can only be used once
+
+    a nonce is forgotten when its token expires, the
+    token is rejected from then on anyway
+    """
+
+    def use(self, nonce, expiry):
+        """
+        Mark 'nonce', whose token expires at 'expiry' (UNIX time),
+        as used and return False if it already was
+        """
+
+        return self.add(nonce, True, expiry)
+
+
+class FileStore:
+    """
+    Values (bytes) kept in the files of 'directory' until they
+    expire, shared by the processes using the same directory,
+    see 'ExpiringStore'
+
+    a value is written aside then linked under its key, and taken
+    by renaming it, so that a key is only ever added (or popped)
+    by a single process, the modification time of a file is the
+    expiry of its value
+
+    the expired values are removed every 'cleanup_interval' seconds
+    """
+
+    # the keys are file names, e.g. 'secrets.token_urlsafe()'
+    KEY = re.compile(r"[\w-]+", re.ASCII)
+
+    def __init__(self, directory, cleanup_interval=60):
+        self.directory = directory
+        self.cleanup_interval = cleanup_interval
+        self.next_cleanup = 0
+
+        os.makedirs(directory, exist_ok=True)
+
+    def _forget_expired(self):
+        now = time.time()
+
+        if now < self.next_cleanup:
+            return
+
+        self.next_cleanup = now + self.cleanup_interval
+
+        for entry in os.scandir(self.directory):
+            # the values being added or popped
+            if entry.name.startswith("."):
+                continue
+
+            try:
+                if entry.stat().st_mtime < now:
+                    os.remove(entry.path)
+            except FileNotFoundError:
+                # popped meanwhile
+                pass
+
+    def add(self, key, value, expiry):
+        """
+        Store 'value' under 'key' until 'expiry' (UNIX time)
+        return False (and keep the current value) if the key is taken
+        """
+
+        if not self.KEY.fullmatch(key):
+            raise ValueError(f"invalid key: {key!r}")
+
+        self._forget_expired()
+
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix=".")
+
+        try:
+            with os.fdopen(fd, "wb") as file:
+                file.write(value)
+
+            os.utime(temp_path, (expiry, expiry))
+
+            try:
+                os.link(temp_path, os.path.join(self.directory, key))
+            except FileExistsError:
+                return False
+        finally:
+            os.remove(temp_path)
+
+        return True
+
+    def get(self, key):
+        """
+        Return the value of 'key', None if there is none
+        """
+
+        if not self.KEY.fullmatch(key):
+            return None
+
+        self._forget_expired()
+
+        try:
+            with open(os.path.join(self.directory, key), "rb") as file:
+                if os.fstat(file.fileno()).st_mtime < time.time():
+                    return None
+
+                return file.read()
+        except FileNotFoundError:
+            return None
+
+    def pop(self, key):
+        """
+        Remove and return the value of 'key', None if there is none
+        """
+
+        if not self.KEY.fullmatch(key):
+            return None
+
+        self._forget_expired()
+
+        taken_path = os.path.join(
+            self.directory, f".{key}.{secrets.token_hex(8)}"
+        )
+
+        try:
+            os.rename(os.path.join(self.directory, key), taken_path)
+        except FileNotFoundError:
+            return None
+
+        try:
+            with open(taken_path, "rb") as file:
+                if os.fstat(file.fileno()).st_mtime < time.time():
+                    return None
+
+                return file.read()
+        finally:
+            os.remove(taken_path)
+
+
+class FileNonceStore(FileStore):
+    """
+    Nonces of the CAPTCHA tokens already checked by any of the
+    processes sharing 'directory', see 'NonceStore'
+    """
+
+    def use(self, nonce, expiry):
+        """
+        Mark 'nonce', whose token expires at 'expiry' (UNIX time),
+        as used and return False if it already was
+        """
+
+        return self.add(nonce, b"", expiry)
@@ -0,0 +1,2725 @@
+# storage layer of the web application
+# every route goes through a single, process-wide database handle
+# instead of opening (and re-parsing) the database file per request
+#
+# the backend is selected by `app.config["DATABASE"]`, see `open_database`
+#   - "photostore.db"                  -> JSONDatabase (TinyDB)
+#   - "sqlite:///photostore.sqlite3"   -> SQLiteDatabase (WAL mode)
+#   - "shards:///photostore-shards"    -> ShardedDatabase (a directory
+#                                         of TinyDB files, one per shard)
+
+import json
+import logging
+import os
+import sqlite3
+import time
+from bisect import bisect_left, insort
+from hashlib import sha256
+from contextlib import contextmanager
+from threading import Event, Lock, Thread, local
+
+from tinydb import TinyDB
+from tinydb.table import Document
+from tinydb.storages import Storage
+
+from cache import LRUCache, Versions
+from locks import FileLock, LockStats, RWLock
+
+logger = logging.getLogger(__name__)
+
+SQLITE_SCHEME = "sqlite://"
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS accounts (
+    id INTEGER PRIMARY KEY,
+    username TEXT NOT NULL UNIQUE,
+    passwd_hash TEXT NOT NULL,
+    avatar TEXT,
+    timestamp INTEGER NOT NULL,
+    uploads INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS images (
+    id INTEGER PRIMARY KEY,
+    filename TEXT NOT NULL,
+    owner_id INTEGER NOT NULL REFERENCES accounts(id),
+    timestamp INTEGER NOT NULL,
+    public INTEGER NOT NULL DEFAULT 0,
+    description TEXT NOT NULL DEFAULT ''
+);
+
+CREATE TABLE IF NOT EXISTS likes (
+    image_id INTEGER NOT NULL REFERENCES images(id) ON DELETE CASCADE,
+    account_id INTEGER NOT NULL REFERENCES accounts(id),
+    UNIQUE (image_id, account_id)
+);
+
+CREATE TABLE IF NOT EXISTS views (
+    image_id INTEGER NOT NULL REFERENCES images(id) ON DELETE CASCADE,
+    account_id INTEGER NOT NULL REFERENCES accounts(id),
+    UNIQUE (image_id, account_id)
+);
+
+CREATE TABLE IF NOT EXISTS comments (
+    id INTEGER PRIMARY KEY,
+    image_id INTEGER NOT NULL REFERENCES images(id) ON DELETE CASCADE,
+    account_id INTEGER NOT NULL REFERENCES accounts(id),
+    comment TEXT NOT NULL,
+    timestamp INTEGER NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS comments_image ON comments (image_id);
+CREATE INDEX IF NOT EXISTS images_owner_timeline
+    ON images (owner_id, timestamp, id);
+CREATE INDEX IF NOT EXISTS images_public_timeline
+    ON images (timestamp, id) WHERE public = 1;
+"""
+
+# changes to the schema of existing databases, in order
+# `PRAGMA user_version` records how many of them are applied
+SQLITE_MIGRATIONS = [
+    # per-account counters of the likes and views on its images
+    """
+    ALTER TABLE accounts ADD COLUMN total_likes INTEGER NOT NULL DEFAULT 0;
+    ALTER TABLE accounts ADD COLUMN total_views INTEGER NOT NULL DEFAULT 0;
+    UPDATE accounts SET
+        total_likes = (
+            SELECT COUNT(*) FROM likes
+            JOIN images ON images.id = likes.image_id
+            WHERE images.owner_id = accounts.id
+        ),
+        total_views = (
+            SELECT COUNT(*) FROM views
+            JOIN images ON images.id = views.image_id
+            WHERE images.owner_id = accounts.id
+        );
+    """,
+    # replaced by the timeline indexes
+    """
+    DROP INDEX IF EXISTS images_owner;
+    DROP INDEX IF EXISTS images_public;
+    """,
+    # popularity (likes + views) of the images, for the index page
+    """
+    ALTER TABLE images ADD COLUMN score INTEGER NOT NULL DEFAULT 0;
+    UPDATE images SET score =
+        (SELECT COUNT(*) FROM likes WHERE image_id = images.id) +
+        (SELECT COUNT(*) FROM views WHERE image_id = images.id);
+    CREATE INDEX images_popularity
+        ON images (score, timestamp, id) WHERE public = 1;
+    """,
+    # JSON list of the resized copies, NULL until they are generated
+    """
+    ALTER TABLE images ADD COLUMN derivatives TEXT;
+    """,
+    # images sharing a file, which are its references
+    """
+    CREATE INDEX images_filename ON images (filename);
+    """,
+    # versions shared by the processes, see 'SQLiteVersions'
+    """
+    CREATE TABLE versions (key TEXT PRIMARY KEY, seq INTEGER NOT NULL);
+    CREATE INDEX versions_seq ON versions (seq);
+    CREATE TABLE versions_epoch (epoch TEXT NOT NULL);
+    INSERT INTO versions_epoch VALUES (lower(hex(randomblob(8))));
+    """,
+]
+
+
+SHARDS_SCHEME = "shards://"
+
+# number of shards of a new sharded database,
+# see `python manage.py reshard` to change it
+DEFAULT_SHARDS = 16
+
+# file of a sharded database recording its number of shards
+SHARDS_MANIFEST = "shards.json"
+
+# accounts and images of every shard, see `ShardedDatabase`
+CATALOG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS accounts (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    username TEXT NOT NULL UNIQUE
+);
+
+CREATE TABLE IF NOT EXISTS images (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    shard INTEGER NOT NULL,
+    timestamp INTEGER NOT NULL,
+    public INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE INDEX IF NOT EXISTS images_public_timeline
+    ON images (timestamp, id) WHERE public = 1;
+
+CREATE TABLE IF NOT EXISTS versions_epoch (epoch TEXT NOT NULL);
+INSERT INTO versions_epoch SELECT lower(hex(randomblob(8)))
+    WHERE NOT EXISTS (SELECT 1 FROM versions_epoch);
+"""
+
+
+def timeline_page(timeline, limit=None, after=None):
+    """
+    Return the IDs of a page of 'timeline', a sorted list
+    of (timestamp, id), newest first
+
+    'after' is the (timestamp, id) cursor of the last image
+    of the previous page, 'limit' is the size of the page
+    """
+
+    end = len(timeline) if after is None else bisect_left(timeline, after)
+    start = 0 if limit is None else max(0, end - limit)
+
+    return [id for _, id in reversed(timeline[start:end])]
+
+
+def image_keys(id, owner, public, file=False):
+    """
+    Return the version keys (see 'Versions') of the data changed
+    along with the image 'id' of 'owner':
+        - ("image", id), its info
+        - ("user", owner), the account info and the owner's images
+        - ("public",), the public images, if it is (or was) public
+        - ("file", id), the file served, if 'file' is set
+    """
+
+    keys = [("image", id), ("user", owner)]
+
+    if public:
+        keys.append(("public",))
+
+    if file:
+        keys.append(("file", id))
+
+    return keys
+
+
+def read_through(cache, versions, ids, load):
+    """
+    Return the records of the images with 'ids' which exist,
+    in the same order, out of 'cache' (image ID -> (version,
+    record)), 'load(ids)' returns the records of the others
+
+    a record is only served while the versions of the image
+    (see 'image_keys') are the ones read before loading it,
+    so that every write invalidates it, even one racing with
+    the load (the versions are bumped once a write is done)
+    """
+
+    current = {
+        id: versions.current([("image", id), ("file", id)]) for id in ids
+    }
+    records = {}
+    missing = []
+
+    for id in ids:
+        entry = cache.get(id, valid=lambda entry: entry[0] == current[id])
+
+        if entry is None:
+            missing.append(id)
+        else:
+            records[id] = entry[1]
+
+    if missing:
+        for record in load(missing):
+            records[record["id"]] = record
+            cache.put(record["id"], (current[record["id"]], record))
+
+    return [records[id] for id in ids if id in records]
+
+
+def popularity(image):
+    """
+    Return the popularity score of 'image'
+    """
+
+    return len(image["likes"]) + len(image["views"])
+
+
+def contains_id(ids, id):
+    """
+    Check if the sorted list 'ids' contains 'id'
+    """
+
+    index = bisect_left(ids, id)
+    return index < len(ids) and ids[index] == id
+
+
+def add_ids(ids, new_ids):
+    """
+    Return the sorted list 'ids' with 'new_ids' added
+    """
+
+    new_ids = sorted({id for id in new_ids if not contains_id(ids, id)})
+
+    if not new_ids:
+        return ids
+
+    # two sorted runs, which sorted() merges in linear time
+    return sorted(ids + new_ids)
+
+
+def remove_id(ids, id):
+    """
+    Return the sorted list 'ids' without 'id'
+    """
+
+    index = bisect_left(ids, id)
+
+    if index < len(ids) and ids[index] == id:
+        return ids[:index] + ids[index + 1:]
+
+    return ids
+
+
+class Members:
+    """
+    Read-only set of the accounts which liked (or viewed) an image
+
+    it is kept as the sorted list of their account IDs, so that
+    checking a user is a binary search, and the usernames are
+    only looked up when the members are listed
+    """
+
+    __slots__ = ("ids", "account_id", "usernames")
+
+    def __init__(self, ids, account_id, usernames):
+        self.ids = ids
+        # username -> account ID (or None)
+        self.account_id = account_id
+        # account IDs -> usernames
+        self.usernames = usernames
+
+    def __contains__(self, username):
+        id = self.account_id(username)
+        return id is not None and contains_id(self.ids, id)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return iter(self.usernames(self.ids))
+
+
+def timeline_discard(timeline, key):
+    """
+    Remove 'key' from the sorted list 'timeline', if present
+    """
+
+    index = bisect_left(timeline, key)
+
+    if index < len(timeline) and timeline[index] == key:
+        del timeline[index]
+
+
+class MemoryJSONStorage(Storage):
+    """
+    TinyDB storage which parses the JSON file only once
+    and serves every subsequent read from memory
+
+    every write is persisted durably: the data is written
+    into a temporary file, flushed to the disk and then
+    atomically renamed over the database file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._data = None
+
+        # number of writes, see `JSONDatabase._writing`
+        self.writes = 0
+
+        # the writes are deferred within `batch`
+        self.batching = False
+        self.pending = False
+
+    def read(self):
+        if self._data is None:
+            try:
+                with open(self.path, encoding="utf-8") as file:
+                    raw = file.read()
+            except FileNotFoundError:
+                return None
+
+            # an empty file is an empty database
+            self._data = json.loads(raw) if raw else None
+
+        return self._data
+
+    @contextmanager
+    def batch(self):
+        """
+        Context manager turning the enclosed writes into a single
+        one, e.g. to update several documents separately
+        """
+
+        # e.g. a batch within the one of `JSONDatabase._writing`
+        if self.batching:
+            yield
+            return
+
+        self.batching = True
+
+        try:
+            yield
+        finally:
+            self.batching = False
+
+            if self.pending:
+                self.pending = False
+                self.write(self._data)
+
+    def write(self, data):
+        if self.batching:
+            # TinyDB reads back the data it passes
+            self._data = data
+            self.pending = True
+            return
+
+        self.writes += 1
+        temp_path = f"{self.path}.tmp"
+
+        try:
+            with open(temp_path, "w", encoding="utf-8") as file:
+                json.dump(data, file)
+                file.flush()
+                os.fsync(file.fileno())
+
+            os.replace(temp_path, self.path)
+        except OSError:
+            # the in-memory copy may now be ahead of the file,
+            # drop it so that the next read comes from the disk
+            self._data = None
+            raise
+
+        self._data = data
+
+
+def shard_of(username, shards):
+    """
+    Return the number of the shard storing the account of
+    'username' and its images, out of 'shards' shards
+    """
+
+    digest = sha256(username.encode("utf-8")).digest()
+    return int.from_bytes(digest[:4], "big") % shards
+
+
+def shards_directory(uri):
+    """
+    Return the directory of the sharded database 'uri'
+    """
+
+    directory = uri[len(SHARDS_SCHEME):]
+
+    # "shards:///relative" and "shards:////absolute"
+    if directory.startswith("/"):
+        directory = directory[1:]
+
+    return directory
+
+
+def shard_path(directory, number):
+    """
+    Return the TinyDB file of the shard 'number'
+    """
+
+    return os.path.join(directory, f"shard-{number}.db")
+
+
+def catalog_path(directory):
+    """
+    Return the SQLite file of the catalog, see `ShardedDatabase`
+    """
+
+    return os.path.join(directory, "catalog.sqlite3")
+
+
+def write_manifest(directory, shards):
+    """
+    Record the number of shards of the database in 'directory'
+    """
+
+    MemoryJSONStorage(os.path.join(directory, SHARDS_MANIFEST)).write(
+        {"shards": shards}
+    )
+
+
+def open_database(uri, image_cache_size=4096, shared=False):
+    """
+    Open the database backend described by 'uri'
+
+    'shared' if other processes serve the same database at the
+    same time, e.g. the workers of './server.py', so that their
+    changes invalidate the cached data of this one (the JSON
+    and sharded databases always check it, see
+    `JSONDatabase._reading`), and they hand out the same ETags,
+    see 'SQLiteVersions', 'FileVersions' and 'ShardedVersions'
+    """
+
+    if uri.startswith(SQLITE_SCHEME):
+        return SQLiteDatabase(uri, image_cache_size, shared)
+
+    if uri.startswith(SHARDS_SCHEME):
+        return ShardedDatabase(uri, image_cache_size, shared)
+
+    return JSONDatabase(uri, image_cache_size, shared)
+
+
+def file_identity(path):
+    """
+    Return an identifier of the file 'path', which changes
+    whenever it is replaced, see 'MemoryJSONStorage'
+    """
+
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return "missing"
+
+    return f"{stat.st_ino}-{stat.st_mtime_ns}-{stat.st_size}"
+
+
+class FileVersions(Versions):
+    """
+    Versions of a JSON database shared with other processes,
+    so that they hand out the same ETags
+
+    every change is a new file, loaded by all the processes, so
+    the version of every key is the identity of the file(s) loaded,
+    the epoch (see `JSONDatabase._changed`), 'bump' and 'reset'
+    without an epoch do nothing
+
+    every write changes the ETag of every response then
+    """
+
+    def bump(self, *keys):
+        pass
+
+    def reset(self, epoch=None):
+        if epoch is not None:
+            super().reset(epoch)
+
+
+class ShardedVersions(Versions):
+    """
+    Versions of a sharded 'database' shared with other processes,
+    so that they hand out the same ETags
+
+    every shard records the versions of the keys its writes change
+    in its own file, in the same write as the change (see
+    `JSONDatabase._writing`), and the other processes read them
+    back along with the shard, so that a write only changes the
+    ETags (and cached records) of the data it changed
+
+    the version of a key is the sum of its versions in every shard,
+    only ("public",) and 'ALL' are changed by several of them
+
+    'epoch' is the one of the catalog
+    """
+
+    # bumped along with every reset, part of every version
+    ALL = ("*",)
+
+    def __init__(self, database, epoch):
+        super().__init__(sync=database._refresh)
+        self.database = database
+        self.epoch = epoch
+
+    def bump(self, *keys):
+        # recorded by the shards
+        pass
+
+    def reset(self, epoch=None):
+        pass
+
+    def current(self, keys):
+        self.sync()
+
+        return self.epoch, [
+            sum(
+                shard.key_versions.get(key, 0)
+                for shard in self.database.shards
+            )
+            for key in (self.ALL, *keys)
+        ]
+
+
+class ViewBuffer:
+    """
+    Buffer of the image views, so that serving an image
+    never waits for a database write
+
+    the views are deduplicated in memory and handed to 'flush'
+    (image ID -> set of usernames) in a single batch, every
+    'interval' seconds or once 'max_pending' views are waiting
+
+    views are only counted once flushed, call 'flush' before
+    exiting so that none are lost
+    """
+
+    def __init__(self, flush, max_pending=256, interval=5.0):
+        self.write = flush
+        self.max_pending = max_pending
+        self.interval = interval
+
+        self.lock = Lock()
+        self.flush_lock = Lock()
+        self.wakeup = Event()
+        self.thread = None
+
+        self.pending = {}
+        self.size = 0
+
+    def _run(self):
+        while True:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            self.flush()
+
+    def add(self, id, username):
+        """
+        Record a view of 'username' on the image with 'id'
+        """
+
+        with self.lock:
+            usernames = self.pending.setdefault(id, set())
+
+            if username in usernames:
+                return
+
+            usernames.add(username)
+            self.size += 1
+
+            # started on first use, not in every importing process
+            if self.thread is None:
+                self.thread = Thread(
+                    target=self._run, name="view-buffer", daemon=True
+                )
+                self.thread.start()
+
+            if self.size >= self.max_pending:
+                self.wakeup.set()
+
+    def flush(self):
+        """
+        Write the pending views, they are kept for
+        the next flush if the write fails
+        """
+
+        # one batch at a time, so that they are written in order
+        with self.flush_lock:
+            with self.lock:
+                pending, self.pending, self.size = self.pending, {}, 0
+
+            if not pending:
+                return
+
+            try:
+                self.write(pending)
+            except (OSError, sqlite3.Error):
+                logger.exception(f"could not write {len(pending)} views")
+
+                with self.lock:
+                    for id, usernames in pending.items():
+                        self.pending.setdefault(id, set()).update(usernames)
+
+                    self.size = sum(map(len, self.pending.values()))
+
+
+class JSONDatabase:
+    """
+    Long-lived handle to the local TinyDB (JSON) database
+
+    documents are never modified in place: every write
+    replaces the changed lists with new ones, so records
+    handed out to the routes stay consistent
+
+    the likes and views of an image are stored as sorted lists
+    of account document IDs, handed out as 'Members'
+
+    lookups by username, owner and visibility are served by
+    in-memory indexes, instead of scanning the whole table:
+        - 'account_ids', username -> account document ID
+        - 'usernames', account document ID -> username
+        - 'owner_index', owner -> timeline of the owned images
+        - 'public_index', timeline of the public images
+        - 'file_index', filename -> number of images stored in it
+
+    a timeline is a list of (timestamp, document ID) kept sorted,
+    so that the images can be paginated from a cursor
+
+    'popularity_index' is the list of (score, timestamp, document ID)
+    of the public images kept sorted, its tail is the top-K
+
+    every account keeps 'total_likes' and 'total_views' counters
+    of its images, updated together with the likes and views
+
+    'versions' are bumped after every change, see 'image_keys' and
+    `_writing`, and reset once the file is reloaded
+
+    the image records are cached in 'image_cache' until they
+    change, see 'read_through', they are shared by the callers
+    and must not be modified
+
+    reads share 'lock' (see 'RWLock'), only the writes are
+    serialized, TinyDB tables are never modified in place
+    while they are read
+
+    the processes opening the same file (e.g. the workers of
+    './server.py') also serialize their writes with 'file_lock',
+    and reload the file once another one changed it, see
+    `_reading` and `_writing`
+
+    'shared' if other processes serve the file at the same time,
+    see 'FileVersions'
+
+    a shard of a 'ShardedDatabase' ('sharded') shares its versions
+    and image cache, and looks up the accounts of the other shards
+    (e.g. the users liking its images) in the catalog, the versions
+    of the keys it changed are stored in its file ('key_versions')
+    when they are shared, see 'ShardedVersions'
+    """
+
+    def __init__(
+        self, uri, image_cache_size=4096, shared=False, sharded=None
+    ):
+        self.uri = uri
+        self.sharded = sharded
+        self.lock = RWLock()
+        self.file_lock = FileLock(f"{uri}.lock")
+
+        if sharded is not None:
+            self.versions = sharded.versions
+            self.image_cache = sharded.image_cache
+        else:
+            versions_class = FileVersions if shared else Versions
+            self.versions = versions_class(sync=self._refresh)
+            self.image_cache = LRUCache(max_size=image_cache_size)
+
+        # generation of the file (see 'FileLock') loaded in memory,
+        # and identifier of its content, see `_changed`
+        self.generation = None
+        self.file_id = None
+
+        # key -> version, and the last version, see 'ShardedVersions'
+        self.key_versions = {}
+        self.last_version = 0
+
+        with self._writing() as changed:
+            if self._upgrade():
+                changed.append(SQLiteVersions.ALL)
+
+    def _load(self):
+        """
+        (Re)load the database file and build the indexes
+        """
+
+        # for local database (but this table is not used)
+        TinyDB.default_table_name = "photostore"
+        self.db = TinyDB(self.uri, storage=MemoryJSONStorage)
+        self.generation = self.file_lock.generation()
+
+        self.accounts = self.db.table("accounts")
+        self.images = self.db.table("images")
+        self.versions_table = self.db.table("versions")
+
+        stored = self.versions_table.get(doc_id=1) or {}
+        self.last_version = stored.get("version", 0)
+        self.key_versions = {
+            tuple(json.loads(key)): version
+            for key, version in stored.get("keys", {}).items()
+        }
+
+        self._build_indexes()
+        self._changed(reloaded=True)
+
+    def _changed(self, reloaded):
+        """
+        Reset the versions once the file was reloaded, or written
+        by this process (only needed by 'FileVersions', the writes
+        bump the versions of the keys they change otherwise)
+        """
+
+        # the generation alone would start over with a new lock file
+        self.file_id = f"{self.generation}-{file_identity(self.uri)}"
+
+        if self.sharded is not None:
+            self.sharded._changed(reloaded)
+        elif isinstance(self.versions, FileVersions):
+            self.versions.reset(self.file_id)
+        elif reloaded:
+            # the records cached so far may be stale
+            self.versions.reset()
+
+    def _build_indexes(self):
+        self.account_ids = {}
+        self.usernames = {}
+        self.owner_index = {}
+        self.public_index = []
+        self.popularity_index = []
+        self.file_index = {}
+
+        for account in self.accounts:
+            self.account_ids[account["username"]] = account.doc_id
+            self.usernames[account.doc_id] = account["username"]
+
+        for image in self.images:
+            self._index_image(image.doc_id, image)
+
+    def _upgrade(self):
+        """
+        Convert the databases created by former versions
+        return True if it was converted
+        """
+
+        # databases created before the likes and views were
+        # stored as account IDs
+        stale_members = any(
+            isinstance(member, str)
+            for image in self.images
+            for member in (*image["likes"], *image["views"])
+        )
+
+        if stale_members:
+            self._convert_members()
+            self._build_indexes()
+
+        # databases created before the counters existed
+        if stale_members or any(
+            "total_likes" not in account or "total_views" not in account
+            for account in self.accounts
+        ):
+            self._recompute_totals()
+            return True
+
+        return False
+
+    def _refresh(self):
+        """
+        Reload the database file if another process changed it
+        """
+
+        if self.file_lock.generation() != self.generation:
+            with self.lock.write(), self.file_lock.hold():
+                if self.file_lock.generation() != self.generation:
+                    self._load()
+
+    @contextmanager
+    def _reading(self):
+        """
+        Context manager for the enclosed reads, shared
+        with the other readers of this process
+        """
+
+        self._refresh()
+
+        with self.lock.read():
+            yield
+
+    @contextmanager
+    def _writing(self):
+        """
+        Context manager for the enclosed writes, held alone by
+        this thread of all the processes, the changes of the
+        other processes are loaded first
+
+        the writes make a single write of the file, and the versions
+        of the keys they add to 'changed' are bumped once it is done,
+        they are written along with it when stored in the file, see
+        'ShardedVersions'
+        """
+
+        with self.lock.write(), self.file_lock.hold():
+            if self.file_lock.generation() != self.generation:
+                self._load()
+
+            writes = self.db.storage.writes
+            changed = []
+            version = None
+
+            try:
+                with self.db.storage.batch():
+                    yield changed
+
+                    # in a single bump, see 'SQLiteVersions'
+                    keys = list(dict.fromkeys(changed))
+
+                    if keys and isinstance(self.versions, ShardedVersions):
+                        version = self._record_versions(keys)
+            finally:
+                if self.db.storage.writes != writes:
+                    self.generation = self.file_lock.bump()
+                    self._changed(reloaded=False)
+
+            if version is not None:
+                self.last_version = version
+                self.key_versions.update(dict.fromkeys(keys, version))
+            elif SQLiteVersions.ALL in keys:
+                self.versions.reset()
+            else:
+                self.versions.bump(*keys)
+
+    def _record_versions(self, keys):
+        """
+        Record the new version of 'keys' in the file, along with
+        the change being written, and return it
+        """
+
+        version = self.last_version + 1
+
+        def update(stored):
+            stored["version"] = version
+            stored["keys"].update(
+                (json.dumps(key), version) for key in keys
+            )
+
+        if not self.versions_table.contains(doc_id=1):
+            self.versions_table.insert(
+                Document({"version": 0, "keys": {}}, doc_id=1)
+            )
+
+        # in place, the table is never handed out
+        self.versions_table.update(update, doc_ids=[1])
+        return version
+
+    def _convert_members(self):
+        """
+        Replace the usernames in the likes and views of every
+        image with the sorted account IDs, the usernames without
+        an account are dropped
+        """
+
+        def to_ids(members):
+            ids = {
+                self.account_ids.get(member)
+                if isinstance(member, str) else member
+                for member in members
+            }
+            ids.discard(None)
+            return sorted(ids)
+
+        def update(image):
+            image["likes"] = to_ids(image["likes"])
+            image["views"] = to_ids(image["views"])
+
+        self.images.update(
+            update, doc_ids=[image.doc_id for image in self.images]
+        )
+
+    def _index_image(self, id, image):
+        key = (image["timestamp"], id)
+        insort(self.owner_index.setdefault(image["owner"], []), key)
+
+        filename = image["filename"]
+        self.file_index[filename] = (
+            self.file_index.get(filename, 0) + 1
+        )
+
+        if image.get("public"):
+            insort(self.public_index, key)
+            insort(self.popularity_index, (popularity(image), *key))
+
+    def _unindex_image(self, id, image):
+        key = (image["timestamp"], id)
+        owned = self.owner_index.get(image["owner"], [])
+        timeline_discard(owned, key)
+
+        if not owned:
+            self.owner_index.pop(image["owner"], None)
+
+        filename = image["filename"]
+        self.file_index[filename] -= 1
+
+        if not self.file_index[filename]:
+            del self.file_index[filename]
+
+        timeline_discard(self.public_index, key)
+        timeline_discard(self.popularity_index, (popularity(image), *key))
+
+    def _reindex_popularity(self, id, old_image, new_image):
+        """
+        Move the image with 'id' in the popularity index after
+        its likes or views changed from 'old_image' to 'new_image'
+        """
+
+        if not old_image.get("public"):
+            return
+
+        key = (old_image["timestamp"], id)
+        timeline_discard(self.popularity_index, (popularity(old_image), *key))
+        insort(self.popularity_index, (popularity(new_image), *key))
+
+    def _images(self, ids):
+        """
+        Return the image records for the document 'ids'
+        """
+
+        return [self._image_record(self.images.get(doc_id=id)) for id in ids]
+
+    def _account_id(self, username):
+        account_id = self.account_ids.get(username)
+
+        if account_id is None and self.sharded is not None:
+            return self.sharded.account_id(username)
+
+        return account_id
+
+    def _usernames_of(self, ids):
+        if self.sharded is not None:
+            return self.sharded.usernames_of(ids)
+
+        return [self.usernames[id] for id in ids if id in self.usernames]
+
+    def _members(self, ids):
+        return Members(ids, self._account_id, self._usernames_of)
+
+    def _update_counters(self, username, **deltas):
+        """
+        Add 'deltas' to the counters of the account of 'username'
+        """
+
+        account_id = self.account_ids.get(username)
+
+        if account_id is None:
+            return
+
+        def update(account):
+            for field, delta in deltas.items():
+                account[field] = account.get(field, 0) + delta
+
+        self.accounts.update(update, doc_ids=[account_id])
+
+    def close(self):
+        with self.lock.write():
+            self.db.close()
+            self.file_lock.close()
+
+    def lock_stats(self):
+        """
+        Return the wait and hold times of the database lock,
+        and of the lock shared with the other processes
+        """
+
+        return dict(self.lock.stats(), file=self.file_lock.stats())
+
+    @staticmethod
+    def _record(document):
+        """
+        Convert a TinyDB 'document' into a plain record
+        with its document ID stored under 'id'
+        """
+
+        if document is None:
+            return None
+
+        return dict(document, id=document.doc_id)
+
+    def _image_record(self, document):
+        """
+        Convert a TinyDB image 'document' into a plain record,
+        with 'Members' for the likes and views
+        """
+
+        if document is None:
+            return None
+
+        return dict(
+            document,
+            id=document.doc_id,
+            likes=self._members(document["likes"]),
+            views=self._members(document["views"]),
+        )
+
+    # accounts
+
+    def get_account(self, username):
+        with self._reading():
+            account_id = self.account_ids.get(username)
+
+            if account_id is None:
+                return None
+
+            return self._record(self.accounts.get(doc_id=account_id))
+
+    def add_account(self, account, id=None):
+        """
+        Insert 'account', under the document ID 'id' if given
+        (e.g. allocated by the catalog of a 'ShardedDatabase')
+        return its ID, None if the username is already taken
+        """
+
+        with self._writing() as changed:
+            if account["username"] in self.account_ids:
+                return None
+
+            account_id = self.accounts.insert(
+                account if id is None else Document(account, doc_id=id)
+            )
+            self.account_ids[account["username"]] = account_id
+            self.usernames[account_id] = account["username"]
+            changed.extend([
+                ("user", account["username"]),
+                ("avatar", account["username"]),
+            ])
+
+        return account_id
+
+    def update_account(self, username, fields):
+        with self._writing() as changed:
+            account_id = self.account_ids.get(username)
+
+            if account_id is not None:
+                self.accounts.update(fields, doc_ids=[account_id])
+
+            changed.append(("user", username))
+
+            if "avatar" in fields:
+                changed.append(("avatar", username))
+
+    def account_totals(self, username):
+        """
+        Return the total likes and views on the images
+        owned by 'username'
+        """
+
+        account = self.get_account(username) or {}
+        return account.get("total_likes", 0), account.get("total_views", 0)
+
+    def recompute_totals(self):
+        """
+        Recompute the 'total_likes' and 'total_views' counters
+        of every account from its images
+        """
+
+        with self._writing() as changed:
+            self._recompute_totals()
+            # every version
+            changed.append(SQLiteVersions.ALL)
+
+    def _recompute_totals(self):
+        totals = {}
+
+        for owner, timeline in self.owner_index.items():
+            total_likes = total_views = 0
+
+            for _, id in timeline:
+                image = self.images.get(doc_id=id)
+                total_likes += len(image["likes"])
+                total_views += len(image["views"])
+
+            totals[owner] = (total_likes, total_views)
+
+        def update(account):
+            total_likes, total_views = totals.get(
+                account["username"], (0, 0)
+            )
+            account["total_likes"] = total_likes
+            account["total_views"] = total_views
+
+        self.accounts.update(update, doc_ids=list(self.account_ids.values()))
+
+    # images
+
+    def _load_images(self, ids):
+        with self._reading():
+            return self._images(
+                id for id in ids if self.images.contains(doc_id=id)
+            )
+
+    def get_image(self, id):
+        images = self.get_images([id])
+        return images[0] if images else None
+
+    def get_images(self, ids):
+        """
+        Return the records of the images with 'ids'
+        which exist, in the same order
+        """
+
+        return read_through(
+            self.image_cache, self.versions, list(ids), self._load_images
+        )
+
+    def list_images(self, owner=None, limit=None, after=None):
+        """
+        Return the images of 'owner' (or the public images
+        if no 'owner' is given) newest first, paginated by
+        'limit' and the (timestamp, id) cursor 'after'
+        """
+
+        with self._reading():
+            if owner is None:
+                timeline = self.public_index
+            else:
+                timeline = self.owner_index.get(owner, [])
+
+            return self._images(timeline_page(timeline, limit, after))
+
+    def popular_images(self, limit):
+        """
+        Return the 'limit' public images with the most
+        likes and views, most popular first
+        """
+
+        # [-0:] would be the whole index
+        if limit <= 0:
+            return []
+
+        with self._reading():
+            top = self.popularity_index[-limit:]
+            return self._images(id for *_, id in reversed(top))
+
+    def add_image(self, image, id=None):
+        """
+        Insert 'image' and count it in its owner's uploads
+        under the document ID 'id' if given
+        """
+
+        with self._writing() as changed:
+            id = self.images.insert(
+                image if id is None else Document(image, doc_id=id)
+            )
+            self._index_image(id, image)
+            self._update_counters(image["owner"], uploads=+1)
+            changed.extend(
+                image_keys(id, image["owner"], image.get("public"), file=True)
+            )
+
+        return id
+
+    def remove_image(self, id):
+        """
+        Remove the image with 'id' and discount it from
+        its owner's uploads
+        """
+
+        with self._writing() as changed:
+            image = self.images.get(doc_id=id)
+
+            if not image:
+                return False
+
+            self.images.remove(doc_ids=[id])
+            self._unindex_image(id, image)
+            self._update_counters(
+                image["owner"],
+                uploads=-1,
+                total_likes=-len(image["likes"]),
+                total_views=-len(image["views"]),
+            )
+            changed.extend(
+                image_keys(id, image["owner"], image.get("public"), file=True)
+            )
+
+        return True
+
+    def set_image_public(self, id, public):
+        with self._writing() as changed:
+            image = self.images.get(doc_id=id)
+
+            if not image:
+                return
+
+            self.images.update({"public": public}, doc_ids=[id])
+
+            key = (image["timestamp"], id)
+            timeline_discard(self.public_index, key)
+            timeline_discard(self.popularity_index, (popularity(image), *key))
+
+            if public:
+                insort(self.public_index, key)
+                insort(self.popularity_index, (popularity(image), *key))
+
+            changed.extend(image_keys(id, image["owner"], True, file=True))
+
+    def set_image_like(self, id, username, like):
+        """
+        Add (or remove) the like of 'username' on the
+        image with 'id' and return the new likes (Members)
+        """
+
+        with self._writing() as changed:
+            image = self.images.get(doc_id=id)
+
+            if not image:
+                return None
+
+            account_id = self._account_id(username)
+            likes = image["likes"]
+
+            if account_id is None:
+                return self._members(likes)
+
+            if like:
+                likes = add_ids(likes, [account_id])
+            else:
+                likes = remove_id(likes, account_id)
+
+            if likes is image["likes"]:
+                return self._members(likes)
+
+            self.images.update({"likes": likes}, doc_ids=[id])
+            self._reindex_popularity(id, image, dict(image, likes=likes))
+            self._update_counters(
+                image["owner"],
+                total_likes=len(likes) - len(image["likes"]),
+            )
+            changed.extend(
+                image_keys(id, image["owner"], image.get("public"))
+            )
+
+        return self._members(likes)
+
+    def add_image_view(self, id, username):
+        """
+        Count a view of 'username' on the image with 'id'
+        return True if it is the first view of that user
+        """
+
+        return self.add_image_views({id: [username]}) > 0
+
+    def add_image_views(self, views):
+        """
+        Count the views in 'views', image ID -> usernames,
+        with a single write of the file
+        return the number of first views
+        """
+
+        with self._writing() as changed:
+            updated = {}
+            total_views = {}
+            added = 0
+
+            for id, usernames in views.items():
+                image = self.images.get(doc_id=id)
+
+                # the image may have been deleted since it was viewed
+                if not image:
+                    continue
+
+                viewers = add_ids(image["views"], [
+                    account_id
+                    for account_id in map(self._account_id, usernames)
+                    if account_id is not None
+                ])
+
+                if viewers is image["views"]:
+                    continue
+
+                new_views = len(viewers) - len(image["views"])
+                added += new_views
+                updated[id] = (image, dict(image, views=viewers))
+                total_views[image["owner"]] = (
+                    total_views.get(image["owner"], 0) + new_views
+                )
+
+            if not updated:
+                return 0
+
+            def update_totals(account):
+                account["total_views"] = (
+                    account.get("total_views", 0)
+                    + total_views.get(account["username"], 0)
+                )
+
+            # a single write, see `_writing`
+            for id, (_, new_image) in updated.items():
+                self.images.update(
+                    {"views": new_image["views"]}, doc_ids=[id]
+                )
+
+            self.accounts.update(update_totals, doc_ids=[
+                self.account_ids[owner]
+                for owner in total_views if owner in self.account_ids
+            ])
+
+            for id, (image, new_image) in updated.items():
+                self._reindex_popularity(id, image, new_image)
+                changed.extend(
+                    image_keys(id, image["owner"], image.get("public"))
+                )
+
+        return added
+
+    def all_images(self):
+        """
+        Return every image, e.g. for the maintenance commands
+        """
+
+        with self._reading():
+            return [self._image_record(image) for image in self.images]
+
+    def images_missing_derivatives(self):
+        """
+        Return the images whose resized copies were never generated
+        """
+
+        with self._reading():
+            return [
+                self._image_record(image) for image in self.images
+                if image.get("derivatives") is None
+            ]
+
+    def file_references(self, filename):
+        """
+        Return the number of images stored in the file 'filename'
+        """
+
+        with self._reading():
+            return self.file_index.get(filename, 0)
+
+    def set_image_file(self, id, filename, derivatives):
+        """
+        Move the image with 'id' into the file 'filename',
+        whose resized copies are 'derivatives'
+        return False if the image does not exist (anymore)
+        """
+
+        with self._writing() as changed:
+            image = self.images.get(doc_id=id)
+
+            if not image:
+                return False
+
+            self._unindex_image(id, image)
+            self.images.update(
+                {"filename": filename, "derivatives": derivatives},
+                doc_ids=[id],
+            )
+            self._index_image(id, self.images.get(doc_id=id))
+            changed.append(("file", id))
+
+        return True
+
+    def set_image_derivatives(self, id, derivatives):
+        """
+        Record the filenames of the resized copies of the image
+        return False if the image does not exist (anymore)
+        """
+
+        with self._writing() as changed:
+            if not self.images.contains(doc_id=id):
+                return False
+
+            self.images.update({"derivatives": derivatives}, doc_ids=[id])
+            changed.append(("file", id))
+
+        return True
+
+    def add_image_comment(self, id, comment):
+        """
+        Append 'comment' on the image with 'id'
+        and return the new list of comments
+        """
+
+        with self._writing() as changed:
+            image = self.images.get(doc_id=id)
+
+            if not image:
+                return None
+
+            comments = image["comments"] + [comment]
+            self.images.update({"comments": comments}, doc_ids=[id])
+            changed.extend(
+                image_keys(id, image["owner"], image.get("public"))
+            )
+
+        return comments
+
+
+class SQLiteVersions(Versions):
+    """
+    Versions shared by the processes serving the same SQLite
+    'database', so that a change made by one of them invalidates
+    the cached data (and ETags) of the others
+
+    every bump is recorded in the 'versions' table under the next
+    sequence number, which becomes the version of its keys, and
+    the bumps of the other processes are read back before the
+    versions are used, so that every process hands out the same
+    ETags, they are only looked up once 'PRAGMA data_version' tells
+    that another connection committed meanwhile
+
+    'epoch' is the one of the database file
+    """
+
+    # bumped along with every reset, part of every version
+    ALL = ("*",)
+
+    def __init__(self, database):
+        super().__init__(sync=self._sync)
+        self.database = database
+        # last sequence number read back
+        self.seen = 0
+        # (connection, data version) of the last read of each thread
+        self.local = local()
+
+        self.epoch = database.connect().execute(
+            "SELECT epoch FROM versions_epoch"
+        ).fetchone()[0]
+
+    def _sync(self):
+        """
+        Read back the bumps committed since the last time
+        """
+
+        connection = self.database.connect()
+        data_version = connection.execute(
+            "PRAGMA data_version"
+        ).fetchone()[0]
+
+        if getattr(self.local, "last", None) == (connection, data_version):
+            return
+
+        rows = connection.execute(
+            "SELECT key, seq FROM versions WHERE seq > ?", (self.seen,)
+        ).fetchall()
+
+        with self.lock:
+            for key, seq in rows:
+                key = tuple(json.loads(key))
+                self.counters[key] = max(self.counters.get(key, 0), seq)
+                self.seen = max(self.seen, seq)
+
+        self.local.last = (connection, data_version)
+
+    def record(self, connection, keys):
+        """
+        Record the bump of 'keys' in the write transaction of
+        'connection' and return its sequence number, the bump
+        is only applied (see `apply`) once it is committed
+        """
+
+        seq = connection.execute(
+            "SELECT COALESCE(MAX(seq), 0) + 1 FROM versions"
+        ).fetchone()[0]
+        connection.executemany(
+            "INSERT OR REPLACE INTO versions (key, seq) VALUES (?, ?)",
+            [(json.dumps(key), seq) for key in keys],
+        )
+
+        return seq
+
+    def apply(self, keys, seq):
+        with self.lock:
+            for key in keys:
+                self.counters[key] = max(self.counters.get(key, 0), seq)
+
+    def bump(self, *keys):
+        if not keys:
+            return
+
+        with self.database.transaction() as connection:
+            seq = self.record(connection, keys)
+
+        self.apply(keys, seq)
+
+    def reset(self):
+        self.bump(self.ALL)
+
+    def current(self, keys):
+        return super().current([self.ALL, *keys])
+
+
+class SQLiteFile:
+    """
+    Connections to a local SQLite database file in WAL mode
+
+    each thread gets its own connection, SQLite itself
+    serializes the writers, the time they wait for each other
+    is measured in 'write_stats'
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        self.connections = []
+        self.local = local()
+        self.write_stats = LockStats()
+
+    def connect(self):
+        """
+        Return the connection of the current thread
+        """
+
+        connection = getattr(self.local, "connection", None)
+
+        if connection is None:
+            connection = sqlite3.connect(
+                self.path,
+                timeout=30,
+                isolation_level=None,
+                check_same_thread=False,
+            )
+            connection.row_factory = sqlite3.Row
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=FULL")
+            connection.execute("PRAGMA foreign_keys=ON")
+
+            self.local.connection = connection
+
+            with self.lock:
+                self.connections.append(connection)
+
+        return connection
+
+    @contextmanager
+    def transaction(self):
+        """
+        Run the enclosed statements in a single write transaction
+        """
+
+        connection = self.connect()
+
+        start = time.perf_counter()
+        connection.execute("BEGIN IMMEDIATE")
+        begun = time.perf_counter()
+
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        else:
+            connection.execute("COMMIT")
+        finally:
+            self.write_stats.record(begun - start, time.perf_counter() - begun)
+
+    def close(self):
+        with self.lock:
+            for connection in self.connections:
+                connection.close()
+
+            self.connections.clear()
+
+        self.local = local()
+
+    def lock_stats(self):
+        """
+        Return the wait and hold times of the write transactions
+        the reads never wait (WAL mode)
+        """
+
+        return {"write": self.write_stats.stats()}
+
+
+class SQLiteDatabase(SQLiteFile):
+    """
+    Long-lived handle to a local SQLite database in WAL mode
+
+    every write only touches the affected rows, so its cost
+    does not grow with the size of the database, and WAL lets
+    readers proceed while a write is being committed, see
+    'SQLiteFile'
+
+    'versions' are bumped after every change, see 'image_keys',
+    they are shared with the other processes if 'shared' is set,
+    see 'SQLiteVersions'
+
+    the image records are cached in 'image_cache' until they
+    change, see 'read_through', they are shared by the callers
+    and must not be modified
+    """
+
+    def __init__(self, uri, image_cache_size=4096, shared=False):
+        path = uri[len(SQLITE_SCHEME):]
+
+        # "sqlite:///relative.db" and "sqlite:////absolute.db"
+        if path.startswith("/"):
+            path = path[1:]
+
+        super().__init__(path)
+        self.uri = uri
+        self.image_cache = LRUCache(max_size=image_cache_size)
+
+        # `executescript` manages its own transaction
+        connection = self.connect()
+        connection.executescript(SQLITE_SCHEMA)
+
+        version = connection.execute("PRAGMA user_version").fetchone()[0]
+
+        if version < len(SQLITE_MIGRATIONS):
+            # the other processes opening it meanwhile (e.g. the workers
+            # of './server.py') wait for this one to migrate it
+            migration_lock = FileLock(f"{self.path}.lock")
+
+            with migration_lock.hold():
+                version = connection.execute(
+                    "PRAGMA user_version"
+                ).fetchone()[0]
+
+                for number, migration in enumerate(SQLITE_MIGRATIONS, 1):
+                    if number > version:
+                        connection.executescript(
+                            f"BEGIN; {migration} "
+                            f"PRAGMA user_version = {number}; COMMIT;"
+                        )
+
+            migration_lock.close()
+
+        self.versions = SQLiteVersions(self) if shared else Versions()
+
+    def _image_owner(self, connection, id):
+        """
+        Return the (owner, public) of the image with 'id',
+        None if it does not exist
+        """
+
+        row = connection.execute(
+            """
+            SELECT accounts.username, images.public FROM images
+            JOIN accounts ON accounts.id = images.owner_id
+            WHERE images.id = ?
+            """,
+            (id,),
+        ).fetchone()
+
+        return None if row is None else (row[0], bool(row[1]))
+
+    def _account_id(self, username):
+        row = self.connect().execute(
+            "SELECT id FROM accounts WHERE username = ?",
+            (username,),
+        ).fetchone()
+
+        return None if row is None else row[0]
+
+    def _usernames_of(self, ids):
+        rows = self.connect().execute(
+            """
+            SELECT id, username FROM accounts
+            WHERE id IN (SELECT value FROM json_each(?))
+            """,
+            (json.dumps(ids),),
+        )
+        usernames = dict(rows.fetchall())
+        return [usernames[id] for id in ids if id in usernames]
+
+    def _members(self, table, id):
+        # served by the UNIQUE (image_id, account_id) index
+        rows = self.connect().execute(
+            f"""
+            SELECT account_id FROM {table}
+            WHERE image_id = ? ORDER BY account_id
+            """,
+            (id,),
+        )
+        return Members(
+            [row[0] for row in rows],
+            self._account_id,
+            self._usernames_of,
+        )
+
+    def _comments(self, id):
+        rows = self.connect().execute(
+            """
+            SELECT accounts.username, comments.comment, comments.timestamp
+            FROM comments
+            JOIN accounts ON accounts.id = comments.account_id
+            WHERE comments.image_id = ? ORDER BY comments.id
+            """,
+            (id,),
+        )
+        return [
+            {
+                "username": row[0],
+                "comment": row[1],
+                "timestamp": row[2],
+            }
+            for row in rows
+        ]
+
+    def _image_record(self, row):
+        """
+        Build the image record (same shape as the TinyDB
+        document) from an 'images' table 'row'
+        """
+
+        if row is None:
+            return None
+
+        return {
+            "id": row["id"],
+            "filename": row["filename"],
+            "owner": row["owner"],
+            "timestamp": row["timestamp"],
+            "public": bool(row["public"]),
+            "description": row["description"],
+            "derivatives": (
+                None if row["derivatives"] is None
+                else json.loads(row["derivatives"])
+            ),
+            "likes": self._members("likes", row["id"]),
+            "views": self._members("views", row["id"]),
+            "comments": self._comments(row["id"]),
+        }
+
+    def _select_images(self, where, parameters=(), order=""):
+        rows = self.connect().execute(
+            f"""
+            SELECT images.*, accounts.username AS owner FROM images
+            JOIN accounts ON accounts.id = images.owner_id
+            WHERE {where} {order}
+            """,
+            parameters,
+        )
+        return [self._image_record(row) for row in rows.fetchall()]
+
+    @contextmanager
+    def _changing(self):
+        """
+        Run the enclosed statements in a single write transaction,
+        and bump the versions of the keys they add to 'changed'
+
+        shared versions are bumped in the same transaction, so that
+        a change is never committed without its bump, they are only
+        applied here once it is committed (so that a record is never
+        cached under the version of a change not committed yet)
+        """
+
+        changed = []
+        seq = None
+
+        with self.transaction() as connection:
+            yield connection, changed
+
+            # in a single bump, see 'SQLiteVersions'
+            keys = list(dict.fromkeys(changed))
+
+            if keys and isinstance(self.versions, SQLiteVersions):
+                seq = self.versions.record(connection, keys)
+
+        if seq is not None:
+            self.versions.apply(keys, seq)
+        elif SQLiteVersions.ALL in keys:
+            self.versions.reset()
+        else:
+            self.versions.bump(*keys)
+
+    # accounts
+
+    def get_account(self, username):
+        row = self.connect().execute(
+            "SELECT * FROM accounts WHERE username = ?",
+            (username,),
+        ).fetchone()
+
+        return None if row is None else dict(row)
+
+    def add_account(self, account):
+        """
+        Insert 'account' and return its ID, None if
+        the username is already taken
+        """
+
+        with self._changing() as (connection, changed):
+            cursor = connection.execute(
+                """
+                INSERT INTO accounts
+                (username, passwd_hash, avatar, timestamp, uploads)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (username) DO NOTHING
+                """,
+                (
+                    account["username"],
+                    account["passwd_hash"],
+                    account.get("avatar"),
+                    account["timestamp"],
+                    account.get("uploads", 0),
+                ),
+            )
+
+            if not cursor.rowcount:
+                return None
+
+            changed.extend([
+                ("user", account["username"]),
+                ("avatar", account["username"]),
+            ])
+
+        return cursor.lastrowid
+
+    def update_account(self, username, fields):
+        # column names come from the routes, never from the client
+        columns = ", ".join(f"{column} = ?" for column in fields)
+
+        with self._changing() as (connection, changed):
+            connection.execute(
+                f"UPDATE accounts SET {columns} WHERE username = ?",
+                (*fields.values(), username),
+            )
+            changed.append(("user", username))
+
+            if "avatar" in fields:
+                changed.append(("avatar", username))
+
+    def account_totals(self, username):
+        """
+        Return the total likes and views on the images
+        owned by 'username'
+        """
+
+        row = self.connect().execute(
+            "SELECT total_likes, total_views FROM accounts WHERE username = ?",
+            (username,),
+        ).fetchone()
+
+        return (0, 0) if row is None else tuple(row)
+
+    def recompute_totals(self):
+        """
+        Recompute the 'total_likes' and 'total_views' counters
+        of every account, and the score of every image
+        """
+
+        with self._changing() as (connection, changed):
+            connection.execute(
+                """
+                UPDATE accounts SET
+                    total_likes = (
+                        SELECT COUNT(*) FROM likes
+                        JOIN images ON images.id = likes.image_id
+                        WHERE images.owner_id = accounts.id
+                    ),
+                    total_views = (
+                        SELECT COUNT(*) FROM views
+                        JOIN images ON images.id = views.image_id
+                        WHERE images.owner_id = accounts.id
+                    )
+                """
+            )
+            connection.execute(
+                """
+                UPDATE images SET score =
+                    (SELECT COUNT(*) FROM likes WHERE image_id = images.id) +
+                    (SELECT COUNT(*) FROM views WHERE image_id = images.id)
+                """
+            )
+
+            # every version
+            changed.append(SQLiteVersions.ALL)
+
+    # images
+
+    def _load_images(self, ids):
+        return self._select_images(
+            f"images.id IN ({', '.join('?' * len(ids))})",
+            ids,
+        )
+
+    def get_image(self, id):
+        images = self.get_images([id])
+        return images[0] if images else None
+
+    def get_images(self, ids):
+        """
+        Return the records of the images with 'ids'
+        which exist, in the same order
+        """
+
+        return read_through(
+            self.image_cache, self.versions, list(ids), self._load_images
+        )
+
+    def list_images(self, owner=None, limit=None, after=None):
+        """
+        Return the images of 'owner' (or the public images
+        if no 'owner' is given) newest first, paginated by
+        'limit' and the (timestamp, id) cursor 'after'
+        """
+
+        if owner is None:
+            conditions, parameters = ["images.public = 1"], []
+        else:
+            conditions, parameters = ["accounts.username = ?"], [owner]
+
+        if after is not None:
+            conditions.append("(images.timestamp, images.id) < (?, ?)")
+            parameters += after
+
+        return self._select_images(
+            " AND ".join(conditions),
+            (*parameters, -1 if limit is None else limit),
+            "ORDER BY images.timestamp DESC, images.id DESC LIMIT ?",
+        )
+
+    def popular_images(self, limit):
+        """
+        Return the 'limit' public images with the most
+        likes and views, most popular first
+        """
+
+        # a negative LIMIT is no limit
+        if limit <= 0:
+            return []
+
+        return self._select_images(
+            "images.public = 1",
+            (limit,),
+            """
+            ORDER BY images.score DESC, images.timestamp DESC, images.id DESC
+            LIMIT ?
+            """,
+        )
+
+    def add_image(self, image):
+        """
+        Insert 'image' and count it in its owner's uploads
+        """
+
+        with self._changing() as (connection, changed):
+            cursor = connection.execute(
+                """
+                INSERT INTO images
+                (filename, owner_id, timestamp, public, description,
+                 derivatives)
+                SELECT ?, id, ?, ?, ?, ? FROM accounts WHERE username = ?
+                """,
+                (
+                    image["filename"],
+                    image["timestamp"],
+                    image["public"],
+                    image["description"],
+                    None if image.get("derivatives") is None
+                    else json.dumps(image["derivatives"]),
+                    image["owner"],
+                ),
+            )
+            connection.execute(
+                "UPDATE accounts SET uploads = uploads + 1 WHERE username = ?",
+                (image["owner"],),
+            )
+            changed.extend(image_keys(
+                cursor.lastrowid, image["owner"], image["public"], file=True
+            ))
+
+        return cursor.lastrowid
+
+    def remove_image(self, id):
+        """
+        Remove the image with 'id' and discount it from
+        its owner's uploads
+        """
+
+        with self._changing() as (connection, changed):
+            owner = self._image_owner(connection, id)
+
+            if owner is None:
+                return False
+
+            connection.execute(
+                """
+                UPDATE accounts SET
+                    uploads = uploads - 1,
+                    total_likes = total_likes -
+                        (SELECT COUNT(*) FROM likes WHERE image_id = :image),
+                    total_views = total_views -
+                        (SELECT COUNT(*) FROM views WHERE image_id = :image)
+                WHERE username = :owner
+                """,
+                {"image": id, "owner": owner[0]},
+            )
+            connection.execute("DELETE FROM images WHERE id = ?", (id,))
+            changed.extend(image_keys(id, *owner, file=True))
+
+        return True
+
+    def set_image_public(self, id, public):
+        with self._changing() as (connection, changed):
+            owner = self._image_owner(connection, id)
+
+            if owner is None:
+                return
+
+            connection.execute(
+                "UPDATE images SET public = ? WHERE id = ?",
+                (public, id),
+            )
+            changed.extend(image_keys(id, owner[0], True, file=True))
+
+    def set_image_like(self, id, username, like):
+        """
+        Add (or remove) the like of 'username' on the
+        image with 'id' and return the new likes (Members)
+        """
+
+        with self._changing() as (connection, changed):
+            owner = self._image_owner(connection, id)
+
+            if owner is None:
+                return None
+
+            if like:
+                cursor = connection.execute(
+                    """
+                    INSERT OR IGNORE INTO likes (image_id, account_id)
+                    SELECT ?, id FROM accounts WHERE username = ?
+                    """,
+                    (id, username),
+                )
+            else:
+                cursor = connection.execute(
+                    """
+                    DELETE FROM likes WHERE image_id = ? AND account_id =
+                    (SELECT id FROM accounts WHERE username = ?)
+                    """,
+                    (id, username),
+                )
+
+            if cursor.rowcount > 0:
+                delta = 1 if like else -1
+
+                connection.execute(
+                    "UPDATE images SET score = score + ? WHERE id = ?",
+                    (delta, id),
+                )
+                connection.execute(
+                    """
+                    UPDATE accounts SET total_likes = total_likes + ?
+                    WHERE id = (SELECT owner_id FROM images WHERE id = ?)
+                    """,
+                    (delta, id),
+                )
+                changed.extend(image_keys(id, *owner))
+
+            likes = self._members("likes", id)
+
+        return likes
+
+    def add_image_view(self, id, username):
+        """
+        Count a view of 'username' on the image with 'id'
+        return True if it is the first view of that user
+        """
+
+        return self.add_image_views({id: [username]}) > 0
+
+    def add_image_views(self, views):
+        """
+        Count the views in 'views', image ID -> usernames,
+        in a single transaction
+        return the number of first views
+        """
+
+        added = 0
+        viewed = set()
+
+        with self._changing() as (connection, changed):
+            for id, usernames in views.items():
+                for username in usernames:
+                    cursor = connection.execute(
+                        """
+                        INSERT OR IGNORE INTO views (image_id, account_id)
+                        SELECT images.id, accounts.id FROM images, accounts
+                        WHERE images.id = ? AND accounts.username = ?
+                        """,
+                        (id, username),
+                    )
+
+                    if cursor.rowcount <= 0:
+                        continue
+
+                    added += 1
+                    connection.execute(
+                        "UPDATE images SET score = score + 1 WHERE id = ?",
+                        (id,),
+                    )
+                    connection.execute(
+                        """
+                        UPDATE accounts SET total_views = total_views + 1
+                        WHERE id = (SELECT owner_id FROM images WHERE id = ?)
+                        """,
+                        (id,),
+                    )
+
+                    if id not in viewed:
+                        viewed.add(id)
+                        changed.extend(image_keys(
+                            id, *self._image_owner(connection, id)
+                        ))
+
+        return added
+
+    def all_images(self):
+        """
+        Return every image, e.g. for the maintenance commands
+        """
+
+        return self._select_images("1 = 1", order="ORDER BY images.id")
+
+    def images_missing_derivatives(self):
+        """
+        Return the images whose resized copies were never generated
+        """
+
+        return self._select_images("images.derivatives IS NULL")
+
+    def file_references(self, filename):
+        """
+        Return the number of images stored in the file 'filename'
+        """
+
+        return self.connect().execute(
+            "SELECT COUNT(*) FROM images WHERE filename = ?", (filename,)
+        ).fetchone()[0]
+
+    def set_image_file(self, id, filename, derivatives):
+        """
+        Move the image with 'id' into the file 'filename',
+        whose resized copies are 'derivatives'
+        return False if the image does not exist (anymore)
+        """
+
+        with self._changing() as (connection, changed):
+            cursor = connection.execute(
+                "UPDATE images SET filename = ?, derivatives = ? WHERE id = ?",
+                (
+                    filename,
+                    None if derivatives is None else json.dumps(derivatives),
+                    id,
+                ),
+            )
+
+            if cursor.rowcount <= 0:
+                return False
+
+            changed.append(("file", id))
+
+        return True
+
+    def set_image_derivatives(self, id, derivatives):
+        """
+        Record the filenames of the resized copies of the image
+        return False if the image does not exist (anymore)
+        """
+
+        with self._changing() as (connection, changed):
+            cursor = connection.execute(
+                "UPDATE images SET derivatives = ? WHERE id = ?",
+                (json.dumps(derivatives), id),
+            )
+
+            if cursor.rowcount <= 0:
+                return False
+
+            changed.append(("file", id))
+
+        return True
+
+    def add_image_comment(self, id, comment):
+        """
+        Append 'comment' on the image with 'id'
+        and return the new list of comments
+        """
+
+        with self._changing() as (connection, changed):
+            cursor = connection.execute(
+                """
+                INSERT INTO comments (image_id, account_id, comment, timestamp)
+                SELECT images.id, accounts.id, ?, ? FROM images, accounts
+                WHERE images.id = ? AND accounts.username = ?
+                """,
+                (comment["comment"], comment["timestamp"], id,
+                 comment["username"]),
+            )
+
+            if not cursor.rowcount:
+                return None
+
+            owner = self._image_owner(connection, id)
+            comments = self._comments(id)
+            changed.extend(image_keys(id, *owner))
+
+        return comments
+
+
+class ShardedDatabase:
+    """
+    Long-lived handle to a database split into several TinyDB
+    (JSON) files, the shards, each one with its own locks (see
+    `JSONDatabase`), so that the writes of the users of different
+    shards do not wait for each other
+
+    an account is stored along with its images in the shard of
+    its username, see `shard_of`, the number of shards is recorded
+    in the manifest of the directory, see `write_manifest`
+
+    the catalog (SQLite) allocates the account and image IDs, so
+    that they are unique across the shards, and records the shard
+    of every image and the timeline of the public images, so that
+    only the shards of the images served are read
+
+    'versions' and 'image_cache' are shared by the shards, the
+    account IDs and the shards of the images never change, they
+    are cached in 'account_ids' and 'image_shards'
+
+    'shared' if other processes serve the database at the same
+    time, see 'ShardedVersions'
+    """
+
+    def __init__(self, uri, image_cache_size=4096, shared=False):
+        self.uri = uri
+        self.directory = shards_directory(uri)
+        os.makedirs(self.directory, exist_ok=True)
+
+        manifest = os.path.join(self.directory, SHARDS_MANIFEST)
+
+        # the other processes opening it meanwhile wait for this one
+        if not os.path.exists(manifest):
+            setup_lock = FileLock(os.path.join(self.directory, ".lock"))
+
+            with setup_lock.hold():
+                if not os.path.exists(manifest):
+                    write_manifest(self.directory, DEFAULT_SHARDS)
+
+            setup_lock.close()
+
+        with open(manifest, encoding="utf-8") as file:
+            shards = json.load(file)["shards"]
+
+        self.image_cache = LRUCache(max_size=image_cache_size)
+        self.account_ids = LRUCache(max_size=image_cache_size)
+        self.image_shards = LRUCache(max_size=image_cache_size)
+
+        self.catalog = SQLiteFile(catalog_path(self.directory))
+        # `executescript` manages its own transaction
+        connection = self.catalog.connect()
+        connection.executescript(CATALOG_SCHEMA)
+
+        if shared:
+            self.versions = ShardedVersions(self, connection.execute(
+                "SELECT epoch FROM versions_epoch"
+            ).fetchone()[0])
+        else:
+            self.versions = Versions(sync=self._refresh)
+
+        self.shards = []
+
+        for number in range(shards):
+            self.shards.append(JSONDatabase(
+                shard_path(self.directory, number),
+                image_cache_size,
+                sharded=self,
+            ))
+
+    def _refresh(self):
+        for shard in self.shards:
+            shard._refresh()
+
+    def _changed(self, reloaded):
+        """
+        Reset the versions once a shard was reloaded, see
+        `JSONDatabase._changed`, the shared ones are read
+        back from the shard instead
+        """
+
+        if reloaded and not isinstance(self.versions, ShardedVersions):
+            # the records cached so far may be stale
+            self.versions.reset()
+
+    def _shard(self, username):
+        """
+        Return the shard of the account of 'username'
+        """
+
+        return self.shards[shard_of(username, len(self.shards))]
+
+    def _group_images(self, ids):
+        """
+        Return the IDs of the images among 'ids' which exist,
+        grouped by shard, shard -> IDs
+        """
+
+        numbers = {}
+        missing = []
+
+        for id in ids:
+            number = self.image_shards.get(id)
+
+            if number is None:
+                missing.append(id)
+            else:
+                numbers[id] = number
+
+        if missing:
+            rows = self.catalog.connect().execute(
+                """
+                SELECT id, shard FROM images
+                WHERE id IN (SELECT value FROM json_each(?))
+                """,
+                (json.dumps(missing),),
+            )
+
+            for id, number in rows:
+                self.image_shards.put(id, number)
+                numbers[id] = number
+
+        groups = {}
+
+        for id, number in numbers.items():
+            groups.setdefault(self.shards[number], []).append(id)
+
+        return groups
+
+    def _image_shard(self, id):
+        """
+        Return the shard of the image with 'id', None if
+        it does not exist
+        """
+
+        return next(iter(self._group_images([id])), None)
+
+    def account_id(self, username):
+        """
+        Return the ID of the account of 'username', None if it
+        does not exist, e.g. for the likes of the users of the
+        other shards
+        """
+
+        account_id = self.account_ids.get(username)
+
+        if account_id is None:
+            row = self.catalog.connect().execute(
+                "SELECT id FROM accounts WHERE username = ?",
+                (username,),
+            ).fetchone()
+
+            if row is None:
+                return None
+
+            account_id = row[0]
+            self.account_ids.put(username, account_id)
+
+        return account_id
+
+    def usernames_of(self, ids):
+        """
+        Return the usernames of the accounts with 'ids'
+        which exist, in the same order
+        """
+
+        rows = self.catalog.connect().execute(
+            """
+            SELECT id, username FROM accounts
+            WHERE id IN (SELECT value FROM json_each(?))
+            """,
+            (json.dumps(ids),),
+        )
+        usernames = dict(rows.fetchall())
+        return [usernames[id] for id in ids if id in usernames]
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+
+        self.catalog.close()
+
+    def lock_stats(self):
+        """
+        Return the wait and hold times of the catalog writes
+        and of the locks of every shard
+        """
+
+        return {
+            "catalog": self.catalog.lock_stats(),
+            "shards": [shard.lock_stats() for shard in self.shards],
+        }
+
+    # accounts
+
+    def get_account(self, username):
+        return self._shard(username).get_account(username)
+
+    def _forget(self, table, id):
+        """
+        Delete the catalog row of a document whose shard
+        could not be written
+        """
+
+        with self.catalog.transaction() as connection:
+            connection.execute(f"DELETE FROM {table} WHERE id = ?", (id,))
+
+    def add_account(self, account):
+        """
+        Insert 'account' and return its ID, None if
+        the username is already taken
+        """
+
+        username = account["username"]
+
+        with self.catalog.transaction() as connection:
+            cursor = connection.execute(
+                """
+                INSERT INTO accounts (username) VALUES (?)
+                ON CONFLICT (username) DO NOTHING
+                """,
+                (username,),
+            )
+
+        # e.g. another signup of the same username won the race
+        if not cursor.rowcount:
+            return None
+
+        account_id = None
+
+        try:
+            account_id = self._shard(username).add_account(
+                account, cursor.lastrowid
+            )
+        finally:
+            if account_id is None:
+                self._forget("accounts", cursor.lastrowid)
+                self.account_ids.pop(username)
+
+        return account_id
+
+    def update_account(self, username, fields):
+        self._shard(username).update_account(username, fields)
+
+    def account_totals(self, username):
+        """
+        Return the total likes and views on the images
+        owned by 'username'
+        """
+
+        return self._shard(username).account_totals(username)
+
+    def recompute_totals(self):
+        """
+        Recompute the 'total_likes' and 'total_views' counters
+        of every account from its images
+        """
+
+        for shard in self.shards:
+            shard.recompute_totals()
+
+    # images
+
+    def _load_images(self, ids):
+        records = {}
+
+        for shard, shard_ids in self._group_images(ids).items():
+            for record in shard._load_images(shard_ids):
+                records[record["id"]] = record
+
+        return [records[id] for id in ids if id in records]
+
+    def get_image(self, id):
+        images = self.get_images([id])
+        return images[0] if images else None
+
+    def get_images(self, ids):
+        """
+        Return the records of the images with 'ids'
+        which exist, in the same order
+        """
+
+        return read_through(
+            self.image_cache, self.versions, list(ids), self._load_images
+        )
+
+    def list_images(self, owner=None, limit=None, after=None):
+        """
+        Return the images of 'owner' (or the public images
+        if no 'owner' is given) newest first, paginated by
+        'limit' and the (timestamp, id) cursor 'after'
+        """
+
+        if owner is not None:
+            return self._shard(owner).list_images(owner, limit, after)
+
+        conditions, parameters = ["public = 1"], []
+
+        if after is not None:
+            conditions.append("(timestamp, id) < (?, ?)")
+            parameters += after
+
+        rows = self.catalog.connect().execute(
+            f"""
+            SELECT id FROM images WHERE {" AND ".join(conditions)}
+            ORDER BY timestamp DESC, id DESC LIMIT ?
+            """,
+            (*parameters, -1 if limit is None else limit),
+        )
+
+        # the catalog and the shard are not written at once
+        return [
+            image
+            for image in self._load_images([row[0] for row in rows])
+            if image.get("public")
+        ]
+
+    def popular_images(self, limit):
+        """
+        Return the 'limit' public images with the most
+        likes and views, most popular first
+        """
+
+        images = [
+            image
+            for shard in self.shards
+            for image in shard.popular_images(limit)
+        ]
+        images.sort(
+            key=lambda image: (
+                popularity(image), image["timestamp"], image["id"]
+            ),
+            reverse=True,
+        )
+
+        return images[:limit]
+
+    def add_image(self, image):
+        """
+        Insert 'image' and count it in its owner's uploads
+        """
+
+        number = shard_of(image["owner"], len(self.shards))
+
+        with self.catalog.transaction() as connection:
+            id = connection.execute(
+                """
+                INSERT INTO images (shard, timestamp, public)
+                VALUES (?, ?, ?)
+                """,
+                (number, image["timestamp"], bool(image.get("public"))),
+            ).lastrowid
+
+        try:
+            self.shards[number].add_image(image, id)
+        except BaseException:
+            self._forget("images", id)
+            raise
+
+        self.image_shards.put(id, number)
+        return id
+
+    def remove_image(self, id):
+        """
+        Remove the image with 'id' and discount it from
+        its owner's uploads
+        """
+
+        shard = self._image_shard(id)
+
+        if shard is None:
+            return False
+
+        removed = shard.remove_image(id)
+
+        with self.catalog.transaction() as connection:
+            connection.execute("DELETE FROM images WHERE id = ?", (id,))
+
+        return removed
+
+    def set_image_public(self, id, public):
+        shard = self._image_shard(id)
+
+        if shard is None:
+            return
+
+        # the shard last, its write changes the versions of the
+        # public images, see `list_images`
+        with self.catalog.transaction() as connection:
+            connection.execute(
+                "UPDATE images SET public = ? WHERE id = ?",
+                (bool(public), id),
+            )
+
+        shard.set_image_public(id, public)
+
+    def set_image_like(self, id, username, like):
+        """
+        Add (or remove) the like of 'username' on the
+        image with 'id' and return the new likes (Members)
+        """
+
+        shard = self._image_shard(id)
+
+        if shard is None:
+            return None
+
+        return shard.set_image_like(id, username, like)
+
+    def add_image_view(self, id, username):
+        """
+        Count a view of 'username' on the image with 'id'
+        return True if it is the first view of that user
+        """
+
+        return self.add_image_views({id: [username]}) > 0
+
+    def add_image_views(self, views):
+        """
+        Count the views in 'views', image ID -> usernames,
+        with a single write of each shard
+        return the number of first views
+        """
+
+        return sum(
+            shard.add_image_views({id: views[id] for id in ids})
+            for shard, ids in self._group_images(list(views)).items()
+        )
+
+    def all_images(self):
+        """
+        Return every image, e.g. for the maintenance commands
+        """
+
+        return [image for shard in self.shards for image in shard.all_images()]
+
+    def images_missing_derivatives(self):
+        """
+        Return the images whose resized copies were never generated
+        """
+
+        return [
+            image
+            for shard in self.shards
+            for image in shard.images_missing_derivatives()
+        ]
+
+    def file_references(self, filename):
+        """
+        Return the number of images stored in the file 'filename'
+        (identical uploads of users of different shards share it)
+        """
+
+        return sum(shard.file_references(filename) for shard in self.shards)
+
+    def set_image_file(self, id, filename, derivatives):
+        """
+        Move the image with 'id' into the file 'filename',
+        whose resized copies are 'derivatives'
+        return False if the image does not exist (anymore)
+        """
+
+        shard = self._image_shard(id)
+        return shard is not None and shard.set_image_file(
+            id, filename, derivatives
+        )
+
+    def set_image_derivatives(self, id, derivatives):
+        """
+        Record the filenames of the resized copies of the image
+        return False if the image does not exist (anymore)
+        """
+
+        shard = self._image_shard(id)
+        return shard is not None and shard.set_image_derivatives(
+            id, derivatives
+        )
+
+    def add_image_comment(self, id, comment):
+        """
+        Append 'comment' on the image with 'id'
+        and return the new list of comments
+        """
+
+        shard = self._image_shard(id)
+
+        if shard is None:
+            return None
+
+        return shard.add_image_comment(id, comment)
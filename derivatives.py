@@ -0,0 +1,155 @@
+# resized copies (derivatives) of the uploaded images
+# the gallery only shows small tiles, so it should not
+# download the full-size originals
+
+import os
+import tempfile
+
+from PIL import Image, ImageOps
+
+# name -> largest (width, height) of the derivative
+# "thumb" fits the gallery tiles (18em) on high DPI screens
+SIZES = {
+    "thumb": (600, 600),
+    "medium": (1600, 1600),
+}
+
+# formats Pillow should use to save each extension
+FORMATS = {"jpg": "JPEG", "jpeg": "JPEG", "png": "PNG", "webp": "WEBP"}
+
+
+def derivative_filename(filename, size, ext=None):
+    """
+    Return the filename of the 'size' derivative of 'filename'
+    e.g. ('abc.png', 'thumb') -> 'abc.thumb.png'
+         ('abc.png', 'thumb', 'webp') -> 'abc.thumb.webp'
+    """
+
+    stem, original_ext = filename.rsplit(".", 1)
+    return f"{stem}.{size}.{ext or original_ext}"
+
+
+def derivative_filenames(filename):
+    """
+    Return every filename a derivative of 'filename' may have
+    """
+
+    return [
+        derivative_filename(filename, size, ext)
+        for size in SIZES
+        for ext in (None, "webp")
+    ]
+
+
+def save_image(image, filepath, ext):
+    """
+    Save 'image' into 'filepath' with the format of 'ext'
+    """
+
+    image_format = FORMATS[ext.lower()]
+
+    if image_format == "JPEG" and image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+
+    options = {
+        "JPEG": {"quality": 85, "optimize": True, "progressive": True},
+        "PNG": {"optimize": True},
+        "WEBP": {"quality": 80, "method": 4},
+    }[image_format]
+
+    # write under a temporary name so that a half written
+    # derivative is never served, a unique one since several
+    # jobs may write the same (content-addressed) file at once
+    fd, temp_path = tempfile.mkstemp(
+        dir=os.path.dirname(filepath), prefix=".", suffix=".tmp"
+    )
+
+    try:
+        with os.fdopen(fd, "wb") as file:
+            image.save(file, format=image_format, **options)
+
+        # readable by the front proxy, like the files written before
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, filepath)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+def generate_derivatives(directory, filename, webp=True):
+    """
+    Generate the derivatives of the image 'filename' stored
+    in 'directory', in its own format and optionally in WebP
+
+    a derivative is only generated when it is smaller than
+    the original, the original is served otherwise
+
+    the derivatives already stored are kept, they were made
+    from the same content (see `storage.content_filename`)
+    """
+
+    ext = filename.rsplit(".", 1)[1]
+    generated = []
+
+    with Image.open(os.path.join(directory, filename)) as original:
+        # apply the EXIF orientation, it is lost when resizing
+        original = ImageOps.exif_transpose(original)
+
+        for size, bounds in SIZES.items():
+            if original.width <= bounds[0] and original.height <= bounds[1]:
+                continue
+
+            missing = [
+                derivative_ext
+                for derivative_ext in ((ext, "webp") if webp else (ext,))
+                if not os.path.isfile(os.path.join(
+                    directory,
+                    derivative_filename(filename, size, derivative_ext),
+                ))
+            ]
+
+            if missing:
+                image = original.copy()
+                image.thumbnail(bounds, Image.LANCZOS)
+
+            for derivative_ext in (ext, "webp") if webp else (ext,):
+                derivative = derivative_filename(
+                    filename, size, derivative_ext
+                )
+
+                if derivative_ext in missing:
+                    save_image(
+                        image,
+                        os.path.join(directory, derivative),
+                        derivative_ext
+                    )
+
+                generated.append(derivative)
+
+    return generated
+
+
+def make_avatar(source, destination, bounds=(256, 256)):
+    """
+    Create the avatar 'destination' (PNG) from the uploaded
+    image 'source', which is removed afterwards
+    """
+
+    try:
+        with Image.open(source) as image:
+            image.thumbnail(bounds)
+            save_image(image, destination, "png")
+    finally:
+        os.remove(source)
+
+
+def remove_derivatives(directory, filename):
+    """
+    Remove every derivative of 'filename' from 'directory'
+    """
+
+    for derivative in derivative_filenames(filename):
+        filepath = os.path.join(directory, derivative)
+
+        if os.path.isfile(filepath):
+            os.remove(filepath)
@@ -0,0 +1,116 @@
+# background jobs of the web application
+# CPU-bound work (e.g. resizing images) runs in a pool of worker
+# processes, so that it does not hold up the request threads
+
+import logging
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+
+class JobQueueFull(Exception):
+    """
+    Raised when the job queue already has 'max_pending' jobs
+    """
+
+
+class JobQueue:
+    """
+    Bounded queue of jobs, run by a pool of worker processes
+
+    every job has a key (e.g. "image-42") under which its
+    status can be looked up:
+        - "queued", waiting for a worker
+        - "running"
+        - "done"
+        - "failed"
+    the status of the finished jobs is kept for a while
+    """
+
+    def __init__(self, workers=2, max_pending=64, max_finished=1024):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.max_finished = max_finished
+
+        self.lock = Lock()
+        self.executor = None
+        self.pending = {}
+        self.finished = OrderedDict()
+
+    def _executor(self):
+        if self.executor is None:
+            # "spawn" as forking a process with running threads is unsafe
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+
+        return self.executor
+
+    def submit(self, key, func, *args, callback=None):
+        """
+        Run 'func(*args)' in a worker process under 'key'
+
+        'callback' is called with the result of 'func' once it is
+        done, in a thread of this process, it is not called if
+        'func' fails
+        """
+
+        with self.lock:
+            if len(self.pending) >= self.max_pending:
+                raise JobQueueFull(key)
+
+            future = self._executor().submit(func, *args)
+            self.pending[key] = future
+            self.finished.pop(key, None)
+
+        def done(future):
+            status = "done"
+
+            if future.exception():
+                status = "failed"
+                logger.error(f"job {key} failed", exc_info=future.exception())
+            elif callback:
+                try:
+                    callback(future.result())
+                except Exception:
+                    status = "failed"
+                    logger.exception(f"callback of job {key} failed")
+
+            with self.lock:
+                if self.pending.get(key) is future:
+                    del self.pending[key]
+
+                self.finished[key] = status
+
+                while len(self.finished) > self.max_finished:
+                    self.finished.popitem(last=False)
+
+        future.add_done_callback(done)
+
+    def status(self, key):
+        """
+        Return the status of the job 'key', None if it is unknown
+        """
+
+        with self.lock:
+            future = self.pending.get(key)
+
+            if future is not None:
+                return "running" if future.running() else "queued"
+
+            return self.finished.get(key)
+
+    def shutdown(self):
+        """
+        Wait for the pending jobs and stop the worker processes
+        """
+
+        with self.lock:
+            executor, self.executor = self.executor, None
+
+        if executor is not None:
+            executor.shutdown(wait=True)
@@ -0,0 +1,253 @@
+# locks of the storage layer, instrumented
+# the time spent waiting for and holding them is measured,
+# so that the contention can be watched under load (see '/api/stats')
+
+import mmap
+import os
+import time
+from contextlib import contextmanager
+from threading import Condition, Lock
+
+try:
+    import fcntl
+except ImportError:
+    # e.g. Windows, where a single process serves the requests
+    fcntl = None
+
+
+class LockStats:
+    """
+    Number of acquisitions of a lock, and the time spent waiting
+    for it and holding it (total and longest, in seconds)
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.acquired = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.hold_total = 0.0
+        self.hold_max = 0.0
+
+    def record(self, wait, hold):
+        """
+        Count an acquisition which waited 'wait' seconds
+        and held the lock 'hold' seconds
+        """
+
+        with self.lock:
+            self.acquired += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+            self.hold_total += hold
+            self.hold_max = max(self.hold_max, hold)
+
+    def stats(self):
+        """
+        Return the counters, the times in milliseconds
+        """
+
+        with self.lock:
+            acquired = self.acquired or 1
+
+            return {
+                "acquired": self.acquired,
+                "wait_avg_ms": self.wait_total / acquired * 1000,
+                "wait_max_ms": self.wait_max * 1000,
+                "hold_avg_ms": self.hold_total / acquired * 1000,
+                "hold_max_ms": self.hold_max * 1000,
+            }
+
+
+@contextmanager
+def measured(stats, acquire, release):
+    """
+    Hold a lock, taken by 'acquire()' and given back by 'release()',
+    for the enclosed statements, and record the times in 'stats'
+    """
+
+    start = time.perf_counter()
+    acquire()
+    acquired = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        release()
+        stats.record(acquired - start, time.perf_counter() - acquired)
+
+
+class RWLock:
+    """
+    Lock shared by any number of readers, or held by a single writer
+
+    writers are preferred: once a writer waits, the new readers wait
+    behind it, so that a steady stream of reads can't starve the writes
+
+    not reentrant, a thread holding the lock must not take it again
+    """
+
+    def __init__(self):
+        self.condition = Condition(Lock())
+        self.readers = 0
+        self.writing = False
+        self.waiting_writers = 0
+
+        self.read_stats = LockStats()
+        self.write_stats = LockStats()
+
+    def _acquire_read(self):
+        with self.condition:
+            while self.writing or self.waiting_writers:
+                self.condition.wait()
+
+            self.readers += 1
+
+    def _release_read(self):
+        with self.condition:
+            self.readers -= 1
+
+            if not self.readers:
+                self.condition.notify_all()
+
+    def _acquire_write(self):
+        with self.condition:
+            self.waiting_writers += 1
+
+            try:
+                while self.writing or self.readers:
+                    self.condition.wait()
+            finally:
+                self.waiting_writers -= 1
+
+            self.writing = True
+
+    def _release_write(self):
+        with self.condition:
+            self.writing = False
+            self.condition.notify_all()
+
+    def read(self):
+        """
+        Context manager holding the lock shared with the other readers
+        """
+
+        return measured(
+            self.read_stats, self._acquire_read, self._release_read
+        )
+
+    def write(self):
+        """
+        Context manager holding the lock alone
+        """
+
+        return measured(
+            self.write_stats, self._acquire_write, self._release_write
+        )
+
+    def stats(self):
+        """
+        Return the wait and hold times of the readers and the writers
+        """
+
+        return {
+            "read": self.read_stats.stats(),
+            "write": self.write_stats.stats(),
+        }
+
+
+class FileLock:
+    """
+    Lock held by a single thread of all the processes opening
+    the same 'path', e.g. the workers of './server.py'
+
+    the file also holds a generation counter, bumped by the holder
+    whenever it changed the data guarded by the lock, so that the
+    other processes can tell that their copy of it is stale
+
+    the file is opened on first use, the processes are only
+    serialized where fcntl is available
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        self.fd = None
+        self.counter = None
+
+        self.hold_stats = LockStats()
+
+    def _open(self):
+        if self.counter is not None:
+            return
+
+        with self.lock:
+            if self.counter is not None:
+                return
+
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+
+            # the counter, 8 bytes shared (mapped) by the processes
+            if os.fstat(fd).st_size < 8:
+                os.ftruncate(fd, 8)
+
+            self.fd = fd
+            self.counter = mmap.mmap(fd, 8)
+
+    def _acquire(self):
+        self._open()
+        self.lock.acquire()
+
+        if fcntl is not None:
+            try:
+                fcntl.flock(self.fd, fcntl.LOCK_EX)
+            except BaseException:
+                self.lock.release()
+                raise
+
+    def _release(self):
+        if fcntl is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+        self.lock.release()
+
+    def hold(self):
+        """
+        Context manager holding the lock
+        """
+
+        return measured(self.hold_stats, self._acquire, self._release)
+
+    def generation(self):
+        """
+        Return the current generation of the guarded data
+        """
+
+        self._open()
+        return int.from_bytes(self.counter[:8], "little")
+
+    def bump(self):
+        """
+        Mark the guarded data as changed and return its new
+        generation, the lock must be held
+        """
+
+        generation = self.generation() + 1
+        self.counter[:8] = generation.to_bytes(8, "little")
+        return generation
+
+    def stats(self):
+        """
+        Return the wait and hold times of the lock
+        """
+
+        return self.hold_stats.stats()
+
+    def close(self):
+        with self.lock:
+            if self.counter is not None:
+                self.counter.close()
+                os.close(self.fd)
+
+            self.fd = None
+            self.counter = None
@@ -0,0 +1,612 @@
+#!/usr/bin/env python
+
+# maintenance commands for the web application
+# usage: python manage.py <command> [arguments]
+# see `python manage.py --help` for the list of commands
+
+import argparse
+import json
+import os
+import sys
+
+from PIL import UnidentifiedImageError
+
+import derivatives
+import storage
+from database import (
+    CATALOG_SCHEMA,
+    DEFAULT_SHARDS,
+    SHARDS_MANIFEST,
+    SHARDS_SCHEME,
+    SQLITE_SCHEME,
+    MemoryJSONStorage,
+    ShardedDatabase,
+    SQLiteDatabase,
+    SQLiteFile,
+    catalog_path,
+    open_database,
+    shard_of,
+    shard_path,
+    shards_directory,
+    write_manifest,
+)
+
+
+def database_uri(args):
+    """
+    Return the database URI given on the command line,
+    or the one configured in the web application
+    """
+
+    if args.database:
+        return args.database
+
+    from app import app
+
+    return app.config["DATABASE"]
+
+
+def upload_dir(args):
+    """
+    Return the uploads directory given on the command line,
+    or the one configured in the web application
+    """
+
+    if args.upload_dir:
+        return args.upload_dir
+
+    from app import app
+
+    return app.config["UPLOAD_DIR"]
+
+
+def generate_derivatives(args):
+    """
+    Generate the resized copies of every image which has none
+    e.g. the images uploaded before they existed
+    """
+
+    db = open_database(database_uri(args))
+    directory = upload_dir(args)
+    failed = 0
+
+    images = db.images_missing_derivatives()
+
+    for image in images:
+        filepath = storage.find_upload(directory, image["filename"])
+
+        if filepath is None:
+            print(f"{image['filename']}: missing", file=sys.stderr)
+            failed += 1
+            continue
+
+        try:
+            generated = derivatives.generate_derivatives(
+                os.path.dirname(filepath),
+                image["filename"],
+                webp=not args.no_webp,
+            )
+        except (OSError, UnidentifiedImageError) as error:
+            print(f"{image['filename']}: {error}", file=sys.stderr)
+            failed += 1
+        else:
+            db.set_image_derivatives(image["id"], generated)
+
+    db.close()
+
+    print(f"Generated the derivatives of {len(images) - failed} images")
+    return 1 if failed else 0
+
+
+def directory_size(directory):
+    """
+    Return the total size of the files in 'directory'
+    and its subdirectories
+    """
+
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(directory)
+        for name in names
+    )
+
+
+def link_file(source, destination):
+    """
+    Make 'destination' a link to 'source' unless
+    it already exists (with the same content)
+    """
+
+    if not os.path.isfile(destination):
+        os.link(source, destination)
+
+
+def content_derivative(filename, content, derivative):
+    """
+    Return the name of 'derivative' of 'filename' once moved
+    into the file 'content', see `storage.content_filename`
+    e.g. ('a.JPEG', 'abc.jpg', 'a.thumb.JPEG') -> 'abc.thumb.jpg'
+         ('a.JPEG', 'abc.jpg', 'a.thumb.webp') -> 'abc.thumb.webp'
+    """
+
+    _, size, ext = derivative.rsplit(".", 2)
+    original_ext = filename.rsplit(".", 1)[1].lower()
+
+    # in the format of the original, under its new extension
+    if (
+        storage.EXTENSIONS.get(ext.lower(), ext.lower())
+        == storage.EXTENSIONS.get(original_ext, original_ext)
+    ):
+        ext = None
+
+    return derivatives.derivative_filename(content, size, ext)
+
+
+def dedup_uploads(args):
+    """
+    Move every image into the file named after its content
+    e.g. the images uploaded before the files were shared,
+    the identical files are only kept once
+
+    the web application should be stopped meanwhile
+    """
+
+    db = open_database(database_uri(args))
+    directory = upload_dir(args)
+    size_before = directory_size(directory)
+    moved = 0
+    failed = 0
+
+    for image in db.all_images():
+        filename = image["filename"]
+        filepath = storage.find_upload(directory, filename)
+
+        if filepath is None:
+            print(f"{filename}: missing", file=sys.stderr)
+            failed += 1
+            continue
+
+        try:
+            content = storage.content_filename(
+                storage.hash_file(filepath),
+                filename.rsplit(".", 1)[1],
+            )
+        except OSError as error:
+            print(f"{filename}: {error}", file=sys.stderr)
+            failed += 1
+            continue
+
+        old_generated = image.get("derivatives")
+        generated = None
+
+        if old_generated is not None:
+            generated = [
+                content_derivative(filename, content, derivative)
+                for derivative in old_generated
+            ]
+
+        # the derivatives may still have to be renamed, e.g. '.thumb.jpeg'
+        # ones kept under their legacy extension by an earlier version
+        if content == filename and generated == old_generated:
+            continue
+
+        # linked first, so that the image is always served
+        try:
+            link_file(filepath, storage.upload_path(directory, content))
+
+            for old, new in zip(old_generated or [], generated or []):
+                old_path = os.path.join(os.path.dirname(filepath), old)
+
+                if os.path.isfile(old_path):
+                    link_file(old_path, storage.upload_path(directory, new))
+        except OSError as error:
+            print(f"{filename}: {error}", file=sys.stderr)
+            failed += 1
+            continue
+
+        db.set_image_file(image["id"], content, generated)
+        moved += 1
+
+        if content == filename:
+            for old, new in zip(old_generated, generated):
+                old_path = os.path.join(os.path.dirname(filepath), old)
+
+                if old != new and os.path.isfile(old_path):
+                    os.remove(old_path)
+        elif not db.file_references(filename):
+            storage.remove_upload(directory, filename)
+
+    db.close()
+
+    freed = size_before - directory_size(directory)
+    print(f"Moved {moved} images, freed {freed} bytes in {directory}")
+    return 1 if failed else 0
+
+
+def shard_uploads(args):
+    """
+    Move the files stored at the top of the uploads directory
+    into their subdirectory, see `storage.shard`
+
+    the web application finds them at either place meanwhile,
+    so it can keep running
+    """
+
+    directory = upload_dir(args)
+    moved = storage.shard_uploads(directory)
+
+    print(f"Moved {moved} files into the subdirectories of {directory}")
+    return 0
+
+
+def recompute_totals(args):
+    """
+    Rebuild the per-account like and view counters
+    e.g. after restoring an old backup
+    """
+
+    db = open_database(database_uri(args))
+    db.recompute_totals()
+    db.close()
+
+    print("Recomputed the likes and views of every account and image")
+    return 0
+
+
+def migrate_sqlite(args):
+    """
+    Copy the accounts and images of the TinyDB (JSON) database
+    'args.source' into the SQLite database 'args.destination'
+
+    document IDs are kept, so image URLs stay the same
+    """
+
+    destination = args.destination
+
+    if not destination.startswith(SQLITE_SCHEME):
+        destination = f"{SQLITE_SCHEME}/{destination}"
+
+    with open(args.source, encoding="utf-8") as file:
+        tables = json.load(file)
+
+    accounts = tables.get("accounts", {})
+    images = tables.get("images", {})
+
+    db = SQLiteDatabase(destination)
+    account_ids = {}
+    skipped = 0
+
+    with db.transaction() as connection:
+        if connection.execute("SELECT 1 FROM accounts").fetchone():
+            print(f"{args.destination} is not empty, aborting", file=sys.stderr)
+            return 1
+
+        for doc_id, account in accounts.items():
+            connection.execute(
+                """
+                INSERT INTO accounts
+                (id, username, passwd_hash, avatar, timestamp, uploads)
+                VALUES (?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    int(doc_id),
+                    account["username"],
+                    account["passwd_hash"],
+                    account.get("avatar"),
+                    account.get("timestamp", 0),
+                    account.get("uploads", 0),
+                ),
+            )
+            account_ids[account["username"]] = int(doc_id)
+
+        known_ids = set(account_ids.values())
+
+        for doc_id, image in images.items():
+            owner_id = account_ids.get(image["owner"])
+
+            # images of unknown owners can never be served
+            if owner_id is None:
+                skipped += 1
+                continue
+
+            id = int(doc_id)
+            connection.execute(
+                """
+                INSERT INTO images
+                (id, filename, owner_id, timestamp, public, description,
+                 derivatives)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    id,
+                    image["filename"],
+                    owner_id,
+                    image.get("timestamp", 0),
+                    bool(image.get("public")),
+                    image.get("description", ""),
+                    None if image.get("derivatives") is None
+                    else json.dumps(image["derivatives"]),
+                ),
+            )
+
+            # account IDs, or usernames in databases created before
+            for table in ("likes", "views"):
+                connection.executemany(
+                    f"""
+                    INSERT OR IGNORE INTO {table} (image_id, account_id)
+                    VALUES (?, ?)
+                    """,
+                    [
+                        (id, account_ids.get(member, member))
+                        for member in image.get(table, [])
+                        if member in account_ids
+                        or member in known_ids
+                    ],
+                )
+
+            connection.executemany(
+                """
+                INSERT INTO comments (image_id, account_id, comment, timestamp)
+                VALUES (?, ?, ?, ?)
+                """,
+                [
+                    (
+                        id,
+                        account_ids[comment["username"]],
+                        comment["comment"],
+                        comment["timestamp"],
+                    )
+                    for comment in image.get("comments", [])
+                    if comment["username"] in account_ids
+                ],
+            )
+
+    db.recompute_totals()
+    db.close()
+
+    print(
+        f"Migrated {len(account_ids)} accounts and "
+        f"{len(images) - skipped} images into {args.destination}"
+    )
+
+    if skipped:
+        print(f"Skipped {skipped} images without a known owner")
+
+    return 0
+
+
+def read_tables(source):
+    """
+    Return the accounts and images of the TinyDB (JSON) or
+    sharded database 'source', document ID -> document
+    """
+
+    if not source.startswith(SHARDS_SCHEME):
+        tables = MemoryJSONStorage(source).read() or {}
+        return tables.get("accounts", {}), tables.get("images", {})
+
+    directory = shards_directory(source)
+
+    manifest = os.path.join(directory, SHARDS_MANIFEST)
+
+    with open(manifest, encoding="utf-8") as file:
+        shards = json.load(file)["shards"]
+
+    accounts = {}
+    images = {}
+
+    # the IDs are unique across the shards
+    for number in range(shards):
+        shard = MemoryJSONStorage(shard_path(directory, number))
+        tables = shard.read() or {}
+        accounts.update(tables.get("accounts", {}))
+        images.update(tables.get("images", {}))
+
+    return accounts, images
+
+
+def reshard(args):
+    """
+    Copy the accounts and images of the TinyDB (JSON) or sharded
+    database 'args.source' into the new sharded database
+    'args.destination', split into 'args.shards' shards
+
+    IDs are kept, so image URLs stay the same
+    the web application should be stopped meanwhile
+    """
+
+    destination = args.destination
+
+    if not destination.startswith(SHARDS_SCHEME):
+        destination = f"{SHARDS_SCHEME}/{destination}"
+
+    directory = shards_directory(destination)
+
+    if os.path.exists(os.path.join(directory, SHARDS_MANIFEST)):
+        print(f"{args.destination} is not empty, aborting", file=sys.stderr)
+        return 1
+
+    accounts, images = read_tables(args.source)
+
+    account_ids = {
+        account["username"]: int(doc_id)
+        for doc_id, account in accounts.items()
+    }
+    known_ids = set(account_ids.values())
+    shards = [{"accounts": {}, "images": {}} for _ in range(args.shards)]
+    catalog_images = []
+    skipped = 0
+
+    for doc_id, account in accounts.items():
+        number = shard_of(account["username"], args.shards)
+        shards[number]["accounts"][doc_id] = account
+
+    for doc_id, image in images.items():
+        # images of unknown owners can never be served
+        if image["owner"] not in account_ids:
+            skipped += 1
+            continue
+
+        # account IDs, or usernames in databases created before
+        for table in ("likes", "views"):
+            image[table] = sorted({
+                account_ids.get(member, member)
+                for member in image.get(table, [])
+                if member in account_ids or member in known_ids
+            })
+
+        number = shard_of(image["owner"], args.shards)
+        shards[number]["images"][doc_id] = image
+        catalog_images.append((
+            int(doc_id),
+            number,
+            image.get("timestamp", 0),
+            bool(image.get("public")),
+        ))
+
+    os.makedirs(directory, exist_ok=True)
+    catalog = SQLiteFile(catalog_path(directory))
+    catalog.connect().executescript(CATALOG_SCHEMA)
+
+    with catalog.transaction() as connection:
+        # left over by a copy which did not complete
+        connection.execute("DELETE FROM accounts")
+        connection.execute("DELETE FROM images")
+        connection.executemany(
+            "INSERT INTO accounts (id, username) VALUES (?, ?)",
+            [(id, username) for username, id in account_ids.items()],
+        )
+        connection.executemany(
+            """
+            INSERT INTO images (id, shard, timestamp, public)
+            VALUES (?, ?, ?, ?)
+            """,
+            catalog_images,
+        )
+
+    catalog.close()
+
+    for number, tables in enumerate(shards):
+        MemoryJSONStorage(shard_path(directory, number)).write(tables)
+
+    # last, so that an incomplete copy is never opened
+    write_manifest(directory, args.shards)
+
+    db = ShardedDatabase(destination)
+    db.recompute_totals()
+    db.close()
+
+    print(
+        f"Copied {len(accounts)} accounts and {len(catalog_images)} images "
+        f"into {args.shards} shards in {directory}"
+    )
+
+    if skipped:
+        print(f"Skipped {skipped} images without a known owner")
+
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Maintenance commands for PhotoStore"
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    command = commands.add_parser(
+        "migrate-sqlite",
+        help="migrate a TinyDB (JSON) database into a new SQLite database",
+    )
+    command.add_argument(
+        "source",
+        nargs="?",
+        default="photostore.db",
+        help="TinyDB database file (default: photostore.db)",
+    )
+    command.add_argument(
+        "destination",
+        nargs="?",
+        default="photostore.sqlite3",
+        help="SQLite database file (default: photostore.sqlite3)",
+    )
+    command.set_defaults(func=migrate_sqlite)
+
+    command = commands.add_parser(
+        "reshard",
+        help="copy a TinyDB (JSON) or sharded database into new shards",
+    )
+    command.add_argument(
+        "source",
+        help="TinyDB database file, or sharded database URI",
+    )
+    command.add_argument(
+        "destination",
+        help="directory (or shards:// URI) of the new sharded database",
+    )
+    command.add_argument(
+        "--shards",
+        type=int,
+        default=DEFAULT_SHARDS,
+        help=f"number of shards (default: {DEFAULT_SHARDS})",
+    )
+    command.set_defaults(func=reshard)
+
+    command = commands.add_parser(
+        "recompute-totals",
+        help="recompute the total likes and views of every account",
+    )
+    command.add_argument(
+        "--database",
+        help="database path or URI (default: app.config['DATABASE'])",
+    )
+    command.set_defaults(func=recompute_totals)
+
+    command = commands.add_parser(
+        "generate-derivatives",
+        help="generate the resized copies of the images which have none",
+    )
+    command.add_argument(
+        "--database",
+        help="database path or URI (default: app.config['DATABASE'])",
+    )
+    command.add_argument(
+        "--upload-dir",
+        help="uploads directory (default: app.config['UPLOAD_DIR'])",
+    )
+    command.add_argument(
+        "--no-webp",
+        action="store_true",
+        help="do not generate the WebP copies",
+    )
+    command.set_defaults(func=generate_derivatives)
+
+    command = commands.add_parser(
+        "dedup-uploads",
+        help="store the identical uploads once, named after their content",
+    )
+    command.add_argument(
+        "--database",
+        help="database path or URI (default: app.config['DATABASE'])",
+    )
+    command.add_argument(
+        "--upload-dir",
+        help="uploads directory (default: app.config['UPLOAD_DIR'])",
+    )
+    command.set_defaults(func=dedup_uploads)
+
+    command = commands.add_parser(
+        "shard-uploads",
+        help="move the uploads into the subdirectories named after them",
+    )
+    command.add_argument(
+        "--upload-dir",
+        help="uploads directory (default: app.config['UPLOAD_DIR'])",
+    )
+    command.set_defaults(func=shard_uploads)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
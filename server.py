@@ -1,15 +1,245 @@
 #!/usr/bin/env python
 
-from waitress import serve
+# production server of the web application (waitress)
+# usage: python server.py [--workers N]
+#
+# with several workers, the requests are served by as many processes
+# accepting the connections of a single listening socket, so that
+# they run on every core, see `run_workers`
+#   - SIGHUP restarts the workers gracefully, e.g. after an update
+#   - SIGTERM (or Ctrl+C) stops them gracefully
+# a worker which dies is replaced
 
-from app import app
+import argparse
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from importlib.metadata import version
 
 # number of threads to use for concurrent client requests
 MAX_THREADS = 32
 
+# number of processes, each with MAX_THREADS threads
+WORKERS = 1
+
+# seconds a stopping worker is given to finish its requests
+GRACEFUL_TIMEOUT = 30
+
 HOST = "localhost"
 PORT = 8080
 
+# versions of waitress whose internals `serve_worker` drives to
+# finish the requests being served when stopping, the one pinned
+# in requirements.txt and the ones checked since (major.minor)
+WAITRESS_VERSIONS = ("2.0", "3.0")
+
+
+def serve_worker(fd, state_dir):
+    """
+    Serve the requests accepted on the listening socket 'fd'
+    until SIGTERM, then finish the requests being served
+    (for GRACEFUL_TIMEOUT seconds at most) before exiting
+    """
+
+    from waitress.server import create_server
+
+    from app import app, share_state
+
+    share_state(state_dir)
+
+    stopping = []
+
+    def stop(*_):
+        stopping.append(True)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    # restarts are up to the main process
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+    server = create_server(
+        app, sockets=[socket.socket(fileno=fd)], threads=MAX_THREADS
+    )
+
+    waitress_version = version("waitress")
+
+    if ".".join(waitress_version.split(".")[:2]) not in WAITRESS_VERSIONS:
+        print(
+            f"waitress {waitress_version} is not supported, the requests "
+            "being served are cut short when stopping",
+            file=sys.stderr,
+        )
+
+        # waitress then waits a few seconds for the running tasks
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+        signal.signal(signal.SIGINT, lambda *_: sys.exit(0))
+        server.run()
+        return
+
+    # waitress has no public way to stop accepting while the requests
+    # being served complete, so the loop below drives its internals
+    # (the asyncore loop, the channels and their requests), as found
+    # in the versions of WAITRESS_VERSIONS
+    while not stopping:
+        server.asyncore.loop(timeout=1, map=server._map, count=1)
+
+    # the other workers accept the new connections meanwhile
+    server.accepting = False
+    deadline = time.monotonic() + GRACEFUL_TIMEOUT
+
+    while server.active_channels and time.monotonic() < deadline:
+        # the idle (keep-alive) connections are closed, not the ones
+        # just accepted, whose request is on its way
+        idle = time.time() - 1
+
+        for channel in list(server.active_channels.values()):
+            if (
+                not channel.requests
+                and channel.request is None
+                and channel.last_activity < idle
+            ):
+                channel.will_close = True
+
+        server.asyncore.loop(timeout=0.1, map=server._map, count=1)
+
+    server.task_dispatcher.shutdown()
+
+
+def run_workers(workers, port=PORT):
+    """
+    Run 'workers' processes serving the requests, see `serve_worker`,
+    until SIGTERM, restart them on SIGHUP
+
+    the listening socket is opened here and handed to every worker,
+    along with a directory for the state they share, see `share_state`
+    of the web application
+    """
+
+    listener = socket.create_server((HOST, port), backlog=1024)
+    state_dir = tempfile.mkdtemp(prefix="photostore-")
+    signals = []
+
+    def spawn():
+        return subprocess.Popen(
+            [
+                sys.executable,
+                os.path.abspath(__file__),
+                "--worker-fd", str(listener.fileno()),
+                "--state-dir", state_dir,
+            ],
+            pass_fds=[listener.fileno()],
+        )
+
+    def on_signal(signum, _):
+        signals.append(signum)
+
+    for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+        signal.signal(signum, on_signal)
+
+    # the workers serving the requests, the ones finishing them
+    current = [spawn() for _ in range(workers)]
+    stopping = []
+
+    try:
+        while True:
+            time.sleep(0.5)
+
+            if signal.SIGTERM in signals or signal.SIGINT in signals:
+                break
+
+            if signal.SIGHUP in signals:
+                print(f"Restarting {workers} workers")
+
+                # the connections wait in the queue of the socket
+                # until the new workers accept them
+                old, current = current, [spawn() for _ in range(workers)]
+
+                for process in old:
+                    process.terminate()
+
+                stopping.extend(old)
+
+            signals.clear()
+            stopping = [
+                process for process in stopping if process.poll() is None
+            ]
+
+            for index, process in enumerate(current):
+                if process.poll() is not None:
+                    print(
+                        f"Worker {process.pid} exited with code "
+                        f"{process.returncode}, restarting it",
+                        file=sys.stderr,
+                    )
+                    current[index] = spawn()
+    finally:
+        for process in current + stopping:
+            process.terminate()
+
+        deadline = time.monotonic() + GRACEFUL_TIMEOUT + 5
+
+        for process in current + stopping:
+            try:
+                process.wait(max(0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+        listener.close()
+        shutil.rmtree(state_dir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="PhotoStore server")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=WORKERS,
+        help=f"number of processes serving the requests (default: {WORKERS})",
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=PORT,
+        help=f"port to listen on (default: {PORT})",
+    )
+    # for the worker processes, see `run_workers`
+    parser.add_argument("--worker-fd", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--state-dir", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker_fd is not None:
+        serve_worker(args.worker_fd, args.state_dir)
+        return 0
+
+    if args.workers > 1:
+        if not hasattr(signal, "SIGHUP"):
+            print("--workers is not supported on this platform", file=sys.stderr)
+            return 1
+
+        print(
+            f"Server started on {HOST}:{args.port} "
+            f"with {args.workers} workers"
+        )
+        run_workers(args.workers, args.port)
+        return 0
+
+    from waitress import serve
+
+    from app import app
+
+    # SIGTERM (e.g. from systemd or docker) would skip the atexit
+    # handlers of the application, e.g. writing the pending views
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+    print(f"Server started on {HOST}:{args.port}")
+    serve(app, host=HOST, port=args.port, threads=MAX_THREADS)
+    return 0
+
+
 if __name__ == "__main__":
-    print(f"Server started on {HOST}:{PORT}")
-    serve(app, host=HOST, port=PORT, threads=MAX_THREADS)
+    sys.exit(main())
@@ -19,7 +19,7 @@ function loadCaptcha() {
 			let captcha = JSON.parse(xhr.responseText);
 
 			let captchaImage = $('#captcha-image')[0];
-			captchaImage.src = `data:image/png;base64,${captcha.b64}`;
+			captchaImage.src = captcha.url;
 
 			let captchaJWT = $('#captcha-jwt')[0];
 			captchaJWT.value = captcha.jwt;
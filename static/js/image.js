@@ -1,6 +1,20 @@
+// size of a page of '/api/image/list', asked on every request
+// (at most the server's 'IMAGE_LIST_MAX_PAGE_SIZE')
+const IMAGES_PAGE_SIZE = 24;
+
 $(document).ready(() => {
+	totalViews();
+	updateUploadInfo();
 	loadImages();
 
+	// load the next page of images when the bottom of the list comes into view
+	let observer = new IntersectionObserver(entries => {
+		if (entries[0].isIntersecting)
+			loadImages();
+	}, { rootMargin: '400px' });
+
+	observer.observe(document.getElementById('images-message'));
+
 	// register 'onclick' event to hide the selected comment
 	$('#comment-overlay').on('click', function() {
 		$('.comment-box.selected').removeClass('selected');
@@ -43,52 +57,72 @@ function getUsername() {
 	return null;
 }
 
+// state of the paginated image list
+let imagesCursor = null,
+	imagesLoading = false,
+	imagesComplete = false;
+
 function loadImages() {
-	totalViews();
+	if (imagesLoading || imagesComplete)
+		return;
+
+	imagesLoading = true;
 
 	let pagetype = $('#images')[0].getAttribute('data-pagetype'),
-		URL = '/api/image/list';
+		URL = `/api/image/list?expand=info&limit=${IMAGES_PAGE_SIZE}`;
 
 	if (pagetype)
-		URL = `${URL}?pagetype=${pagetype}`;
+		URL = `${URL}&pagetype=${pagetype}`;
+
+	if (imagesCursor)
+		URL = `${URL}&after=${imagesCursor}`;
+
+	let headerLoader = document.getElementById('header-loader');
+
+	// update the state of the loader
+	headerLoader.classList.remove('completed');
+	headerLoader.classList.add('active');
+	headerLoader.style.width = '50%';
 
 	let xhr = new XMLHttpRequest();
 	xhr.open('GET', URL);
 
-	xhr.onreadystatechange = async function() {
+	xhr.onreadystatechange = function() {
 		if (xhr.readyState === XMLHttpRequest.DONE) {
+			imagesLoading = false;
+
 			if (xhr.status === 200) {
 				let imageList = JSON.parse(xhr.responseText),
-					profileUploadInfo = document.querySelector('#numPhotos'),
 					images = document.getElementById('images'),
-					imagesMessage = document.getElementById('images-message'),
-					headerLoader = document.getElementById('header-loader');
+					imagesMessage = document.getElementById('images-message');
 
 				if (imageList.length > 0) {
-					// update the state of the loader
-					headerLoader.classList.add('active');
-
-					if (profileUploadInfo)
-						profileUploadInfo.innerHTML = `You have uploaded ${imageList.length} photos`;
+					// the list already contains the info of every image
+					let fragment = document.createDocumentFragment();
 
-					for (let idx in imageList) {
-						let imageBox = await new Promise(resolve => {
-							createImageBox(imageList[idx], pagetype === 'profile', resolve);
-						});
+					imageList.forEach(info => {
+						fragment.appendChild(createImageBox(info, pagetype === 'profile'));
+					});
 
-						if (imageBox)
-							images.appendChild(imageBox);
+					images.appendChild(fragment);
 
-						headerLoader.style.width = `${(parseInt(idx)+1) * 100 / imageList.length}%`;
-					}
+					// keep the order chosen by the user, if any
+					if (imagesSortChosen)
+						sortImages();
 
-					imagesMessage.remove();
+					let lastImage = imageList[imageList.length - 1];
+					imagesCursor = `${lastImage.timestamp}-${lastImage.id}`;
 				}
-				else {
-					if (profileUploadInfo)
-						profileUploadInfo.innerHTML = `You haven't uploaded any photos yet`;
 
-					imagesMessage.innerText = 'Aw snap! No images to show!';
+				// a short page is the last one
+				// the 'index' page only has a single page
+				if (imageList.length < IMAGES_PAGE_SIZE || pagetype === 'index') {
+					imagesComplete = true;
+
+					if (images.children.length > 0)
+						imagesMessage.remove();
+					else
+						imagesMessage.innerText = 'Aw snap! No images to show!';
 				}
 
 				headerLoader.style.width = '100%';
@@ -103,148 +137,147 @@ function loadImages() {
 	xhr.send();
 }
 
-function createImageBox(id, viewingProfile, resolve) {
-	let xhr = new XMLHttpRequest();
-	xhr.open('GET', `/api/image/info/${id}`);
-
-	xhr.onreadystatechange = function() {
-		if (xhr.readyState === XMLHttpRequest.DONE) {
-			if (xhr.status === 200) {
-				// get the image info
-				let info = JSON.parse(xhr.responseText);
+function updateUploadInfo(delta) {
+	let profileUploadInfo = $('#numPhotos')[0];
 
-				// create a clone from our template
-				let imageTemplate = $('#image-box-template')[0];
-				let cloneTemplate = imageTemplate.content.cloneNode(true);
-
-				// start filling the template
-				let imageBox = cloneTemplate.querySelector('.image-box');
-				imageBox.setAttribute('data-id', id);
-				imageBox.setAttribute('data-timestamp', info.timestamp);
-				imageBox.setAttribute('data-likes', info.likes.length);
-				imageBox.setAttribute('data-views', info.views + (info.firstSeen ? 1 : 0));
-				imageBox.setAttribute('data-comments', info.comments.length);
+	if (!profileUploadInfo)
+		return;
 
-				let image = imageBox.querySelector('.image');
-				image.src = `/api/image/get/${id}`;
+	let numPhotos = parseInt(profileUploadInfo.getAttribute('data-uploads')) + (delta || 0);
+	profileUploadInfo.setAttribute('data-uploads', numPhotos);
 
-				let imageMeta = imageBox.querySelector('.image-meta'),
-					imageOwner = imageMeta.querySelector('.image-owner'),
-					imageTime = imageMeta.querySelector('.image-time');
+	if (numPhotos > 0)
+		profileUploadInfo.innerHTML = `You have uploaded ${numPhotos} photos`;
+	else
+		profileUploadInfo.innerHTML = `You haven't uploaded any photos yet`;
+}
 
-				if (!viewingProfile) {
-					imageOwner.innerHTML = info.owner;
-					imageOwner.setAttribute('title', info.owner);
-				}
+function createImageBox(info, viewingProfile) {
+	let id = info.id;
 
-				let time = fromTimestamp(info.timestamp);
-				imageTime.innerHTML = time;
-				imageTime.setAttribute('title', time);
+	// create a clone from our template
+	let imageTemplate = $('#image-box-template')[0];
+	let cloneTemplate = imageTemplate.content.cloneNode(true);
 
-				let imageDescription = imageBox.querySelector('.image-description');
-				imageDescription.innerHTML = info.description;
-				imageDescription.setAttribute('title', imageDescription.innerText);
+	// start filling the template
+	let imageBox = cloneTemplate.querySelector('.image-box');
+	imageBox.setAttribute('data-id', id);
+	imageBox.setAttribute('data-timestamp', info.timestamp);
+	imageBox.setAttribute('data-likes', info.likes.length);
+	imageBox.setAttribute('data-views', info.views + (info.firstSeen ? 1 : 0));
+	imageBox.setAttribute('data-comments', info.comments.length);
+
+	let image = imageBox.querySelector('.image');
+	image.src = `/api/image/get/${id}?size=thumb`;
+
+	let imageMeta = imageBox.querySelector('.image-meta'),
+		imageOwner = imageMeta.querySelector('.image-owner'),
+		imageTime = imageMeta.querySelector('.image-time');
+
+	if (!viewingProfile) {
+		imageOwner.innerHTML = info.owner;
+		imageOwner.setAttribute('title', info.owner);
+	}
 
-				let imageViewsContainer = imageBox.querySelector('.image-views-container'),
-					imageViews = imageViewsContainer.querySelector('.image-views'),
-					numViews = $('#numViews')[0];
+	let time = fromTimestamp(info.timestamp);
+	imageTime.innerHTML = time;
+	imageTime.setAttribute('title', time);
 
-				imageViews.innerHTML = info.views + (info.firstSeen ? 1 : 0);
-				imageViews.setAttribute('title', imageViews.innerText);
+	let imageDescription = imageBox.querySelector('.image-description');
+	imageDescription.innerHTML = info.description;
+	imageDescription.setAttribute('title', imageDescription.innerText);
 
-				if (numViews && info.firstSeen)
-					numViews.innerHTML = parseInt(numViews.innerHTML) + 1;
+	let imageViewsContainer = imageBox.querySelector('.image-views-container'),
+		imageViews = imageViewsContainer.querySelector('.image-views'),
+		numViews = $('#numViews')[0];
 
-				let imageCommentContainer = imageBox.querySelector('.image-comments-container'),
-					imageComments = imageCommentContainer.querySelector('.image-comments'),
-					imageCommentIcon = imageCommentContainer.querySelector('.icon-container');
+	imageViews.innerHTML = info.views + (info.firstSeen ? 1 : 0);
+	imageViews.setAttribute('title', imageViews.innerText);
 
-				imageComments.innerHTML = info.comments.length;
-				imageComments.setAttribute('title', info.comments.length);
+	if (numViews && info.firstSeen)
+		numViews.innerHTML = parseInt(numViews.innerHTML) + 1;
 
-				$(imageCommentIcon).on('click', () => {
-					imageBox.classList.toggle('commenting');
-				});
+	let imageCommentContainer = imageBox.querySelector('.image-comments-container'),
+		imageComments = imageCommentContainer.querySelector('.image-comments'),
+		imageCommentIcon = imageCommentContainer.querySelector('.icon-container');
 
-				let imageLikesContainer = imageBox.querySelector('.image-likes-container'),
-					imageLikes = imageLikesContainer.querySelector('.image-likes'),
-					imageLiked = info.likes.includes(getUsername());
+	imageComments.innerHTML = info.comments.length;
+	imageComments.setAttribute('title', info.comments.length);
 
-				imageLikes.innerHTML = info.likes.length;
-				imageLikes.setAttribute('title', info.likes.length);
+	$(imageCommentIcon).on('click', () => {
+		imageBox.classList.toggle('commenting');
+	});
 
-				let imageLikeIcon = imageLikesContainer.querySelector('.icon-container');
-				$(imageLikeIcon).on('click', () => {
-					likeImage(imageBox);
-				});
+	let imageLikesContainer = imageBox.querySelector('.image-likes-container'),
+		imageLikes = imageLikesContainer.querySelector('.image-likes'),
+		imageLiked = info.likes.includes(getUsername());
 
-				imageLikeIcon.setAttribute('data-liked', imageLiked);
+	imageLikes.innerHTML = info.likes.length;
+	imageLikes.setAttribute('title', info.likes.length);
 
-				if (imageLiked)
-					imageLikeIcon.classList.add('dislike');
+	let imageLikeIcon = imageLikesContainer.querySelector('.icon-container');
+	$(imageLikeIcon).on('click', () => {
+		likeImage(imageBox);
+	});
 
-				let commentForm = imageBox.querySelector('.comment-input-form');
-				$(commentForm).on('submit', (event) => {
-					// stop the form submission
-					event.preventDefault();
-					postComment(imageBox);
-				});
+	imageLikeIcon.setAttribute('data-liked', imageLiked);
 
-				let whoCommentedList = imageBox.querySelector('.who-commented-list');
+	if (imageLiked)
+		imageLikeIcon.classList.add('dislike');
 
-				// clear the list
-				whoCommentedList.innerHTML = '';
-				info.comments.forEach(commentObject => {
-					appendCommentInComments(commentObject, whoCommentedList);
-				});
+	let commentForm = imageBox.querySelector('.comment-input-form');
+	$(commentForm).on('submit', (event) => {
+		// stop the form submission
+		event.preventDefault();
+		postComment(imageBox);
+	});
 
-				let whoLikedList = imageBox.querySelector('.who-liked-list');
+	let whoCommentedList = imageBox.querySelector('.who-commented-list');
 
-				// clear the list
-				whoLikedList.innerHTML = '';
-				info.likes.forEach(username => {
-					appendUserInLikes(username, whoLikedList);
-				});
+	// clear the list
+	whoCommentedList.innerHTML = '';
+	info.comments.forEach(commentObject => {
+		appendCommentInComments(commentObject, whoCommentedList);
+	});
 
-				let imageNav = imageBox.querySelector('.image-navigation-container'),
-					downloadImageLink = imageNav.querySelector('.download'),
-					changeImageVisibilityIcon = imageNav.querySelector('.make-public'),
-					changeImageVisibilityIconImage = changeImageVisibilityIcon.querySelector('img'),
-					deleteImageIcon = imageNav.querySelector('.delete');
+	let whoLikedList = imageBox.querySelector('.who-liked-list');
 
-				downloadImageLink.href = `/api/image/get/${id}`;
+	// clear the list
+	whoLikedList.innerHTML = '';
+	info.likes.forEach(username => {
+		appendUserInLikes(username, whoLikedList);
+	});
 
-				let visibility = info.public ? 'public' : 'private';
+	let imageNav = imageBox.querySelector('.image-navigation-container'),
+		downloadImageLink = imageNav.querySelector('.download'),
+		changeImageVisibilityIcon = imageNav.querySelector('.make-public'),
+		changeImageVisibilityIconImage = changeImageVisibilityIcon.querySelector('img'),
+		deleteImageIcon = imageNav.querySelector('.delete');
 
-				imageBox.setAttribute('data-visibility', visibility);
-				changeImageVisibilityIconImage.src = `/static/icons/${visibility}.png`;
+	downloadImageLink.href = `/api/image/get/${id}`;
 
-				$(changeImageVisibilityIcon).on('click', () => {
-					makeImagePublic(imageBox);
-				});
+	let visibility = info.public ? 'public' : 'private';
 
-				$(deleteImageIcon).on('click', () => {
-					deleteImage(imageBox);
-				});
+	imageBox.setAttribute('data-visibility', visibility);
+	changeImageVisibilityIconImage.src = `/static/icons/${visibility}.png`;
 
-				image.onload = function() {
-					this.style.opacity = '1';
-				}
+	$(changeImageVisibilityIcon).on('click', () => {
+		makeImagePublic(imageBox);
+	});
 
-				$(imageBox).on('mouseleave', () => {
-					imageBox.classList.remove('commenting');
-				});
+	$(deleteImageIcon).on('click', () => {
+		deleteImage(imageBox);
+	});
 
-				resolve(imageBox);
-			}
-			else {
-				// we couldn't get any information for this image
-				resolve(null);
-			}
-		}
+	image.onload = function() {
+		this.style.opacity = '1';
 	}
 
-	xhr.send();
+	$(imageBox).on('mouseleave', () => {
+		imageBox.classList.remove('commenting');
+	});
+
+	return imageBox;
 }
 
 function totalViews() {
@@ -495,15 +528,8 @@ function deleteImage(imageBox) {
 				let images = $('#images')[0];
 				let pageType = images.getAttribute('data-pagetype');
 
-				if (pageType === 'profile') {
-					let profileUploadInfo = $('#numPhotos')[0],
-						numPhotos = images.children.length;
-
-					if (numPhotos > 0)
-						profileUploadInfo.innerHTML = `You have uploaded ${numPhotos} photos`;
-					else
-						profileUploadInfo.innerHTML = `You haven't uploaded any photos yet`;
-				}
+				if (pageType === 'profile')
+					updateUploadInfo(-1);
 			}
 			else
 			if (xhr.status === 403)
@@ -1,3 +1,7 @@
+// set once the user chooses an order, until then the images
+// keep the order of the server (e.g. most popular first)
+let imagesSortChosen = false;
+
 $(document).ready(() => {
 	function f(id) {
 		var listItems = $(`#${id} li`);
@@ -13,6 +17,7 @@ $(document).ready(() => {
 				item.classList.add('selected');
 				$(`#${id} button`)[0].value = item.getAttribute('data-value');
 
+				imagesSortChosen = true;
 				sortImages();
 			});
 		});
@@ -0,0 +1,253 @@
+# storage of the uploaded images
+# every image is stored under the hash of its content, so that
+# identical files (e.g. uploaded by several users, or twice by the
+# same one) are only stored once, along with their derivatives
+#
+# the image records referencing a file are its reference count,
+# see `file_references` of the database: a file is only removed
+# along with the last image stored in it
+#
+# the files (and avatars) are spread over two levels of
+# subdirectories named after their hash, e.g. 'ab/cd/abcd...png',
+# so that no directory grows too large to be looked up quickly
+# the files stored before are found at the top of the directory
+# until `python manage.py shard-uploads` moves them
+
+import os
+import re
+import tempfile
+from hashlib import sha256
+
+from PIL import Image
+
+import derivatives
+
+# bytes read at once from an upload
+CHUNK_SIZE = 64 * 1024
+
+# spellings of the same format, stored under one extension
+EXTENSIONS = {"jpeg": "jpg"}
+
+# name of a content-addressed file, before its extension
+DIGEST = re.compile(r"[0-9a-f]{64}")
+
+# first bytes of the accepted formats -> (extension, Pillow format)
+SIGNATURES = {
+    b"\xff\xd8\xff": ("jpg", "JPEG"),
+    b"\x89PNG\r\n\x1a\n": ("png", "PNG"),
+}
+
+
+class InvalidUpload(Exception):
+    """
+    Raised when an upload is not an image of an accepted format
+    """
+
+
+def sniff_format(header):
+    """
+    Return the (extension, Pillow format) of a file starting
+    with 'header', None if it is not of an accepted format
+    """
+
+    for signature, image_format in SIGNATURES.items():
+        if header.startswith(signature):
+            return image_format
+
+    return None
+
+
+def verify_image(filepath, image_format):
+    """
+    Check that 'filepath' is a well-formed image of 'image_format'
+    without decoding it, raise InvalidUpload otherwise
+    """
+
+    try:
+        with Image.open(filepath, formats=[image_format]) as image:
+            image.verify()
+    except (OSError, SyntaxError, ValueError, Image.DecompressionBombError):
+        raise InvalidUpload(filepath)
+
+
+def shard(filename):
+    """
+    Return the subdirectory 'filename' is stored in
+    e.g. 'abcd...png' -> 'ab/cd', the derivatives of
+    a file are stored along with it
+    """
+
+    stem = filename.split(".", 1)[0]
+
+    if not DIGEST.fullmatch(stem):
+        stem = sha256(stem.encode("utf-8")).hexdigest()
+
+    return os.path.join(stem[:2], stem[2:4])
+
+
+def upload_directory(directory, filename):
+    """
+    Return the directory 'filename' is stored in, created if needed
+    """
+
+    path = os.path.join(directory, shard(filename))
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def upload_path(directory, filename):
+    """
+    Return the path 'filename' is stored at, created if needed
+    """
+
+    return os.path.join(upload_directory(directory, filename), filename)
+
+
+def find_upload(directory, filename):
+    """
+    Return the path of the stored 'filename', None if there is none
+
+    a file not moved into its subdirectory yet is found at the top
+    of 'directory', it is looked up again in its subdirectory in
+    case it was moved meanwhile
+    """
+
+    sharded = os.path.join(directory, shard(filename), filename)
+    flat = os.path.join(directory, filename)
+
+    for path in (sharded, flat, sharded):
+        if os.path.isfile(path):
+            return path
+
+    return None
+
+
+def content_filename(digest, ext):
+    """
+    Return the filename of a file whose content hashes to 'digest'
+    e.g. ('9f86d0...', 'JPEG') -> '9f86d0....jpg'
+    """
+
+    ext = ext.lower()
+    return f"{digest}.{EXTENSIONS.get(ext, ext)}"
+
+
+def hash_file(filepath):
+    """
+    Return the SHA-256 hex digest of the content of 'filepath'
+    """
+
+    digest = sha256()
+
+    with open(filepath, "rb") as file:
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def receive_upload(stream, directory):
+    """
+    Write the image uploaded in 'stream' into a temporary file
+    of 'directory' and return its path and the filename the
+    content is stored under, see `store_upload`
+
+    the content is written in chunks and hashed along the way,
+    so that the upload is never held in memory, its format is
+    told by its first bytes (not by the name given by the client)
+    and checked by Pillow once written
+
+    raise InvalidUpload if it is not an image of an accepted
+    format, the temporary file is removed then
+    """
+
+    digest = sha256()
+    image_format = None
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+
+    try:
+        with os.fdopen(fd, "wb") as file:
+            for chunk in iter(lambda: stream.read(CHUNK_SIZE), b""):
+                if image_format is None:
+                    image_format = sniff_format(chunk)
+
+                    if image_format is None:
+                        raise InvalidUpload(temp_path)
+
+                digest.update(chunk)
+                file.write(chunk)
+
+        if image_format is None:
+            raise InvalidUpload(temp_path)
+
+        ext, pillow_format = image_format
+        verify_image(temp_path, pillow_format)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+    return temp_path, content_filename(digest.hexdigest(), ext)
+
+
+def store_upload(directory, temp_path, filename):
+    """
+    Move the received upload 'temp_path' to 'filename', or drop
+    it if the same content is already stored there
+    """
+
+    if find_upload(directory, filename):
+        os.remove(temp_path)
+    else:
+        os.replace(temp_path, upload_path(directory, filename))
+
+
+def remove_upload(directory, filename):
+    """
+    Remove the file 'filename' and its derivatives from 'directory'
+    only once no image references it anymore
+    """
+
+    sharded = os.path.join(directory, shard(filename))
+
+    # as in `find_upload`, in case the file is being moved
+    for folder in (sharded, directory, sharded):
+        filepath = os.path.join(folder, filename)
+
+        if os.path.isfile(filepath):
+            os.remove(filepath)
+
+        derivatives.remove_derivatives(folder, filename)
+
+
+def shard_uploads(directory):
+    """
+    Move the files at the top of 'directory' into their
+    subdirectory and return how many were moved
+
+    a file is always found at either place while it is
+    moved, so that it can run along with the web application
+    """
+
+    moved = 0
+
+    for entry in os.scandir(directory):
+        # the temporary files are still being written
+        if (
+            not entry.is_file()
+            or entry.name.startswith(".")
+            or entry.name.endswith((".tmp", ".upload"))
+        ):
+            continue
+
+        # never over a file in its subdirectory, it is the newer one
+        # e.g. an avatar changed since
+        try:
+            os.link(entry.path, upload_path(directory, entry.name))
+        except FileExistsError:
+            pass
+        else:
+            moved += 1
+
+        os.remove(entry.path)
+
+    return moved
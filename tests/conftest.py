@@ -0,0 +1,89 @@
+# fixtures of the tests, run with `python -m pytest` from the
+# root of the repository
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from database import open_database  # noqa: E402
+
+BACKENDS = {
+    "json": lambda directory: os.path.join(directory, "photostore.db"),
+    "sqlite": lambda directory: f"sqlite:///{directory}/photostore.sqlite3",
+    "shards": lambda directory: f"shards:///{directory}/photostore-shards",
+}
+
+
+@pytest.fixture(params=list(BACKENDS))
+def database_uri(request, tmp_path):
+    """
+    URI of a new database, of every backend in turn
+    """
+
+    return BACKENDS[request.param](tmp_path)
+
+
+@pytest.fixture
+def db(database_uri):
+    db = open_database(database_uri)
+    yield db
+    db.close()
+
+
+@pytest.fixture
+def app(database_uri, tmp_path):
+    """
+    The web application on a new database and uploads directory,
+    without CSRF and CAPTCHA checks
+    """
+
+    import app as photostore
+
+    upload_dir = tmp_path / "uploads"
+    upload_dir.mkdir()
+
+    config = dict(photostore.app.config)
+    photostore.app.config.update(
+        TESTING=True,
+        WTF_CSRF_ENABLED=False,
+        USE_CAPTCHA=False,
+        DATABASE=database_uri,
+        UPLOAD_DIR=str(upload_dir),
+    )
+
+    yield photostore
+
+    photostore.views.flush()
+    photostore.jobs.shutdown()
+    photostore.get_db().close()
+    photostore.app.config.clear()
+    photostore.app.config.update(config)
+
+
+def new_account(username):
+    return {
+        "username": username,
+        "passwd_hash": "x",
+        "avatar": None,
+        "timestamp": 0,
+        "uploads": 0,
+        "total_likes": 0,
+        "total_views": 0,
+    }
+
+
+def new_image(owner, timestamp, public=False, filename="image.png"):
+    return {
+        "filename": filename,
+        "owner": owner,
+        "timestamp": timestamp,
+        "public": public,
+        "description": "",
+        "likes": [],
+        "views": [],
+        "comments": [],
+        "derivatives": None,
+    }
@@ -0,0 +1,319 @@
+import io
+import os
+
+import jwt
+import pytest
+from PIL import Image
+
+import storage
+
+
+def png(color="red", size=(300, 200)):
+    buffer = io.BytesIO()
+    Image.new("RGB", size, color).save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def signup(client, username):
+    return client.post("/signup", data={
+        "username": username,
+        "password": "password1",
+        "confirm-password": "password1",
+    })
+
+
+def upload(client, data):
+    return client.post(
+        "/upload",
+        data={"fileToUpload": (io.BytesIO(data), "image.png")},
+        content_type="multipart/form-data",
+    )
+
+
+class Captcha:
+    """
+    Plain images in place of `captcha.image.ImageCaptcha`,
+    which needs an older Pillow
+    """
+
+    def __init__(self, size):
+        self.size = size
+
+    def generate_image(self, chars):
+        return Image.new("RGB", self.size, "white")
+
+
+@pytest.fixture
+def captcha(app, monkeypatch):
+    monkeypatch.setattr(
+        app, "captcha", Captcha(app.app.config["CAPTCHA_SIZE"])
+    )
+
+
+@pytest.fixture
+def client(app):
+    client = app.app.test_client()
+    assert signup(client, "alice").status_code == 302
+    return client
+
+
+@pytest.fixture
+def image(app, client):
+    """
+    (ID, content) of an image uploaded by alice,
+    once its resized copies are generated
+    """
+
+    data = png()
+    assert upload(client, data).status_code == 200
+
+    app.jobs.shutdown()
+
+    images = client.get("/api/image/list?pagetype=profile").get_json()
+    return images[0], data
+
+
+def test_signup_taken(app, client):
+    response = signup(app.app.test_client(), "alice")
+
+    assert response.status_code == 302
+    assert response.headers["Location"].endswith("/signup")
+
+
+def test_upload(app, client, image):
+    id, data = image
+
+    info = client.get(f"/api/image/info/{id}").get_json()
+    assert info["owner"] == "alice"
+    assert info["public"] is False
+
+    response = client.get(f"/api/image/get/{id}")
+    assert response.data == data
+    response.close()
+
+    app.views.flush()
+    assert app.get_db().get_image(id)["views"]
+
+    assert client.get("/api/image/list?pagetype=community").get_json() == []
+    client.post(
+        "/api/image/make_public", json={"id": id, "make_public": True}
+    )
+    assert client.get(
+        "/api/image/list?pagetype=community"
+    ).get_json() == [id]
+
+
+def test_list_pages(app, client):
+    for color in ("red", "green", "blue"):
+        assert upload(client, png(color)).status_code == 200
+
+    app.jobs.shutdown()
+
+    url = "/api/image/list?pagetype=profile&expand=info&limit=2"
+    page = client.get(url).get_json()
+    assert len(page) == 2
+
+    # the last page is a short one
+    cursor = f"{page[-1]['timestamp']}-{page[-1]['id']}"
+    last = client.get(f"{url}&after={cursor}").get_json()
+    assert len(last) == 1
+
+    ids = [info["id"] for info in page + last]
+    assert ids == sorted(ids, reverse=True)
+
+
+def test_conditional(client, image):
+    id, _ = image
+    url = f"/api/image/info/{id}"
+
+    response = client.get(url)
+    etag = response.headers["ETag"]
+    assert response.status_code == 200
+
+    response = client.get(url, headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.data == b""
+
+    client.post("/api/image/like", json={"id": id, "like": True})
+
+    response = client.get(url, headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    assert response.get_json()["likes"] == ["alice"]
+
+
+def test_avatar(app, client):
+    response = client.get("/avatar/alice")
+    assert response.status_code == 302
+    assert "defaultprofile" in response.headers["Location"]
+
+    data = png("blue", (300, 300))
+    client.post(
+        "/avatar",
+        data={"avatar": (io.BytesIO(data), "avatar.png")},
+        content_type="multipart/form-data",
+    )
+    app.jobs.shutdown()
+
+    response = client.get("/avatar/alice")
+    etag = response.headers["ETag"]
+    assert response.status_code == 200
+    response.close()
+
+    response = client.get("/avatar/alice", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+
+    # the avatar of the user logged in, through `avatar_username`
+    response = client.get("/avatar", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+
+
+def test_range(client, image):
+    id, data = image
+    url = f"/api/image/get/{id}"
+
+    response = client.get(url)
+    etag = response.headers["ETag"]
+    assert response.headers["Accept-Ranges"] == "bytes"
+    response.close()
+
+    response = client.get(url, headers={"Range": "bytes=0-9"})
+    assert response.status_code == 206
+    assert response.data == data[:10]
+    assert response.headers["Content-Range"] == f"bytes 0-9/{len(data)}"
+    response.close()
+
+    response = client.get(
+        url, headers={"Range": "bytes=10-", "If-Range": etag}
+    )
+    assert response.status_code == 206
+    assert response.data == data[10:]
+    response.close()
+
+    # changed since, the whole file
+    response = client.get(
+        url, headers={"Range": "bytes=10-", "If-Range": '"stale"'}
+    )
+    assert response.status_code == 200
+    assert response.data == data
+    response.close()
+
+    response = client.get(url, headers={"Range": f"bytes={len(data)}-"})
+    assert response.status_code == 416
+    response.close()
+
+    response = client.get(url, headers={"If-None-Match": etag})
+    assert response.status_code == 304
+
+
+def test_captcha_hmac(app, captcha):
+    value, _, _, token = app.generate_captcha()
+    assert "nonce" in jwt.decode(token, options={"verify_signature": False})
+
+    assert app.verify_captcha(value, token)["valid"]
+
+    # a token is only verified once, even with the right answer
+    assert not app.verify_captcha(value, token)["valid"]
+
+    value, _, _, token = app.generate_captcha()
+    assert not app.verify_captcha(value + "x", token)["valid"]
+    assert not app.verify_captcha(value, token)["valid"]
+
+
+def test_captcha_bcrypt(app, captcha):
+    # the tokens made before switching mode are still verified
+    app.app.config["CAPTCHA_MODE"] = "bcrypt"
+    value, _, _, token = app.generate_captcha()
+    app.app.config["CAPTCHA_MODE"] = "hmac"
+
+    assert not app.verify_captcha(value + "x", token)["valid"]
+    assert app.verify_captcha(value, token)["valid"]
+
+
+def test_captcha_image(app, captcha):
+    response = app.app.test_client().get("/api/captcha")
+    url = response.get_json()["url"]
+    assert url.endswith(".webp")
+
+    # served until the CAPTCHA expires, e.g. to a reload of the page
+    for _ in range(2):
+        response = app.app.test_client().get(url)
+        assert response.status_code == 200
+        assert response.mimetype == "image/webp"
+        assert Image.open(io.BytesIO(response.data)).format == "WEBP"
+
+    client = app.app.test_client()
+    assert client.get(url[:-len("webp")] + "png").status_code == 404
+    assert client.get("/api/captcha/unknown.webp").status_code == 404
+
+
+def test_jwt_cache(app, client):
+    token = app.encode_to_jwt({"username": "bob"})
+    app.jwt_cache.pop(token)
+    hits = app.jwt_cache.hits
+
+    assert app.decode_from_jwt(token) == {"username": "bob"}
+    assert app.decode_from_jwt(token) == {"username": "bob"}
+    assert app.jwt_cache.hits == hits + 1
+
+    # a copy, the cached claims are shared by the requests
+    app.decode_from_jwt(token)["username"] = "alice"
+    assert app.decode_from_jwt(token) == {"username": "bob"}
+
+    # the invalid tokens are not cached
+    forged = token[:-2] + ("AA" if token[-2:] != "AA" else "BB")
+    assert app.decode_from_jwt(forged) == {}
+    assert forged not in app.jwt_cache.entries
+
+    expired = app.encode_to_jwt({"username": "bob", "exp": 1})
+    assert app.decode_from_jwt(expired) == {}
+
+
+def test_jwt_cache_password_reset(app, client):
+    token = next(
+        cookie.value for cookie in client.cookie_jar if cookie.name == "jwt"
+    )
+    assert client.get("/profile").status_code == 200
+    assert token in app.jwt_cache.entries
+
+    # every token of the user is verified again
+    client.post("/reset-password", data={
+        "current-password": "password1",
+        "new-password": "password2",
+        "confirm-new-password": "password2",
+    })
+    assert token not in app.jwt_cache.entries
+
+
+def test_unsharded_upload(app, client, image):
+    id, data = image
+    upload_dir = app.app.config["UPLOAD_DIR"]
+    filename = app.get_db().get_image(id)["filename"]
+
+    # served from the top of the uploads directory until moved
+    os.replace(
+        storage.find_upload(upload_dir, filename),
+        os.path.join(upload_dir, filename),
+    )
+
+    response = client.get(f"/api/image/get/{id}")
+    assert response.data == data
+    response.close()
+
+    storage.shard_uploads(upload_dir)
+
+    response = client.get(f"/api/image/get/{id}")
+    assert response.data == data
+    response.close()
+
+
+def test_invalid_upload(app, client):
+    # named as an image, whatever its content
+    response = upload(client, b"<?php echo 1; ?>")
+    assert response.status_code == 302
+
+    with client.session_transaction() as session:
+        assert ("error", "Unsupported image!") in session["_flashes"]
+
+    assert client.get("/api/image/list?pagetype=profile").get_json() == []
+    assert os.listdir(app.app.config["UPLOAD_DIR"]) == []
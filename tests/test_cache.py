@@ -0,0 +1,56 @@
+import time
+
+from cache import LRUCache
+
+
+def test_lru_cache():
+    cache = LRUCache(max_size=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+
+    # the least recently used is forgotten
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+
+    assert cache.get("a", valid=lambda value: value > 1) is None
+    assert cache.get("a", "missing") == "missing"
+
+    assert cache.stats() == {
+        "size": 1,
+        "max_size": 2,
+        "hits": 3,
+        "misses": 3,
+        "evictions": 1,
+        "hit_rate": 0.5,
+    }
+
+
+def test_lru_cache_expiry():
+    cache = LRUCache(ttl=60)
+
+    # at the expiry given, if before the TTL
+    cache.put("a", 1, expiry=time.time() - 1)
+    cache.put("b", 2, expiry=time.time() + 3600)
+    assert cache.get("a") is None
+    assert cache.entries["b"][0] <= time.time() + 60
+
+    cache.ttl = -1
+    cache.put("c", 3)
+    assert cache.get("c") is None
+
+
+def test_lru_cache_remove():
+    cache = LRUCache()
+
+    for key, user in [("a", "alice"), ("b", "bob"), ("c", "alice")]:
+        cache.put(key, {"username": user})
+
+    cache.remove_matching(lambda claims: claims["username"] == "alice")
+    assert list(cache.entries) == ["b"]
+
+    cache.pop("b")
+    cache.pop("b")
+    assert cache.get("b") is None
@@ -0,0 +1,150 @@
+import itertools
+import time
+from threading import current_thread
+
+import pytest
+
+from captchas import (
+    CaptchaPool, ExpiringStore, FileNonceStore, FileStore, NonceStore
+)
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_pool_refills():
+    made = itertools.count()
+    pool = CaptchaPool(lambda: next(made), size=4, low_watermark=2)
+
+    assert pool.pop() == 0
+    wait_until(lambda: len(pool.captchas) == 4)
+
+    # served out of the pool, newest first
+    assert pool.pop() == 4
+
+    pool.close()
+
+
+def test_pool_replaces_expired():
+    made = itertools.count()
+    pool = CaptchaPool(
+        lambda: next(made), size=3, low_watermark=1, max_age=0.2
+    )
+
+    pool.pop()
+    wait_until(lambda: len(pool.captchas) == 3)
+    first = list(pool.captchas)
+
+    # still full after an idle period, of fresh CAPTCHAs
+    time.sleep(0.5)
+
+    with pool.ready:
+        assert len(pool.captchas) == 3
+        assert all(
+            time.monotonic() - made_at < 0.2
+            for made_at, _ in pool.captchas
+        )
+        assert not set(pool.captchas) & set(first)
+
+    pool.close()
+
+
+def test_pool_retries_with_backoff():
+    attempts = []
+
+    def generate():
+        # the CAPTCHA made inline by `pop` succeeds
+        if current_thread().name != "captcha-pool":
+            return "captcha"
+
+        attempts.append(time.monotonic())
+        raise OSError("no fonts")
+
+    pool = CaptchaPool(generate, retry_delay=0.05, max_retry_delay=0.2)
+    assert pool.pop() == "captcha"
+
+    time.sleep(0.6)
+    pool.close()
+
+    # after 0, 0.05, 0.15, 0.35, 0.55 seconds
+    delays = [b - a for a, b in zip(attempts, attempts[1:])]
+    assert 3 <= len(delays) <= 5
+    assert delays[1] > delays[0] * 1.5
+    assert max(delays) < 0.3
+
+
+def test_nonces():
+    nonces = NonceStore()
+
+    assert nonces.use("a", time.time() + 60)
+    assert not nonces.use("a", time.time() + 60)
+
+    # forgotten once the token expired
+    assert nonces.use("b", time.time() - 1)
+    assert nonces.use("b", time.time() + 60)
+
+
+def test_file_nonces(tmp_path):
+    # shared by the processes using the same directory
+    nonces = FileNonceStore(str(tmp_path))
+    other = FileNonceStore(str(tmp_path))
+
+    assert nonces.use("a", time.time() + 60)
+    assert not other.use("a", time.time() + 60)
+    assert not nonces.use("a", time.time() + 60)
+
+    # the expired nonces are removed on the next cleanup
+    assert other.use("b", time.time() - 1)
+    cleaning = FileNonceStore(str(tmp_path), cleanup_interval=0)
+    assert cleaning.use("c", time.time() + 60)
+
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["a", "c"]
+
+
+def test_expiring_store():
+    store = ExpiringStore(max_size=2)
+
+    assert store.add("a", b"a", time.time() + 60)
+    assert not store.add("a", b"b", time.time() + 60)
+    assert store.get("a") == b"a"
+
+    assert store.add("b", b"b", time.time() - 1)
+    assert store.get("b") is None
+
+    # past 'max_size', the ones expiring first are forgotten
+    assert store.add("c", b"c", time.time() + 30)
+    assert store.add("d", b"d", time.time() + 90)
+    assert store.get("c") is None
+    assert store.get("a") == b"a"
+
+    assert store.pop("a") == b"a"
+    assert store.pop("a") is None
+    assert store.values.keys() == {"d"}
+
+
+def test_file_store(tmp_path):
+    # shared by the processes using the same directory
+    store = FileStore(str(tmp_path))
+    other = FileStore(str(tmp_path))
+
+    assert store.add("a", b"a", time.time() + 60)
+    assert not other.add("a", b"b", time.time() + 60)
+    assert other.get("a") == b"a"
+
+    assert store.add("b", b"b", time.time() - 1)
+    assert other.get("b") is None
+    assert other.pop("b") is None
+
+    assert other.pop("a") == b"a"
+    assert store.get("a") is None
+
+    assert store.get("../a") is None
+    with pytest.raises(ValueError):
+        store.add("../a", b"a", time.time() + 60)
+
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,260 @@
+import sqlite3
+import time
+
+import pytest
+
+from conftest import new_account, new_image
+from database import (
+    SQLITE_MIGRATIONS,
+    SQLITE_SCHEMA,
+    SQLiteDatabase,
+    ViewBuffer,
+    open_database,
+)
+
+
+def test_accounts(db):
+    assert db.get_account("alice") is None
+    assert db.add_account(new_account("alice")) is not None
+    assert db.add_account(new_account("alice")) is None
+
+    db.update_account("alice", {"avatar": "avatar.png"})
+
+    assert db.get_account("alice")["avatar"] == "avatar.png"
+    assert db.account_totals("alice") == (0, 0)
+
+
+def test_images(db):
+    db.add_account(new_account("alice"))
+    db.add_account(new_account("bob"))
+
+    ids = [
+        db.add_image(new_image("alice", timestamp))
+        for timestamp in (1, 2, 3)
+    ]
+
+    assert db.get_account("alice")["uploads"] == 3
+    assert [image["id"] for image in db.list_images("alice")] == ids[::-1]
+    assert db.list_images() == []
+
+    # newest first, paginated by the (timestamp, id) cursor
+    page = db.list_images("alice", limit=2)
+    assert [image["id"] for image in page] == [ids[2], ids[1]]
+
+    after = (page[-1]["timestamp"], page[-1]["id"])
+    page = db.list_images("alice", limit=2, after=after)
+    assert [image["id"] for image in page] == [ids[0]]
+
+    db.set_image_public(ids[0], True)
+    db.set_image_public(ids[1], True)
+
+    assert [image["id"] for image in db.list_images()] == [ids[1], ids[0]]
+    assert db.get_image(ids[0])["public"] is True
+
+    assert "bob" in db.set_image_like(ids[0], "bob", True)
+    assert db.add_image_views({ids[0]: ["alice", "bob"]}) == 2
+    assert db.add_image_views({ids[0]: ["bob"]}) == 0
+    assert db.account_totals("alice") == (1, 2)
+
+    image = db.get_image(ids[0])
+    assert sorted(image["views"]) == ["alice", "bob"]
+    assert list(image["likes"]) == ["bob"]
+
+    assert [image["id"] for image in db.popular_images(1)] == [ids[0]]
+    assert db.popular_images(0) == []
+
+    assert "bob" not in db.set_image_like(ids[0], "bob", False)
+    assert db.account_totals("alice") == (0, 2)
+
+    comment = {"username": "bob", "comment": "nice", "timestamp": 4}
+    assert db.add_image_comment(ids[0], comment) == [comment]
+    assert db.get_image(ids[0])["comments"] == [comment]
+
+    assert db.file_references("image.png") == 3
+    assert db.remove_image(ids[0])
+    assert not db.remove_image(ids[0])
+    assert db.get_image(ids[0]) is None
+    assert db.file_references("image.png") == 2
+    assert db.get_account("alice")["uploads"] == 2
+    assert db.account_totals("alice") == (0, 0)
+    assert [image["id"] for image in db.list_images()] == [ids[1]]
+
+
+def test_view_buffer(db):
+    db.add_account(new_account("alice"))
+    db.add_account(new_account("bob"))
+    id = db.add_image(new_image("alice", 1))
+    batches = []
+
+    def write(views):
+        batches.append(views)
+        return db.add_image_views(views)
+
+    views = ViewBuffer(write, max_pending=3, interval=60)
+
+    # deduplicated in memory, counted once flushed
+    views.add(id, "alice")
+    views.add(id, "alice")
+    views.add(id, "bob")
+    assert views.size == 2
+    assert len(db.get_image(id)["views"]) == 0
+
+    views.flush()
+    assert batches == [{id: {"alice", "bob"}}]
+    assert sorted(db.get_image(id)["views"]) == ["alice", "bob"]
+    assert db.account_totals("alice") == (0, 2)
+
+    views.flush()
+    assert len(batches) == 1
+
+    # written early once 'max_pending' views are waiting
+    for username in ("carol", "dave", "erin"):
+        views.add(id, username)
+
+    deadline = time.monotonic() + 5
+
+    while len(batches) < 2:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+    assert batches[1] == {id: {"carol", "dave", "erin"}}
+
+
+def test_view_buffer_failed_write():
+    batches = []
+
+    def write(views):
+        batches.append(views)
+
+        if len(batches) == 1:
+            raise OSError("disk full")
+
+    views = ViewBuffer(write, interval=60)
+    views.add(1, "alice")
+    views.flush()
+
+    # kept for the next flush, with the views added meanwhile
+    views.add(1, "bob")
+    views.add(2, "alice")
+    assert views.size == 3
+
+    views.flush()
+    assert batches[1] == {1: {"alice", "bob"}, 2: {"alice"}}
+    assert views.pending == {}
+
+
+def test_derivatives(db):
+    db.add_account(new_account("alice"))
+    id = db.add_image(new_image("alice", 1))
+
+    assert [image["id"] for image in db.images_missing_derivatives()] == [id]
+    assert db.set_image_derivatives(id, ["image.640.webp"])
+    assert db.get_image(id)["derivatives"] == ["image.640.webp"]
+    assert db.images_missing_derivatives() == []
+
+    db.remove_image(id)
+    assert not db.set_image_derivatives(id, [])
+
+
+def test_sqlite_migrations(tmp_path):
+    path = tmp_path / "photostore.sqlite3"
+
+    # a database made before any migration
+    connection = sqlite3.connect(path)
+    connection.executescript(SQLITE_SCHEMA)
+    connection.executescript(
+        """
+        INSERT INTO accounts (username, passwd_hash, timestamp, uploads)
+        VALUES ('alice', 'x', 0, 1), ('bob', 'x', 0, 0);
+        INSERT INTO images (filename, owner_id, timestamp, public)
+        VALUES ('image.png', 1, 1, 1);
+        INSERT INTO likes VALUES (1, 2);
+        INSERT INTO views VALUES (1, 1), (1, 2);
+        """
+    )
+    connection.close()
+
+    db = SQLiteDatabase(f"sqlite:///{path}")
+    connection = db.connect()
+
+    assert connection.execute("PRAGMA user_version").fetchone()[0] == len(
+        SQLITE_MIGRATIONS
+    )
+    assert db.account_totals("alice") == (1, 2)
+    assert connection.execute("SELECT score FROM images").fetchone()[0] == 3
+    assert db.get_image(1)["derivatives"] is None
+    assert [image["id"] for image in db.popular_images(10)] == [1]
+    assert connection.execute(
+        "SELECT COUNT(*) FROM versions_epoch"
+    ).fetchone()[0] == 1
+
+    db.close()
+
+    # already migrated
+    db = SQLiteDatabase(f"sqlite:///{path}")
+    assert db.account_totals("alice") == (1, 2)
+    db.close()
+
+
+def test_sqlite_shared_versions(tmp_path, monkeypatch):
+    uri = f"sqlite:///{tmp_path}/photostore.sqlite3"
+    writer = SQLiteDatabase(uri, shared=True)
+    reader = SQLiteDatabase(uri, shared=True)
+
+    writer.add_account(new_account("alice"))
+    etag = reader.versions.etag([("user", "alice")])
+    writes = writer.lock_stats()["write"]["acquired"]
+
+    def crash(keys, seq):
+        raise RuntimeError("stopped once the change is committed")
+
+    monkeypatch.setattr(writer.versions, "apply", crash)
+
+    with pytest.raises(RuntimeError):
+        writer.update_account("alice", {"avatar": "avatar.png"})
+
+    # bumped in the transaction of the change
+    assert writer.lock_stats()["write"]["acquired"] == writes + 1
+    assert reader.get_account("alice")["avatar"] == "avatar.png"
+    assert reader.versions.etag([("user", "alice")]) != etag
+
+    writer.close()
+    reader.close()
+
+
+def test_sharded_shared_versions(tmp_path):
+    uri = f"shards:///{tmp_path}/photostore-shards"
+    writer = open_database(uri, shared=True)
+    reader = open_database(uri, shared=True)
+
+    for username in ("alice", "bob"):
+        writer.add_account(new_account(username))
+
+    ids = [
+        writer.add_image(new_image(owner, 1, public=True))
+        for owner in ("alice", "alice", "bob")
+    ]
+    keys = {id: [("image", id), ("file", id)] for id in ids}
+
+    def etags(db):
+        return {id: db.versions.etag(keys[id]) for id in ids}
+
+    before = etags(reader)
+    assert etags(writer) == before
+
+    # the other images of the shard are not changed
+    writer.add_image_views({ids[0]: ["bob"]})
+    after = etags(reader)
+
+    assert after[ids[0]] != before[ids[0]]
+    assert after[ids[1]] == before[ids[1]]
+    assert after[ids[2]] == before[ids[2]]
+    assert etags(writer) == after
+    assert list(reader.get_image(ids[0])["views"]) == ["bob"]
+
+    # read back from the files
+    reopened = open_database(uri, shared=True)
+    assert etags(reopened) == after
+
+    for db in (writer, reader, reopened):
+        db.close()
@@ -0,0 +1,129 @@
+import multiprocessing
+import time
+from threading import Barrier, Thread
+
+import pytest
+
+import locks
+from locks import FileLock, RWLock
+
+
+def start(target):
+    thread = Thread(target=target, daemon=True)
+    thread.start()
+    return thread
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_rwlock_readers():
+    lock = RWLock()
+    # every reader holds the lock while the others take it
+    barrier = Barrier(3, timeout=5)
+
+    def read():
+        with lock.read():
+            barrier.wait()
+
+    threads = [start(read) for _ in range(3)]
+
+    for thread in threads:
+        thread.join()
+
+    assert lock.stats()["read"]["acquired"] == 3
+    assert lock.stats()["write"]["acquired"] == 0
+
+
+def test_rwlock_writer_preferred():
+    lock = RWLock()
+    events = []
+
+    def write():
+        with lock.write():
+            events.append("write")
+
+    def read():
+        with lock.read():
+            events.append("read")
+
+    with lock.read():
+        writer = start(write)
+        wait_until(lambda: lock.waiting_writers == 1)
+
+        # the new readers wait behind the writer
+        reader = start(read)
+        time.sleep(0.1)
+        assert events == []
+
+    writer.join(5)
+    reader.join(5)
+    assert events == ["write", "read"]
+
+    stats = lock.stats()["write"]
+    assert stats["acquired"] == 1
+    assert stats["wait_max_ms"] >= 100
+
+
+def test_file_lock(tmp_path):
+    path = str(tmp_path / "lock")
+    # as opened by two processes
+    lock, other = FileLock(path), FileLock(path)
+    events = []
+
+    def hold():
+        with other.hold():
+            events.append("other")
+            other.bump()
+
+    with lock.hold():
+        assert lock.generation() == 0
+        assert lock.bump() == 1
+
+        holder = start(hold)
+        time.sleep(0.1)
+
+        if locks.fcntl is not None:
+            assert events == []
+
+    holder.join(5)
+    assert events == ["other"]
+    assert lock.generation() == other.generation() == 2
+    assert lock.stats()["acquired"] == other.stats()["acquired"] == 1
+
+    lock.close()
+    other.close()
+
+    # kept in the file, e.g. for the workers started later
+    assert FileLock(path).generation() == 2
+
+
+@pytest.mark.skipif(locks.fcntl is None, reason="no fcntl on this platform")
+def test_file_lock_processes(tmp_path):
+    path = str(tmp_path / "lock")
+    lock = FileLock(path)
+
+    with lock.hold():
+        child = multiprocessing.get_context("fork").Process(
+            target=bump, args=(path,)
+        )
+        child.start()
+        time.sleep(0.2)
+        assert lock.generation() == 0
+
+    child.join(5)
+    assert child.exitcode == 0
+    assert lock.generation() == 1
+    lock.close()
+
+
+def bump(path):
+    lock = FileLock(path)
+
+    with lock.hold():
+        lock.bump()
@@ -0,0 +1,262 @@
+import json
+import os
+
+import pytest
+from PIL import Image
+
+import derivatives
+import manage
+import storage
+from conftest import new_account, new_image
+from database import open_database
+
+
+def uploaded_files(directory):
+    return sorted(
+        os.path.relpath(os.path.join(root, name), directory)
+        for root, _, names in os.walk(directory)
+        for name in names
+    )
+
+
+@pytest.fixture
+def legacy_db(tmp_path):
+    """
+    Path of a TinyDB (JSON) database as written before the account IDs,
+    the likes and views are usernames
+    """
+
+    path = tmp_path / "photostore.db"
+    comment = {"username": "bob", "comment": "nice", "timestamp": 3}
+    images = {
+        "3": dict(
+            new_image("alice", 1, public=True),
+            likes=["bob"],
+            views=["alice", "bob", "carol"],
+            comments=[comment],
+        ),
+        "5": new_image("bob", 2),
+        # of an account removed since
+        "6": new_image("carol", 3),
+    }
+    path.write_text(json.dumps({
+        "accounts": {
+            "1": new_account("alice"),
+            "2": new_account("bob"),
+        },
+        "images": images,
+    }))
+
+    return str(path)
+
+
+def check_migrated(db):
+    # the IDs are kept, so are the image URLs
+    image = db.get_image(3)
+    assert image["owner"] == "alice"
+    assert list(image["likes"]) == ["bob"]
+    assert sorted(image["views"]) == ["alice", "bob"]
+    assert image["comments"][0]["comment"] == "nice"
+
+    assert db.get_image(5)["owner"] == "bob"
+    assert db.get_image(6) is None
+
+    assert [image["id"] for image in db.list_images()] == [3]
+    assert db.account_totals("alice") == (1, 2)
+
+    # the new IDs follow the copied ones
+    assert db.add_image(new_image("bob", 4)) > 5
+
+
+@pytest.fixture
+def upload_dir(tmp_path):
+    directory = tmp_path / "uploads"
+    directory.mkdir()
+    return str(directory)
+
+
+def test_dedup_uploads(database_uri, upload_dir):
+    # identical legacy uploads, named after their owner
+    legacy = ["alice-aaa.jpeg", "alice-bbb.JPG"]
+    db = open_database(database_uri)
+    db.add_account(new_account("alice"))
+
+    for timestamp, filename in enumerate(legacy):
+        Image.new("RGB", (700, 700), "red").save(
+            os.path.join(upload_dir, filename), "JPEG"
+        )
+        image = new_image("alice", timestamp, filename=filename)
+        image["derivatives"] = derivatives.generate_derivatives(
+            upload_dir, filename
+        )
+        db.add_image(image)
+
+    db.close()
+
+    assert manage.main([
+        "dedup-uploads", "--database", database_uri,
+        "--upload-dir", upload_dir,
+    ]) == 0
+
+    db = open_database(database_uri)
+    images = db.list_images("alice")
+    content = images[0]["filename"]
+
+    assert content.endswith(".jpg")
+    assert [image["filename"] for image in images] == [content, content]
+
+    # the names looked up when serving and removing the file
+    expected = [
+        derivatives.derivative_filename(content, "thumb"),
+        derivatives.derivative_filename(content, "thumb", "webp"),
+    ]
+
+    for image in images:
+        assert image["derivatives"] == expected
+
+    shard = storage.shard(content)
+    assert uploaded_files(upload_dir) == sorted(
+        os.path.join(shard, filename) for filename in [content, *expected]
+    )
+
+    for image in images:
+        db.remove_image(image["id"])
+
+    db.close()
+    storage.remove_upload(upload_dir, content)
+
+    assert uploaded_files(upload_dir) == []
+
+
+def test_dedup_uploads_renames_derivatives(database_uri, upload_dir):
+    # moved into its content file with the '.jpeg' derivatives it had
+    Image.new("RGB", (700, 700), "red").save(
+        os.path.join(upload_dir, "alice-aaa.jpeg"), "JPEG"
+    )
+    content = storage.content_filename(
+        storage.hash_file(os.path.join(upload_dir, "alice-aaa.jpeg")), "jpg"
+    )
+    os.replace(
+        os.path.join(upload_dir, "alice-aaa.jpeg"),
+        storage.upload_path(upload_dir, content),
+    )
+
+    shard = os.path.join(upload_dir, storage.shard(content))
+    legacy = [
+        derivatives.derivative_filename(content, "thumb", "jpeg"),
+        derivatives.derivative_filename(content, "thumb", "webp"),
+    ]
+
+    for derivative in legacy:
+        Image.new("RGB", (600, 600), "red").save(
+            os.path.join(shard, derivative)
+        )
+
+    db = open_database(database_uri)
+    db.add_account(new_account("alice"))
+    image = new_image("alice", 0, filename=content)
+    image["derivatives"] = legacy
+    id = db.add_image(image)
+    db.close()
+
+    args = [
+        "dedup-uploads", "--database", database_uri,
+        "--upload-dir", upload_dir,
+    ]
+    assert manage.main(args) == 0
+    assert manage.main(args) == 0
+
+    expected = [
+        derivatives.derivative_filename(content, "thumb"),
+        derivatives.derivative_filename(content, "thumb", "webp"),
+    ]
+
+    db = open_database(database_uri)
+    assert db.get_image(id)["derivatives"] == expected
+    db.close()
+
+    assert uploaded_files(upload_dir) == sorted(
+        os.path.join(storage.shard(content), filename)
+        for filename in [content, *expected]
+    )
+
+
+def test_shard_uploads(upload_dir):
+    for filename in ("alice-aaa.png", "avatar-alice.png"):
+        with open(os.path.join(upload_dir, filename), "wb") as file:
+            file.write(filename.encode())
+
+    assert manage.main(["shard-uploads", "--upload-dir", upload_dir]) == 0
+
+    assert uploaded_files(upload_dir) == sorted(
+        os.path.join(storage.shard(filename), filename)
+        for filename in ("alice-aaa.png", "avatar-alice.png")
+    )
+
+
+def test_recompute_totals(database_uri):
+    db = open_database(database_uri)
+
+    for username in ("alice", "bob"):
+        db.add_account(new_account(username))
+
+    id = db.add_image(new_image("alice", 0))
+    db.set_image_like(id, "bob", True)
+    db.add_image_views({id: ["alice", "bob"]})
+
+    # e.g. restored from an old backup
+    db.update_account("alice", {"total_likes": 5, "total_views": 0})
+    assert db.account_totals("alice") == (5, 0)
+    db.close()
+
+    assert manage.main([
+        "recompute-totals", "--database", database_uri,
+    ]) == 0
+
+    db = open_database(database_uri)
+    assert db.account_totals("alice") == (1, 2)
+    assert db.account_totals("bob") == (0, 0)
+    db.close()
+
+
+def test_migrate_sqlite(tmp_path, legacy_db):
+    destination = str(tmp_path / "photostore.sqlite3")
+
+    assert manage.main(["migrate-sqlite", legacy_db, destination]) == 0
+
+    db = open_database(f"sqlite:///{destination}")
+    check_migrated(db)
+    db.close()
+
+    # never over an existing database
+    assert manage.main(["migrate-sqlite", legacy_db, destination]) == 1
+
+
+def test_reshard(tmp_path, legacy_db):
+    destination = f"shards:///{tmp_path}/photostore-shards"
+
+    assert manage.main([
+        "reshard", legacy_db, destination, "--shards", "2",
+    ]) == 0
+
+    db = open_database(destination)
+    check_migrated(db)
+    db.close()
+
+    # never over an existing database
+    assert manage.main(["reshard", legacy_db, destination]) == 1
+
+    # into more shards, with the image added since
+    resharded = f"shards:///{tmp_path}/resharded"
+
+    assert manage.main([
+        "reshard", destination, resharded, "--shards", "5",
+    ]) == 0
+
+    db = open_database(resharded)
+    assert len(db.shards) == 5
+    assert db.get_image(3)["owner"] == "alice"
+    assert len(db.list_images("bob")) == 2
+    assert db.get_image(5)["owner"] == "bob"
+    assert db.account_totals("alice") == (1, 2)
+    db.close()
@@ -0,0 +1,95 @@
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+
+import pytest
+
+SERVER = os.path.join(os.path.dirname(os.path.dirname(__file__)), "server.py")
+
+pytestmark = pytest.mark.skipif(
+    not hasattr(signal, "SIGHUP"), reason="no prefork mode on this platform"
+)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+def workers(server):
+    output = subprocess.run(
+        ["ps", "-o", "pid=", "--ppid", str(server.pid)],
+        capture_output=True,
+        text=True,
+    ).stdout
+    return sorted(int(pid) for pid in output.split())
+
+
+def wait_until(condition, timeout=30):
+    deadline = time.monotonic() + timeout
+
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.1)
+
+
+@pytest.fixture
+def server(tmp_path):
+    """
+    (server process, URL) of './server.py' running 2 workers,
+    with its database in a temporary directory
+    """
+
+    port = free_port()
+    process = subprocess.Popen(
+        [sys.executable, SERVER, "--workers", "2", "--port", str(port)],
+        cwd=tmp_path,
+    )
+
+    yield process, f"http://localhost:{port}"
+
+    if process.poll() is None:
+        process.kill()
+        process.wait()
+
+
+def get(url):
+    try:
+        with urllib.request.urlopen(url, timeout=10) as response:
+            return response.status
+    except OSError:
+        return None
+
+
+def test_prefork(server):
+    process, url = server
+    url = f"{url}/api/image/list?pagetype=community"
+
+    wait_until(lambda: get(url) == 200)
+    started = workers(process)
+    assert len(started) == 2
+
+    # replaced gracefully, the requests keep being served
+    process.send_signal(signal.SIGHUP)
+    deadline = time.monotonic() + 5
+
+    while time.monotonic() < deadline:
+        assert get(url) == 200
+
+    wait_until(lambda: len(workers(process)) == 2)
+    assert not set(workers(process)) & set(started)
+
+    # a worker which dies is replaced
+    killed = workers(process)[0]
+    os.kill(killed, signal.SIGKILL)
+    wait_until(lambda: killed not in workers(process))
+    wait_until(lambda: len(workers(process)) == 2)
+    assert get(url) == 200
+
+    process.send_signal(signal.SIGTERM)
+    assert process.wait(timeout=60) == 0
@@ -0,0 +1,90 @@
+import io
+import os
+from hashlib import sha256
+
+import pytest
+from PIL import Image
+
+import storage
+
+
+def test_shard():
+    digest = "ab" * 32
+
+    assert storage.shard(f"{digest}.png") == os.path.join("ab", "ab")
+    assert storage.shard(f"{digest}.thumb.webp") == os.path.join("ab", "ab")
+
+    # the legacy names are spread by their hash
+    assert storage.shard("alice-aaa.png") == storage.shard("alice-aaa.webp")
+    assert storage.shard("alice-aaa.png") != storage.shard("alice-bbb.png")
+
+
+def test_shard_uploads(tmp_path):
+    directory = str(tmp_path)
+
+    for filename in ("alice-aaa.png", "alice-bbb.png", "upload.tmp"):
+        (tmp_path / filename).write_bytes(filename.encode())
+
+    # found at the top of the directory, until moved
+    assert storage.find_upload(directory, "alice-aaa.png") == os.path.join(
+        directory, "alice-aaa.png"
+    )
+
+    # never over the newer file of its subdirectory
+    with open(storage.upload_path(directory, "alice-bbb.png"), "wb") as file:
+        file.write(b"newer")
+
+    assert storage.shard_uploads(directory) == 1
+    assert storage.shard_uploads(directory) == 0
+    assert [
+        entry.name for entry in os.scandir(directory) if entry.is_file()
+    ] == ["upload.tmp"]
+
+    path = storage.find_upload(directory, "alice-aaa.png")
+    assert path == storage.upload_path(directory, "alice-aaa.png")
+
+    with open(storage.find_upload(directory, "alice-bbb.png"), "rb") as file:
+        assert file.read() == b"newer"
+
+    assert storage.find_upload(directory, "alice-ccc.png") is None
+
+    storage.remove_upload(directory, "alice-aaa.png")
+    assert storage.find_upload(directory, "alice-aaa.png") is None
+
+
+def image_bytes(image_format):
+    buffer = io.BytesIO()
+    Image.new("RGB", (64, 64), "red").save(buffer, image_format)
+    return buffer.getvalue()
+
+
+@pytest.mark.parametrize(
+    "image_format, ext", [("PNG", "png"), ("JPEG", "jpg")]
+)
+def test_receive_upload(tmp_path, image_format, ext):
+    data = image_bytes(image_format)
+    # read in several chunks
+    stream = io.BufferedReader(io.BytesIO(data), buffer_size=16)
+
+    temp_path, filename = storage.receive_upload(stream, str(tmp_path))
+
+    assert filename == f"{sha256(data).hexdigest()}.{ext}"
+
+    with open(temp_path, "rb") as file:
+        assert file.read() == data
+
+
+@pytest.mark.parametrize("data", [
+    b"",
+    b"GIF89a",
+    b"<?php echo 1; ?>",
+    # an accepted signature, not followed by an image
+    b"\x89PNG\r\n\x1a\n" + b"\0" * 64,
+    image_bytes("PNG")[:100],
+])
+def test_receive_invalid_upload(tmp_path, data):
+    with pytest.raises(storage.InvalidUpload):
+        storage.receive_upload(io.BytesIO(data), str(tmp_path))
+
+    # the temporary file is removed
+    assert os.listdir(tmp_path) == []